@@ -0,0 +1,154 @@
+"""
+	MMS Attachment Store
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+"""
+import hashlib, json, os, os.path, re, tempfile, threading
+
+class AttachmentStore:
+	"""
+	Saves the parts (images) of messages, but only one copy of each.
+
+	The same pictures get forwarded around in group messages a lot, so each
+	part is stored by its SHA-256 hash (objects/ab/abcdef...), whatever it's named.
+	If we already have it, nothing is written.
+
+	Every time a part shows up, a line is added to `manifest.jsonl` saying which
+	message (and part) it came from.  With `links` on, each message also gets a
+	folder (messages/<message>/) of hard links to its parts, under their own file names.
+	"""
+	# How much to hash/write at a time
+	chunk_size = 1024*1024
+
+	def __init__(self, store_dir='attachments', links=True):
+		self.store_dir = store_dir
+		self.links = links
+		self.lock = threading.Lock()
+
+		os.makedirs(os.path.join(self.store_dir, 'objects'), exist_ok=True)
+		self.manifest_file = os.path.join(self.store_dir, 'manifest.jsonl')
+
+		# (message, part) => entry, so adding the same message again doesn't add it to the manifest twice
+		self.manifest = {}
+		if os.path.isfile(self.manifest_file):
+			with open(self.manifest_file, 'r') as manifest:
+				for line in manifest:
+					try:
+						entry = json.loads(line)
+					except ValueError:
+						# Probably half of a line, from a crash
+						continue
+					self.manifest[(entry['message'], entry['part'])] = entry
+
+	def object_path(self, hash):
+		return os.path.join(self.store_dir, 'objects', hash[:2], hash)
+
+	def hash(self, data):
+		# Hash the data a chunk at a time, straight from the message (which can be memory mapped)
+		hash = hashlib.sha256()
+		for x in range(0, len(data), self.chunk_size):
+			hash.update(data[x:x+self.chunk_size])
+
+		return hash.hexdigest()
+
+	def write_object(self, path, data):
+		# Write to a temp file, then rename it, so there's never a half-written object
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+		try:
+			with os.fdopen(fd, 'wb') as tmp_file:
+				for x in range(0, len(data), self.chunk_size):
+					tmp_file.write(data[x:x+self.chunk_size])
+
+			# mkstemp only lets us read it, these are for anyone to look at
+			os.chmod(tmp_name, 0o644)
+			os.replace(tmp_name, path)
+		except Exception:
+			os.unlink(tmp_name)
+			raise
+
+	def safe_name(self, name):
+		# Message-IDs and file names can have anything in them
+		return re.sub(r'[^\w.@+-]', '_', name).lstrip('.') or '_'
+
+	def add(self, message, part_num, part):
+		"""
+		Store one MMSPart, from `message` (ie: its Message-ID or file name).
+		Returns the manifest entry.
+		"""
+		data = part.raw
+		file_name = part.real_file_name()
+
+		# The object is named by the hash alone, so the same bytes under different names are stored once
+		hash = self.hash(data)
+		path = self.object_path(hash)
+
+		with self.lock:
+			entry = self.manifest.get((message, part_num))
+			if entry is not None and entry['hash'] == hash:
+				return dict(entry, stored=False)
+
+			# Only write it if it's new
+			stored = not os.path.isfile(path)
+			if stored:
+				self.write_object(path, data)
+
+			entry = {
+				'message': message,
+				'part': part_num,
+				'file_name': file_name,
+				'content_type': part.content_type,
+				'hash': hash,
+				'size': len(data),
+				'object': os.path.relpath(path, self.store_dir)
+			}
+
+			if self.links:
+				entry['link'] = self.link(path, message, file_name)
+
+			self.manifest[(message, part_num)] = entry
+			with open(self.manifest_file, 'a') as manifest:
+				manifest.write(json.dumps(entry) + '\n')
+
+		return dict(entry, stored=stored)
+
+	def add_message(self, message, parts, kinds=('image',)):
+		# Store all of the parts of these kinds, returns their manifest entries
+		return [self.add(message, x, part) for x, part in enumerate(parts) if part.kind() in kinds]
+
+	def link(self, path, message, file_name):
+		# Hard link messages/<message>/<file_name> to the object (it doesn't take any more space)
+		link_dir = os.path.join(self.store_dir, 'messages', self.safe_name(message))
+		os.makedirs(link_dir, exist_ok=True)
+
+		# Two parts can have the same name, so number them
+		base, extension = os.path.splitext(self.safe_name(file_name))
+		link_name = os.path.join(link_dir, base + extension)
+		for x in range(1, 1000):
+			try:
+				os.link(path, link_name)
+				break
+			except FileExistsError:
+				if os.path.samefile(path, link_name):
+					break
+				link_name = os.path.join(link_dir, '{0}_{1}{2}'.format(base, x, extension))
+			except OSError:
+				# File system without hard links, the manifest still has it
+				return None
+		else:
+			raise FileExistsError('Too many parts named {0} in {1}'.format(file_name, link_dir))
+
+		return os.path.relpath(link_name, self.store_dir)
+
+	def stats(self):
+		# How much we saved
+		total_size = sum(entry['size'] for entry in self.manifest.values())
+		unique = {entry['hash']: entry['size'] for entry in self.manifest.values()}
+
+		return {
+			'parts': len(self.manifest),
+			'unique': len(unique),
+			'total_size': total_size,
+			'stored_size': sum(unique.values())
+		}
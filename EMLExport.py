@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+	MMS to Email Exporter
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+
+	Converts MMS messages into .eml files (or one mbox file), so they can be
+	opened with email programs and archiving tools.
+"""
+import argparse, base64, mmap, os.path, re, secrets, sys, time
+from email.header import Header
+from email.utils import encode_rfc2231, formatdate
+
+from MMSMessage import MMSMessage
+
+class EMLExporter:
+	"""
+	Writes a decoded MMS message as a MIME (RFC 5322) email.
+
+	The email module builds the whole message in memory, so this writes it
+	out by hand instead.  Each part is base64 encoded a chunk at a time,
+	straight from the message data (which can be memory mapped) to the file,
+	so it never needs much memory no matter how big the pictures are.
+	"""
+	# The multipart types MMS uses, and their email versions
+	# Any other application/vnd.wap.multipart.* is sent as multipart/mixed
+	multipart_types = {
+		'application/vnd.wap.multipart.related': 'multipart/related',
+		'application/vnd.wap.multipart.mixed': 'multipart/mixed',
+		'application/vnd.wap.multipart.alternative': 'multipart/alternative'
+	}
+
+	# Python's codec names (what MMSMessage uses) to MIME charset names
+	mime_charsets = {
+		'utf_8': 'utf-8',
+		'ascii': 'us-ascii',
+		'iso8859_1': 'iso-8859-1',
+		'iso8859_2': 'iso-8859-2',
+		'iso8859_3': 'iso-8859-3',
+		'iso8859_4': 'iso-8859-4'
+	}
+
+	# 57 bytes is one 76 character line of base64, so each chunk is a whole number of lines
+	chunk_size = 57*1024
+
+	# Headers are folded onto more lines once they're longer than this (RFC 5322 says 78, and never more than 998)
+	line_length = 78
+
+	# Phone numbers aren't email addresses, so they get this (reserved) domain
+	def __init__(self, domain='mms.invalid'):
+		self.domain = domain
+
+	def address(self, number):
+		# Senders can already be email addresses, only phone numbers need the domain
+		number = number.split('/')[0]
+		if '@' in number:
+			return number
+
+		return '{0}@{1}'.format(number, self.domain)
+
+	def header(self, name, value, separator=' '):
+		# Anything that isn't plain ASCII needs to be encoded (RFC 2047)
+		# So do control characters: a CR/LF would start a new header (ie: a Subject with a Bcc in it)
+		try:
+			value.encode('ascii')
+			if re.search(r'[\x00-\x1f\x7f]', value):
+				raise UnicodeEncodeError('ascii', value, 0, 1, 'control character')
+		except UnicodeEncodeError:
+			# This folds the encoded words itself
+			value = Header(value, 'utf-8', header_name=name).encode(splitchars=separator.strip() or ' ', linesep='\r\n')
+		else:
+			value = self.fold(len(name) + 2, value, separator)
+
+		return '{0}: {1}\r\n'.format(name, value).encode('ascii')
+
+	def fold(self, indent, value, separator=' '):
+		# Break a long value onto more lines (CRLF and a space) after each `separator` that fits
+		# ie: ', ' for a list of addresses.  `indent` is how much of the first line the header's name takes.
+		pieces = value.split(separator)
+		lines = [pieces[0]]
+		length = indent + len(pieces[0])
+
+		for piece in pieces[1:]:
+			if length + len(separator) + len(piece) > self.line_length:
+				lines[-1] += separator.rstrip()
+				lines.append(piece)
+				length = 1 + len(piece)
+			else:
+				lines[-1] += separator + piece
+				length += len(separator) + len(piece)
+
+		return '\r\n '.join(lines)
+
+	def quote(self, value):
+		# For file names, which go inside another header, so control characters are just dropped
+		value = re.sub(r'[\x00-\x1f\x7f]', '', value)
+		return '"{0}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+	def parameter(self, name, value):
+		# A header parameter (ie: a file name), quoted if it's ASCII
+		# Otherwise only the parameter is encoded (RFC 2231), the rest of the header has to stay readable
+		try:
+			value.encode('ascii')
+		except UnicodeEncodeError:
+			value = re.sub(r'[\x00-\x1f\x7f]', '', value)
+			return '{0}*={1}'.format(name, encode_rfc2231(value, 'utf-8'))
+
+		return '{0}={1}'.format(name, self.quote(value))
+
+	def message_headers(self, mms_headers):
+		headers = b''
+
+		if mms_headers.get('From'):
+			headers += self.header('From', self.address(mms_headers['From']))
+		if mms_headers.get('To'):
+			headers += self.header('To', ', '.join(self.address(to_num) for to_num in mms_headers['To']), ', ')
+		if mms_headers.get('Cc'):
+			headers += self.header('Cc', ', '.join(self.address(cc_num) for cc_num in mms_headers['Cc']), ', ')
+
+		date = mms_headers.get('Date')
+		headers += self.header('Date', formatdate(date.timestamp() if date is not None else None, localtime=True))
+
+		if mms_headers.get('Subject'):
+			headers += self.header('Subject', mms_headers['Subject'])
+		if mms_headers.get('Message-ID'):
+			headers += self.header('Message-ID', '<{0}>'.format(mms_headers['Message-ID'].strip('<>')))
+		if mms_headers.get('X-Mms-Transaction-Id'):
+			headers += self.header('X-Mms-Transaction-Id', mms_headers['X-Mms-Transaction-Id'])
+
+		headers += b'MIME-Version: 1.0\r\n'
+		return headers
+
+	def part_headers(self, part):
+		content_type = part.content_type
+		if part.charset and part.kind() in ('text', 'smil'):
+			content_type += '; charset=' + self.mime_charsets.get(part.charset, part.charset.replace('_', '-'))
+
+		file_name = part.real_file_name() if part.kind() == 'image' else part.file_name
+		if file_name:
+			content_type += '; ' + self.parameter('name', file_name)
+
+		headers = self.header('Content-Type', content_type)
+
+		if part.content_id:
+			headers += self.header('Content-ID', '<{0}>'.format(part.content_id.strip('<>')))
+		if part.content_location:
+			headers += self.header('Content-Location', part.content_location)
+		if file_name:
+			disposition = 'inline' if part.kind() in ('text', 'smil') else 'attachment'
+			headers += self.header('Content-Disposition', '{0}; {1}'.format(disposition, self.parameter('filename', file_name)))
+
+		headers += b'Content-Transfer-Encoding: base64\r\n'
+		return headers
+
+	def write_body(self, output, data):
+		# Base64 a chunk at a time, with CRLF line endings
+		for x in range(0, len(data), self.chunk_size):
+			output.write(base64.encodebytes(data[x:x+self.chunk_size]).replace(b'\n', b'\r\n'))
+
+	def write(self, output, mms_headers, mms_parts):
+		# Write one message to a (binary) file
+		output.write(self.message_headers(mms_headers))
+
+		content_type = mms_headers.get('Content-Type') or ''
+		if not content_type.startswith('application/vnd.wap.multipart.'):
+			if not mms_parts:
+				# Nothing in it at all
+				output.write(b'Content-Type: text/plain; charset=us-ascii\r\n\r\n')
+				return
+
+			# An error message, just one text part
+			part = mms_parts[0]
+			output.write(self.part_headers(part) + b'\r\n')
+			self.write_body(output, part.raw)
+			return
+
+		# Base64 never has "=_" in it, so this can't show up in any of the parts
+		boundary = '=_mms_{0}'.format(secrets.token_hex(16))
+
+		multipart_type = self.multipart_types.get(content_type, 'multipart/mixed')
+		multipart = '{0}; boundary={1}'.format(multipart_type, self.quote(boundary))
+		if multipart_type == 'multipart/related':
+			if mms_headers.related_type:
+				multipart += '; type=' + self.quote(mms_headers.related_type)
+			if mms_headers.start:
+				multipart += '; start=' + self.quote('<{0}>'.format(mms_headers.start.strip('<>')))
+
+		output.write(self.header('Content-Type', multipart))
+		output.write(b'\r\nThis is a multi-part message in MIME format.\r\n')
+
+		boundary = boundary.encode('ascii')
+		for part in mms_parts:
+			output.write(b'\r\n--' + boundary + b'\r\n')
+			output.write(self.part_headers(part) + b'\r\n')
+			self.write_body(output, part.raw)
+
+		output.write(b'\r\n--' + boundary + b'--\r\n')
+
+	def write_mbox(self, output, mms_headers, mms_parts):
+		# Add one message to an mbox file
+		# Every body is base64, so there are never any "From " lines in them that need escaping
+		date = mms_headers.get('Date')
+		sender = self.address(mms_headers['From']) if mms_headers.get('From') else 'MAILER-DAEMON'
+		output.write('From {0} {1}\n'.format(sender, time.asctime(date.timetuple() if date is not None else time.localtime())).encode('ascii'))
+
+		# mbox files use plain newlines
+		self.write(NewlineWriter(output), mms_headers, mms_parts)
+		output.write(b'\n')
+
+class NewlineWriter:
+	# Turns CRLF into LF as it's written (for mbox files)
+	def __init__(self, output):
+		self.output = output
+
+	def write(self, data):
+		return self.output.write(data.replace(b'\r\n', b'\n'))
+
+def open_message(file_name):
+	# Memory map the file, so the parts are read straight off the disk as they are written out
+	with open(file_name, 'rb') as mms_file:
+		try:
+			mms_data = mmap.mmap(mms_file.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			# Empty files can't be mapped
+			mms_data = mms_file.read()
+
+	return MMSMessage(mms_data).decode(use_pil=False, lazy=True)
+
+if __name__ == '__main__':
+	from batch import find_files
+
+	parser = argparse.ArgumentParser(
+		description="Export MMS messages as .eml files, or an mbox",
+		epilog="https://github.com/NTICompass/mms-viewer"
+	)
+
+	parser.add_argument("paths", nargs="+", help="MMS files, directories or globs")
+	parser.add_argument('-d', '--output-dir', default='.', help="Where to write the .eml files (default: .)")
+	parser.add_argument('--mbox', metavar="FILE", help="Write all of the messages to this mbox file instead ('-' for stdout)")
+	parser.add_argument('--pattern', default='*.bin', help="File pattern to use in directories (default: *.bin)")
+	parser.add_argument('--domain', default='mms.invalid', help="Domain to put after phone numbers (default: mms.invalid)")
+
+	args = parser.parse_args()
+
+	exporter = EMLExporter(args.domain)
+
+	if args.mbox is not None:
+		mbox = sys.stdout.buffer if args.mbox == '-' else open(args.mbox, 'ab')
+	else:
+		os.makedirs(args.output_dir, exist_ok=True)
+
+	for file_name in find_files(args.paths, args.pattern):
+		try:
+			mms_headers, mms_parts = open_message(file_name)
+		except Exception as error:
+			print('{0}: {1}: {2}'.format(file_name, type(error).__name__, error), file=sys.stderr)
+			continue
+
+		# One bad message shouldn't stop the whole export, or leave half of itself behind
+		if args.mbox is not None:
+			start = mbox.tell() if mbox.seekable() else None
+			try:
+				exporter.write_mbox(mbox, mms_headers, mms_parts)
+			except Exception as error:
+				print('{0}: {1}: {2}'.format(file_name, type(error).__name__, error), file=sys.stderr)
+				if start is not None:
+					mbox.seek(start)
+					mbox.truncate()
+		else:
+			eml_name = os.path.join(args.output_dir, os.path.splitext(os.path.basename(file_name))[0] + '.eml')
+			try:
+				with open(eml_name, 'wb') as eml_file:
+					exporter.write(eml_file, mms_headers, mms_parts)
+			except Exception as error:
+				print('{0}: {1}: {2}'.format(file_name, type(error).__name__, error), file=sys.stderr)
+				os.unlink(eml_name)
+
+	if args.mbox is not None and mbox is not sys.stdout.buffer:
+		mbox.close()
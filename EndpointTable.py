@@ -0,0 +1,199 @@
+"""
+	MMSC Endpoint Table
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+"""
+import atexit, json, os, os.path, tempfile, threading, time
+
+from Profiler import profiler
+
+class Endpoint:
+	"""
+	One MMSC server, and how well it's been doing.
+
+	After `max_failures` errors/timeouts in a row its circuit "opens", and it's
+	skipped for `cooldown` seconds.  Then one request is let through to see if
+	it's back.  If that fails too, it waits twice as long (up to `max_cooldown`).
+	"""
+	max_failures = 3
+	cooldown = 30
+	max_cooldown = 15*60
+
+	# How much each new latency counts, compared to the average so far
+	latency_weight = 0.3
+
+	def __init__(self, server, query, port):
+		self.server = server
+		self.query = query
+		self.port = str(port)
+
+		self.latency = None
+		self.failures = 0
+		self.answered = 0
+		self.open_until = 0
+		self.open_for = self.cooldown
+		self.trying = False
+
+	def __repr__(self):
+		return '<Endpoint {0}:{1}/{2} latency={3} failures={4}>'.format(self.server, self.port, self.query,
+			'{0:.3f}'.format(self.latency) if self.latency is not None else None, self.failures)
+
+	def available(self, now):
+		# Is the circuit closed, or is it time to try it again?
+		return self.failures < self.max_failures or (now >= self.open_until and not self.trying)
+
+	def success(self, latency):
+		# It answered (even if it was a 404), so it's working
+		self.answered += 1
+		self.failures = 0
+		self.open_for = self.cooldown
+		self.trying = False
+
+		if self.latency is None:
+			self.latency = latency
+		else:
+			self.latency += self.latency_weight * (latency - self.latency)
+
+	def failure(self, now):
+		self.failures += 1
+
+		if self.failures >= self.max_failures:
+			# It was open already, and the trial request failed
+			if self.trying:
+				self.open_for = min(self.open_for * 2, self.max_cooldown)
+
+			self.open_until = now + self.open_for
+			self.trying = False
+
+class EndpointTable:
+	"""
+	Picks which MMSC server to download an MMS ID from.
+
+	Virgin Mobile uses different servers for different IDs, which one seems to
+	depend on the length of the ID.  So each time a server has a message, we
+	remember it for that "pattern" of ID (its length, and if it's all digits).
+	Servers are tried in order of how often they had IDs like this one, then
+	the `preferred` server for that length, then the rest by their latency.
+
+	Servers that keep failing or timing out are skipped for a while (see `Endpoint`),
+	instead of waiting for them to time out on every download.  Call `begin()`
+	before each request, then `success()`, `not_found()` or `failure()` after it,
+	and `end()` when it's over (however it ended).
+
+	The patterns are saved in `state_file` (JSON), if there is one.  It's only
+	written when the order the servers are tried in changes, the counts that
+	don't change anything are saved by `flush()` (which is also run at exit).
+	"""
+	def __init__(self, servers, port, preferred=None, state_file=None):
+		# `servers` is a list of (server, query), `preferred` is an object of ID length => server
+		self.endpoints = {server: Endpoint(server, query, port) for server, query in servers}
+		self.preferred = preferred or {}
+		self.state_file = state_file
+		self.lock = threading.Lock()
+
+		# pattern => {server: how many IDs it had}
+		self.patterns = self.load_state()
+		self.dirty = False
+
+		if self.state_file is not None:
+			atexit.register(self.flush)
+
+	def load_state(self):
+		if self.state_file is None:
+			return {}
+
+		try:
+			with open(self.state_file, 'r') as state:
+				return json.load(state).get('patterns', {})
+		except (OSError, ValueError):
+			return {}
+
+	def save_state(self):
+		if self.state_file is None:
+			return
+
+		# Write to a temp file, then rename it, so it's never half written
+		fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.state_file)), prefix='.tmp-')
+		try:
+			with os.fdopen(fd, 'w') as tmp_file:
+				json.dump({'patterns': self.patterns}, tmp_file)
+			os.replace(tmp_name, self.state_file)
+		except Exception:
+			os.unlink(tmp_name)
+			raise
+
+		self.dirty = False
+
+	def flush(self):
+		# Save the counts that haven't been yet
+		with self.lock:
+			if self.dirty:
+				self.save_state()
+
+	def pattern(self, mms_id):
+		return '{0}:{1}'.format(len(mms_id), 'digits' if mms_id.isdigit() else 'alnum')
+
+	def candidates(self, mms_id):
+		# All of the endpoints, in the order to try them for this ID
+		with self.lock:
+			served = self.patterns.get(self.pattern(mms_id), {})
+			preferred = self.preferred.get(len(mms_id))
+
+			def rank(endpoint):
+				return (
+					-served.get(endpoint.server, 0),
+					endpoint.server != preferred,
+					endpoint.latency if endpoint.latency is not None else float('inf')
+				)
+
+			return sorted(self.endpoints.values(), key=rank)
+
+	def begin(self, endpoint):
+		# Call this before sending a request, if it returns False skip this endpoint (its circuit is open)
+		with self.lock:
+			if not endpoint.available(time.monotonic()):
+				profiler.count('endpoint.skipped')
+				return False
+
+			# This is the one request that sees if it's working again
+			if endpoint.failures >= endpoint.max_failures:
+				endpoint.trying = True
+
+			return True
+
+	def end(self, endpoint):
+		# Call this when the request is over, if it was the trial request and nothing
+		# was reported (it raised something else), let another one try
+		with self.lock:
+			endpoint.trying = False
+
+	def success(self, endpoint, mms_id, latency):
+		with self.lock:
+			endpoint.success(latency)
+
+			served = self.patterns.setdefault(self.pattern(mms_id), {})
+			order = sorted(served, key=served.get, reverse=True)
+			served[endpoint.server] = served.get(endpoint.server, 0) + 1
+
+			# Most of the time it's the same server as last time, that's not worth writing the file for
+			if sorted(served, key=served.get, reverse=True) != order:
+				self.save_state()
+			else:
+				self.dirty = True
+
+	def failure(self, endpoint):
+		# An error or a timeout, not a 404
+		with self.lock:
+			endpoint.failure(time.monotonic())
+
+	def not_found(self, endpoint, latency):
+		# The server's fine, it just doesn't have that message
+		with self.lock:
+			endpoint.success(latency)
+
+	def timeout(self, endpoint, default=10, minimum=2):
+		# Servers we know are fast don't get as long to answer
+		if endpoint.latency is None:
+			return default
+
+		return min(default, max(minimum, endpoint.latency * 5))
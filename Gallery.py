@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+	MMS Image Gallery
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+
+	One window for all of the images, from one or more messages.
+	Images are decoded on a background thread, so the window shows up right away
+	and the thumbnails fill in as they are ready.
+"""
+import argparse, itertools, mmap, queue, threading
+import tkinter as tk
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image, ImageTk
+
+from MMSMessage import MMSMessage
+
+class Gallery:
+	"""
+	Click a thumbnail (or use the arrow keys) to flip between images.
+
+	The images next to the one being shown (up to `prefetch` on each side)
+	are decoded ahead of time, and the last `cache_size` full-size images are
+	kept around, so flipping back and forth doesn't decode anything again.
+
+	Only the worker thread decodes images, and only the main thread touches tk.
+	The worker hands back PIL images on a queue, which the main thread checks with `after()`.
+	"""
+	# Lower numbers are decoded first
+	priority_show = 0
+	priority_prefetch = 1
+	priority_thumb = 2
+
+	def __init__(self, title='MMS Images', thumb_size=(96, 96), cache_size=8, prefetch=1):
+		self.title = title
+		self.thumb_size = thumb_size
+		self.cache_size = cache_size
+		self.prefetch = prefetch
+
+		# (part, name) for each image
+		self.images = []
+		self.current = None
+
+		# index => PhotoImage
+		self.thumbs = {}
+		self.cache = OrderedDict()
+		self.requested = set()
+
+		# (priority, order, (kind, index)), `order` keeps jobs with the same priority first in, first out
+		self.jobs = queue.PriorityQueue()
+		self.job_order = itertools.count()
+		self.results = queue.Queue()
+
+		self.window = tk.Tk()
+		self.window.title(title)
+
+		# Let's not make the images *too* big, how about a max of 1.5x the screen height
+		self.max_size = (int(self.window.winfo_screenwidth() * 0.9), int(self.window.winfo_screenheight() / 1.5))
+
+		self.panel = tk.Label(self.window, text='Loading...')
+		self.panel.pack(side='top', fill='both', expand='yes')
+
+		self.caption = tk.Label(self.window)
+		self.caption.pack(side='top', fill='x')
+
+		# The thumbnails go in a strip along the bottom, that scrolls if there are a lot of them
+		self.strip_canvas = tk.Canvas(self.window, height=thumb_size[1] + 12, highlightthickness=0)
+		self.strip_scroll = tk.Scrollbar(self.window, orient='horizontal', command=self.strip_canvas.xview)
+		self.strip_canvas.configure(xscrollcommand=self.strip_scroll.set)
+		self.strip = tk.Frame(self.strip_canvas)
+		self.strip.bind('<Configure>', lambda event: self.strip_canvas.configure(scrollregion=self.strip_canvas.bbox('all')))
+		self.strip_canvas.create_window((0, 0), window=self.strip, anchor='nw')
+		self.strip_scroll.pack(side='bottom', fill='x')
+		self.strip_canvas.pack(side='bottom', fill='x')
+		self.buttons = []
+
+		self.window.bind('<Left>', lambda event: self.step(-1))
+		self.window.bind('<Right>', lambda event: self.step(1))
+		self.window.bind('<Escape>', lambda event: self.window.destroy())
+
+		self.worker = threading.Thread(target=self.work, daemon=True)
+		self.worker.start()
+
+		self.window.after(50, self.poll)
+
+	def add(self, part, name=None):
+		# Add one image part, returns its index
+		index = len(self.images)
+		self.images.append((part, name or part.file_name))
+
+		button = tk.Button(self.strip, text=name or part.file_name, compound='top', wraplength=self.thumb_size[0],
+			command=lambda: self.show(index))
+		button.pack(side='left', padx=2, pady=2)
+		self.buttons.append(button)
+
+		self.request('thumb', index, self.priority_thumb)
+
+		if self.current is None:
+			self.show(index)
+
+		return index
+
+	def add_message(self, parts, name=None):
+		# Add all of the images in a message
+		for x, part in enumerate(part for part in parts if part.kind() == 'image'):
+			self.add(part, '{0} #{1}'.format(name, x + 1) if name is not None else None)
+
+	def request(self, kind, index, priority):
+		if (kind, index) not in self.requested:
+			self.requested.add((kind, index))
+			self.jobs.put((priority, next(self.job_order), (kind, index)))
+
+	def work(self):
+		while True:
+			priority, order, (kind, index) = self.jobs.get()
+
+			# We may have moved on since this was asked for
+			if kind == 'full' and abs(index - self.current) > self.prefetch:
+				self.results.put((kind, index, None, None))
+				continue
+
+			try:
+				image = self.load(self.images[index][0], self.thumb_size if kind == 'thumb' else self.max_size)
+			except Exception as error:
+				self.results.put((kind, index, None, error))
+			else:
+				self.results.put((kind, index, image, None))
+
+	def load(self, part, size):
+		# Decode an image, no bigger than `size`
+		image = Image.open(BytesIO(part.raw))
+
+		# JPEGs can be decoded straight to (about) that size, which is a lot faster
+		if image.format == 'JPEG':
+			image.draft(image.mode, size)
+
+		image.thumbnail(size, Image.LANCZOS)
+		return image
+
+	def poll(self):
+		# Take whatever the worker has finished, and put it on the screen
+		try:
+			while True:
+				kind, index, image, error = self.results.get_nowait()
+				self.requested.discard((kind, index))
+
+				if kind == 'thumb' and image is not None:
+					self.thumbs[index] = ImageTk.PhotoImage(image)
+					self.buttons[index].configure(image=self.thumbs[index])
+				elif kind == 'full' and image is not None:
+					self.remember(index, ImageTk.PhotoImage(image))
+					if index == self.current:
+						self.display(index)
+				elif kind == 'full' and error is not None and index == self.current:
+					self.panel.configure(image='', text="Can't display {0}: {1}".format(self.images[index][1], error))
+		except queue.Empty:
+			pass
+
+		self.window.after(50, self.poll)
+
+	def remember(self, index, photo):
+		self.cache[index] = photo
+		self.cache.move_to_end(index)
+
+		while len(self.cache) > self.cache_size:
+			self.cache.popitem(last=False)
+
+	def show(self, index):
+		self.current = index
+
+		for x, button in enumerate(self.buttons):
+			button.configure(relief='sunken' if x == index else 'raised')
+
+		if index in self.cache:
+			self.cache.move_to_end(index)
+			self.display(index)
+		else:
+			self.panel.configure(image='', text='Loading...')
+			self.request('full', index, self.priority_show)
+
+		# Get the ones next to it ready
+		for distance in range(1, self.prefetch + 1):
+			for neighbour in (index + distance, index - distance):
+				if 0 <= neighbour < len(self.images) and neighbour not in self.cache:
+					self.request('full', neighbour, self.priority_prefetch)
+
+	def step(self, direction):
+		if self.images:
+			self.show((self.current + direction) % len(self.images))
+
+	def display(self, index):
+		# Hang on to it, tk stops showing it if it's dropped from the cache
+		self.photo = self.cache[index]
+		self.panel.configure(image=self.photo, text='')
+		self.caption.configure(text='{0} ({1}/{2})'.format(self.images[index][1], index + 1, len(self.images)))
+		self.window.title('{0} - {1}'.format(self.title, self.images[index][1]))
+
+	def run(self):
+		self.window.mainloop()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description="Show the images from one or more MMS files",
+		epilog="https://github.com/NTICompass/mms-viewer"
+	)
+
+	parser.add_argument("files", nargs="+", help="MMS files")
+	parser.add_argument('--cache-size', type=int, default=8, help="Full-size images to keep in memory (default: 8)")
+	parser.add_argument('--prefetch', type=int, default=1, help="Images on each side to decode ahead of time (default: 1)")
+
+	args = parser.parse_args()
+
+	gallery = Gallery(cache_size=args.cache_size, prefetch=args.prefetch)
+
+	for file_name in args.files:
+		with open(file_name, 'rb') as mms_file:
+			try:
+				mms_data = mmap.mmap(mms_file.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError:
+				continue
+
+		mms_headers, mms_parts = MMSMessage(mms_data).decode(use_pil=False, lazy=True)
+		gallery.add_message(mms_parts, file_name)
+
+	if gallery.images:
+		gallery.run()
+	else:
+		parser.exit(1, "No images found\n")
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+	MMSC Emulator
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+
+	A local stand-in for Virgin Mobile's MMSC servers, so downloading can be
+	tested (and benchmarked) without the carrier.
+
+	Messages are served from a directory, as `/ammsc?<id>` like the real thing.
+	It can be made slow (latency, bandwidth) and unreliable (404s, timeouts).
+"""
+import argparse, os.path, random, re, socket, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class MMSCRequestHandler(BaseHTTPRequestHandler):
+	# Keep-alive, like `VirginMobile.download_many()` expects
+	protocol_version = 'HTTP/1.1'
+	server_version = 'MMSC/1.0'
+
+	def do_GET(self):
+		server = self.server
+		path, _, mms_id = self.path.partition('?')
+
+		# The real servers want to know who's asking
+		phone_num = self.headers.get('X-MDN')
+		if server.require_mdn and not phone_num:
+			return self.send_empty(403)
+
+		if path.strip('/') != server.query or not mms_id:
+			return self.send_empty(404)
+
+		if server.latency:
+			time.sleep(server.latency + random.uniform(0, server.jitter))
+
+		# Sometimes the server never answers at all
+		if server.timeout_rate and random.random() < server.timeout_rate:
+			time.sleep(server.hang)
+			self.close_connection = True
+			return
+
+		mms_data = server.find_message(phone_num, mms_id)
+		if mms_data is None:
+			return self.send_empty(404)
+
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/vnd.wap.mms-message')
+		self.send_header('Content-Length', str(len(mms_data)))
+		self.end_headers()
+
+		try:
+			self.send_body(mms_data)
+		except (BrokenPipeError, ConnectionResetError, socket.timeout):
+			# The client gave up on us
+			self.close_connection = True
+
+	def send_empty(self, status):
+		self.send_response(status)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+
+	def send_body(self, mms_data):
+		bandwidth = self.server.bandwidth
+		if not bandwidth:
+			self.wfile.write(mms_data)
+			return
+
+		# Send about 10 chunks a second, to simulate a slow connection
+		chunk_size = max(int(bandwidth / 10), 1)
+		start = time.perf_counter()
+		for x in range(0, len(mms_data), chunk_size):
+			self.wfile.write(mms_data[x:x+chunk_size])
+
+			# Wait until the time we *should* have finished sending this much
+			ahead = (x + chunk_size) / bandwidth - (time.perf_counter() - start)
+			if ahead > 0:
+				time.sleep(ahead)
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			super().log_message(format, *args)
+
+class MMSCServer(ThreadingHTTPServer):
+	"""
+	Serves the MMS PDUs in `pdu_dir`.
+
+	A message is `<pdu_dir>/<phone number>/<id>.bin`, or `<pdu_dir>/<id>.bin` for any phone.
+	Or pass `messages`, an object of PDUs keyed by ID.
+
+	latency: seconds to wait before answering (plus up to `jitter` more)
+	bandwidth: bytes/sec to send the message at (None for as fast as possible)
+	not_found_rate: fraction of IDs that always 404 (picked by the ID, so it's the same every time)
+	timeout_rate: fraction of requests that are never answered (they wait `hang` seconds, then close)
+	"""
+	daemon_threads = True
+
+	def __init__(self, address=('127.0.0.1', 0), pdu_dir=None, messages=None, query='ammsc', latency=0, jitter=0,
+		bandwidth=None, not_found_rate=0, timeout_rate=0, hang=30, require_mdn=True, verbose=False):
+		self.pdu_dir = pdu_dir
+		self.messages = messages or {}
+		self.query = query
+		self.latency = latency
+		self.jitter = jitter
+		self.bandwidth = bandwidth
+		self.not_found_rate = not_found_rate
+		self.timeout_rate = timeout_rate
+		self.hang = hang
+		self.require_mdn = require_mdn
+		self.verbose = verbose
+
+		super().__init__(address, MMSCRequestHandler)
+
+	@property
+	def port(self):
+		return self.server_address[1]
+
+	def mms_servers(self, id_lengths=(9, 17)):
+		# What to pass to `VirginMobile(mms_servers=...)` to use this server
+		host = self.server_address[0]
+		return {length: (host, self.query) for length in id_lengths}
+
+	def find_message(self, phone_num, mms_id):
+		if self.not_found_rate and random.Random(mms_id).random() < self.not_found_rate:
+			return None
+
+		if mms_id in self.messages:
+			return self.messages[mms_id]
+
+		if self.pdu_dir is None or os.path.basename(mms_id) != mms_id:
+			return None
+
+		# The phone number is a directory name too, so it can only be digits (ie: not "..", or an absolute path)
+		if phone_num and not re.fullmatch(r'\+?\d+', phone_num):
+			return None
+
+		for file_name in (os.path.join(self.pdu_dir, phone_num or '', mms_id + '.bin'), os.path.join(self.pdu_dir, mms_id + '.bin')):
+			if os.path.isfile(file_name):
+				with open(file_name, 'rb') as mms_file:
+					return mms_file.read()
+
+		return None
+
+	def start(self):
+		# Run the server in the background, call `shutdown()` to stop it
+		thread = threading.Thread(target=self.serve_forever, daemon=True)
+		thread.start()
+		return thread
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description="A local MMSC server, for testing downloads",
+		epilog="https://github.com/NTICompass/mms-viewer"
+	)
+
+	parser.add_argument("pdu_dir", help="Directory of <id>.bin (or <phone>/<id>.bin) files to serve")
+	parser.add_argument('--host', default='127.0.0.1', help="Address to listen on (default: 127.0.0.1)")
+	parser.add_argument('--port', type=int, default=8088, help="Port to listen on (default: 8088)")
+	parser.add_argument('--latency', type=float, default=0, help="Seconds to wait before answering (default: 0)")
+	parser.add_argument('--jitter', type=float, default=0, help="Up to this many more seconds of latency (default: 0)")
+	parser.add_argument('--bandwidth', type=int, help="Bytes/sec to send messages at (default: unlimited)")
+	parser.add_argument('--not-found', type=float, default=0, help="Fraction of IDs to 404 (default: 0)")
+	parser.add_argument('--timeouts', type=float, default=0, help="Fraction of requests to never answer (default: 0)")
+	parser.add_argument('--hang', type=float, default=30, help="Seconds to hang for before closing a timed out request (default: 30)")
+	parser.add_argument('-v', '--verbose', help="Log each request", action="store_true")
+
+	args = parser.parse_args()
+
+	server = MMSCServer((args.host, args.port), args.pdu_dir, latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth,
+		not_found_rate=args.not_found, timeout_rate=args.timeouts, hang=args.hang, verbose=args.verbose)
+
+	print('Serving {0} on http://{1}:{2}/{3}?<id>'.format(args.pdu_dir, args.host, server.port, server.query))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
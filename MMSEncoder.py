@@ -0,0 +1,184 @@
+"""
+	MMS PDU Encoder
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+
+	Builds MMS PDUs in the same format that MMSMessage decodes.
+	Mainly used to make test/benchmark messages, since we can't share real ones.
+"""
+import random, struct
+from datetime import datetime
+
+from MMSMessage import MMSMessage
+
+def encode_uintvar(value):
+	# The opposite of `read_uintvar`: 7 bits per byte, the 1st bit is the "continue bit"
+	# Ex: 319 => 0x013F => 00 0001 0011 1111 => 1|0000010 0|0111111 => 82 3F
+	octets = [value & 127]
+	value >>= 7
+	while value:
+		octets.append(0x80 | (value & 127))
+		value >>= 7
+
+	return bytes(reversed(octets))
+
+class MMSEncoder:
+	# Reverse lookup tables, so we can go from a value back to its byte
+	header_codes = {(info if type(info) is str else info[0]): code for code, info in MMSMessage.mms_headers.items()}
+	message_types = {value: code for code, value in MMSMessage.mms_message_type.items()}
+	versions = {value: code for code, value in MMSMessage.mms_version.items()}
+	message_classes = {value: code for code, value in MMSMessage.mms_message_class.items()}
+	message_priorities = {value: code for code, value in MMSMessage.mms_message_priority.items()}
+	charsets = {value: code for code, value in MMSMessage.charsets.items()}
+	mime_types = {value: code for code, value in MMSMessage.mime_types.items()}
+
+	def value_length(self, value):
+		# Values with a length: 00-1E is the length, or 1F and then the length (a uintvar)
+		if len(value) <= 0x1E:
+			return bytes([len(value)]) + value
+		else:
+			return b'\x1F' + encode_uintvar(len(value)) + value
+
+	def text(self, value):
+		# Null-terminated string
+		return value.encode('utf_8') + b'\x00'
+
+	def header(self, name, value):
+		return bytes([self.header_codes[name]]) + value
+
+	def encode_headers(self, message_type='m-retrieve-conf', transaction_id=None, version='1.2', message_id=None,
+		date=None, from_num=None, to_nums=(), cc_nums=(), subject=None, message_class='Personal', priority='Normal',
+		retrieve_text=None, content_type='application/vnd.wap.multipart.related', other_headers=()):
+		# `other_headers` is a list of (name, value) that are added (already encoded) before the Content-Type
+		pdu = self.header('X-Mms-Message-Type', bytes([self.message_types[message_type]]))
+
+		if transaction_id is not None:
+			pdu += self.header('X-Mms-Transaction-Id', self.text(transaction_id))
+
+		pdu += self.header('X-Mms-MMS-Version', bytes([self.versions[version]]))
+
+		if message_id is not None:
+			pdu += self.header('Message-ID', self.text(message_id))
+
+		# Date is 4 bytes, big endian
+		date = datetime.now() if date is None else date
+		pdu += self.header('Date', self.value_length(struct.pack('>L', int(date.timestamp()))))
+
+		# The "from" has the "Address-present-token" (0x80) in front of it
+		if from_num is not None:
+			pdu += self.header('From', self.value_length(b'\x80' + self.text(from_num + '/TYPE=PLMN')))
+
+		# There can be multiple "To" values, each is its own header
+		for to_num in to_nums:
+			pdu += self.header('To', self.text(to_num + '/TYPE=PLMN'))
+
+		# Same with "Cc"
+		for cc_num in cc_nums:
+			pdu += self.header('Cc', self.text(cc_num + '/TYPE=PLMN'))
+
+		if subject is not None:
+			pdu += self.header('Subject', self.text(subject))
+
+		if message_class is not None:
+			pdu += self.header('X-mms-Message-Class', bytes([self.message_classes[message_class]]))
+
+		if priority is not None:
+			pdu += self.header('X-Mms-Priority', bytes([self.message_priorities[priority]]))
+
+		if retrieve_text is not None:
+			# 0x81: Not "OK"
+			pdu += self.header('X-Mms-Retrieve-Status', b'\x81')
+			pdu += self.header('X-Mms-Retrieve-Text', self.text(retrieve_text))
+
+		for name, value in other_headers:
+			pdu += self.header(name, value)
+
+		if content_type.startswith('application/vnd.wap.multipart'):
+			# 0x89: Multipart Related Type, 0x8A: Presentation Content ID
+			value = bytes([self.mime_types[content_type]]) + b'\x89' + self.text('application/smil') + b'\x8A' + self.text('<smil>')
+			pdu += self.header('Content-Type', self.value_length(value))
+		else:
+			pdu += self.header('Content-Type', bytes([self.mime_types[content_type]]))
+
+		return pdu
+
+	def encode_part(self, content_type, data, file_name='', charset='utf_8'):
+		if content_type.startswith('image/'):
+			# Images only have the type, the file name is in the Content-Disposition
+			# Which needs the name to be 12 characters (0x0F bytes)
+			data_header = bytes([self.mime_types[content_type]])
+			if len(file_name) == 12:
+				data_header += b'\xAE\x0F\x81\x86' + self.text(file_name)
+		elif content_type in self.mime_types:
+			# Type, charset and then the file name
+			content_type_range = bytes([self.mime_types[content_type], 0x81, self.charsets[charset]]) + b'\x85' + self.text(file_name)
+			data_header = self.value_length(content_type_range) + b'\x8E' + self.text(file_name)
+		else:
+			# The type as a string, then the charset and then the file name
+			content_type_range = self.text(content_type) + bytes([self.charsets[charset]]) + self.text(file_name)
+			data_header = self.value_length(content_type_range) + b'\xC0"' + self.text('<{0}>'.format(file_name))
+
+		return bytes([len(data_header)]) + encode_uintvar(len(data)) + data_header + data
+
+	def retrieve_conf(self, parts, **headers):
+		# `parts` is a list of (content_type, data, file_name) tuples
+		pdu = self.encode_headers(**headers)
+		pdu += bytes([len(parts)])
+		for content_type, data, file_name in parts:
+			pdu += self.encode_part(content_type, data, file_name)
+
+		return pdu
+
+	def error(self, text, retrieve_text='Error'):
+		# An error is just text/plain, no multipart
+		return self.encode_headers(retrieve_text=retrieve_text, content_type='text/plain', message_class=None, priority=None) + text.encode('utf_8')
+
+	def smil(self, file_names):
+		# A SMIL presentation, with one slide per file
+		slides = []
+		for file_name in file_names:
+			tag = 'img' if file_name.endswith(('.jpg', '.png')) else 'text'
+			region = 'Image' if tag == 'img' else 'Text'
+			slides.append('<par dur="5000ms"><{0} src="{1}" region="{2}"/></par>'.format(tag, file_name, region))
+
+		return ('<smil><head><layout><root-layout width="320" height="480"/>'
+			'<region id="Image" top="0" left="0" height="80%" width="100%"/>'
+			'<region id="Text" top="80%" left="0" height="20%" width="100%"/>'
+			'</layout></head><body>' + ''.join(slides) + '</body></smil>').encode('utf_8')
+
+	def generate(self, parts=2, part_size=1024, mix=('text', 'jpeg'), recipients=1, smil=True, seed=None):
+		"""
+		Make a synthetic m-retrieve-conf message.
+
+		`mix` is cycled through to pick the type of each part (text, jpeg or png).
+		Images are only their file signature followed by random bytes, they
+		aren't real pictures.  They are never opened by PIL when benchmarking.
+		Everything random comes from `seed`, so the same seed makes the same message.
+		"""
+		rand = random.Random(seed)
+		message_parts = []
+
+		for x in range(parts):
+			kind = mix[x % len(mix)]
+			if kind == 'text':
+				data = ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz ') for y in range(part_size)).encode('utf_8')
+				message_parts.append(('text/plain', data, 'text{0:04d}.txt'.format(x)))
+			elif kind == 'jpeg':
+				data = b'\xFF\xD8\xFF\xE1' + rand.randbytes(max(part_size - 4, 0))
+				message_parts.append(('image/jpeg', data, 'IMG_{0:04d}.jpg'.format(x)))
+			elif kind == 'png':
+				data = b'\x89\x50\x4E\x47\x0D\x0A\x1A\x0A' + rand.randbytes(max(part_size - 8, 0))
+				message_parts.append(('image/png', data, 'IMG_{0:04d}.png'.format(x)))
+			else:
+				raise ValueError('Unknown part type: {0}'.format(kind))
+
+		if smil:
+			message_parts.insert(0, ('application/smil', self.smil([part[2] for part in message_parts]), 'smil.xml'))
+
+		return self.retrieve_conf(message_parts,
+			transaction_id='T{0:016x}'.format(rand.getrandbits(64)),
+			message_id='{0:032x}@mms.example'.format(rand.getrandbits(128)),
+			date=datetime(2016, 9, 21, 15, 7, 53),
+			from_num='+1555{0:07d}'.format(rand.randrange(10**7)),
+			to_nums=['1555{0:07d}'.format(rand.randrange(10**7)) for x in range(recipients)],
+			subject='Benchmark')
@@ -3,20 +3,344 @@
 	By: Eric Siegel
 	https://github.com/NTICompass/mms-viewer
 """
-import struct, tempfile
+import os.path, struct, sys
 from datetime import datetime
-from bs4 import BeautifulSoup
-from PIL import Image # Pillow
-from io import BytesIO
+from enum import IntEnum
+
+from Profiler import profiler
+
+class MessageType(IntEnum):
+	# Values for header 0x8C
+	M_SEND_REQ = 0x80
+	M_SEND_CONF = 0x81
+	M_NOTIFICATION_IND = 0x82
+	M_NOTIFYRESP_IND = 0x83
+	M_RETRIEVE_CONF = 0x84
+	M_ACKNOWLEDGE_IND = 0x85
+	M_DELIVERY_IND = 0x86
+	M_READ_REC_IND = 0x87
+	M_READ_ORIG_IND = 0x88
+	M_FORWARD_REQ = 0x89
+	M_FORWARD_CONF = 0x8A
+
+	# ie: m-retrieve-conf
+	def __str__(self):
+		return self.name.lower().replace('_', '-')
+
+class MMSVersion(IntEnum):
+	# Values for header 0x8D
+	# From: https://godoc.org/github.com/ubuntu-phonedations/nuntium/mms
+	V1_0 = 0x90
+	V1_1 = 0x91
+	V1_2 = 0x92
+	V1_3 = 0x93
+
+	# ie: 1.2
+	def __str__(self):
+		return self.name[1:].replace('_', '.')
+
+class MessageClass(IntEnum):
+	# Values for header 0x8A
+	PERSONAL = 0x80
+	ADVERTISEMENT = 0x81
+	INFORMATIONAL = 0x82
+	AUTO = 0x83
+
+	# ie: Personal
+	def __str__(self):
+		return self.name.title()
+
+class MessagePriority(IntEnum):
+	# Values for header 0x8F
+	LOW = 0x80
+	NORMAL = 0x81
+	HIGH = 0x82
+
+	# ie: Normal
+	def __str__(self):
+		return self.name.title()
+
+class MMSHeaders:
+	"""
+	The decoded headers of an MMS message.
+
+	Each header we know how to decode has its own slot (no __dict__), and the
+	message type, class, priority and version are stored as enums.  So there's
+	a lot less memory used per message when there are millions of them.
+
+	It can still be used like the dict that `decode()` used to return.
+	ie: headers['From'], 'Subject' in headers, headers.items()
+	The enums are turned back into their names there (ie: 'm-retrieve-conf').
+	Any other header is kept in the `extra` dict, which is only made if one shows up.
+	"""
+	# Header name => attribute
+	fields = {
+		'X-Mms-Message-Type': 'message_type',
+		'X-Mms-Transaction-Id': 'transaction_id',
+		'X-Mms-MMS-Version': 'version',
+		'Message-ID': 'message_id',
+		'Date': 'date',
+		'From': 'from_num',
+		'To': 'to_nums',
+		'Cc': 'cc_nums',
+		'Subject': 'subject',
+		'X-mms-Message-Class': 'message_class',
+		'X-Mms-Priority': 'priority',
+		'X-Mms-Delivery-Report': 'delivery_report',
+		'X-Mms-Retrieve-Status': 'retrieve_status',
+		'X-Mms-Retrieve-Text': 'retrieve_text',
+		'Content-Type': 'content_type'
+	}
+
+	# `related_type` and `start` are from the Content-Type header
+	# (the type of the "main" part, and its Content-ID)
+	__slots__ = tuple(fields.values()) + ('related_type', 'start', 'extra')
+
+	def __init__(self, **values):
+		for slot in self.__slots__:
+			setattr(self, slot, values.get(slot))
+
+	def __getitem__(self, key):
+		if key in self.fields:
+			value = getattr(self, self.fields[key])
+		else:
+			value = self.extra.get(key) if self.extra is not None else None
+
+		if value is None:
+			raise KeyError(key)
+
+		return str(value) if isinstance(value, IntEnum) else value
+
+	def __setitem__(self, key, value):
+		if key in self.fields:
+			setattr(self, self.fields[key], value)
+		else:
+			if self.extra is None:
+				self.extra = {}
+			self.extra[key] = value
+
+	def __contains__(self, key):
+		if key in self.fields:
+			return getattr(self, self.fields[key]) is not None
+
+		return self.extra is not None and self.extra.get(key) is not None
+
+	def get(self, key, default=None):
+		return self[key] if key in self else default
+
+	def keys(self):
+		keys = [key for key in self.fields if key in self]
+		if self.extra is not None:
+			keys += [key for key in self.extra if key in self]
+
+		return keys
+
+	def items(self):
+		return [(key, self[key]) for key in self.keys()]
+
+	def values(self):
+		return [self[key] for key in self.keys()]
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.keys())
+
+	def to_dict(self):
+		return dict(self.items())
+
+	def __eq__(self, other):
+		if isinstance(other, (MMSHeaders, dict)):
+			return self.to_dict() == dict(other.items())
+
+		return NotImplemented
+
+	def __repr__(self):
+		return repr(self.to_dict())
+
+
+def read_uintvar(data, curr_index):
+	"""
+	Read a "Variable Length Unsigned Int" (WAP-230 Section 8.1.2) from `data`.
+
+	Returns the value and the index after it.
+	Raises an IndexError if `data` ends before the last byte of the uintvar.
+	"""
+	value = 0
+	while True:
+		byte = data[curr_index]
+		curr_index += 1
+		value = (value << 7) | (byte & 127)
+		if byte >> 7 == 0:
+			return value, curr_index
+
+class MMSPart:
+	"""
+	One part of a (multipart) MMS message.
+
+	When the message is decoded, we only record where the part is in the data,
+	its length, content type, charset and file name.  The actual "decoding"
+	(PIL, the SMIL parser or the charset) only happens the first time `data` is read.
+
+	It can still be used like the dict that `decode()` used to return.
+	ie: part['contentType'], part['data']
+	"""
+	# The "hex signature" each image format starts with, and its file extension
+	# See: https://en.wikipedia.org/wiki/List_of_file_signatures
+	file_signatures = [
+		(b'\xFF\xD8\xFF', 'JPEG', '.jpg'),
+		(b'\x89\x50\x4E\x47\x0D\x0A\x1A\x0A', 'PNG', '.png'),
+		(b'GIF87a', 'GIF', '.gif'),
+		(b'GIF89a', 'GIF', '.gif'),
+		(b'BM', 'BMP', '.bmp'),
+		(b'II*\x00', 'TIFF', '.tif'),
+		(b'MM\x00*', 'TIFF', '.tif')
+	]
+
+	__slots__ = ('source', 'offset', 'content_length', 'content_type', 'charset', 'file_name', 'use_pil',
+		'content_id', 'content_location', 'related', '_data', '_decoded')
+
+	keys_map = {
+		'fileName': 'file_name',
+		'contentType': 'content_type',
+		'contentLength': 'content_length',
+		'charset': 'charset',
+		'data': 'data'
+	}
+
+	def __init__(self, source, offset, length, content_type, charset='', file_name='', use_pil=True,
+		content_id=None, content_location=None):
+		self.source = source
+		self.offset = offset
+		self.content_length = length
+		self.content_type = content_type
+		self.charset = charset
+		self.file_name = file_name
+		self.use_pil = use_pil
+		self.content_id = content_id
+		self.content_location = content_location
+
+		# The other parts in the same message, so the SMIL can find the parts it uses
+		self.related = []
+
+		# This is filled in when the data is first read
+		self._data = None
+		self._decoded = False
+
+	@property
+	def raw(self):
+		# The undecoded bytes of this part
+		# This is a memoryview into the original data, nothing is copied
+		return self.source[self.offset:self.offset+self.content_length]
+
+	@property
+	def decoded(self):
+		return self._decoded
+
+	@property
+	def data(self):
+		if not self._decoded:
+			# Each kind of decoding is timed separately
+			with profiler.timer('decode.' + self.kind()):
+				self._data = self.decode_data()
+			self._decoded = True
+
+		return self._data
+
+	def kind(self):
+		# image, smil, text or other (audio, video, vCards, ...)
+		if self.content_type.startswith('image/'):
+			return 'image'
+		elif self.content_type == 'application/smil':
+			return 'smil'
+		elif self.content_type.startswith('text/'):
+			return 'text'
+		else:
+			return 'other'
+
+	def decode_data(self):
+		the_data = self.raw
+
+		# "Decode" the data, or wrap it in an object
+		if self.content_type.startswith('image/'):
+			# Should we process the image with PIL or not?
+			if self.use_pil:
+				# Pillow is slow to import, so it's only imported when an image is decoded
+				from PIL import Image # Pillow
+				from io import BytesIO
+
+				return Image.open(BytesIO(the_data))
+			else:
+				# Just hand back the memoryview, it can be written straight to a file
+				return the_data
+		elif self.content_type == 'application/smil':
+			return SMILPresentation.parse(str(the_data, self.charset), self.related)
+		elif self.content_type.startswith('text/'):
+			return str(the_data, self.charset)
+		else:
+			# Audio, video, etc. aren't text, hand back the bytes (as a memoryview)
+			return the_data
+
+	def sniff_format(self):
+		# What format is this *really*?  Check the first few bytes, don't trust the content type.
+		# Returns the format (as PIL names it) and its extension, or None if we don't know it.
+		header = bytes(self.source[self.offset:self.offset+min(self.content_length, 8)])
+		for signature, image_format, extension in self.file_signatures:
+			if header.startswith(signature):
+				return image_format, extension
+
+		return None
+
+	def real_file_name(self):
+		# The file name, with the extension fixed to match the actual format
+		file_name = self.file_name or 'part{0}'.format(self.offset)
+		sniffed = self.sniff_format()
+		if sniffed is None:
+			return file_name
+
+		image_format, extension = sniffed
+		base_name, file_extension = os.path.splitext(file_name)
+
+		# .jpeg is fine for a JPEG too
+		if file_extension.lower() == extension or (image_format == 'JPEG' and file_extension.lower() == '.jpeg'):
+			return file_name
+
+		return base_name + extension
+
+	# Act like the old dict
+	def __getitem__(self, key):
+		if key not in self.keys_map:
+			raise KeyError(key)
+
+		return getattr(self, self.keys_map[key])
+
+	def __contains__(self, key):
+		return key in self.keys_map
+
+	def get(self, key, default=None):
+		return self[key] if key in self else default
+
+	def keys(self):
+		return self.keys_map.keys()
+
+	def __repr__(self):
+		# Don't decode the data just to print it
+		data = repr(self._data) if self._decoded else '<{0} bytes at {1}>'.format(self.content_length, self.offset)
+		return "{{'fileName': {0!r}, 'contentType': {1!r}, 'contentLength': {2!r}, 'charset': {3!r}, 'data': {4}}}".format(
+			self.file_name, self.content_type, self.content_length, self.charset, data)
 
 class MMSMessage:
+	# Bump this whenever what `decode()` returns changes, so old entries in a ParseCache aren't used
+	decoder_version = 2
+
 	# Each header value has its own unique way of being decoded
 	# tuple: (name, method)
 	# See: http://www.wapforum.org/tech/documents/WAP-230-WSP-20010705-a.pdf (see section 8.4.1.2)
 	# Turns out the 1st byte after the header (which may be *part* of the data), tells us how to interpret the length
 	mms_headers = {
 		0x81: ("Bcc"),
-		0x82: ("Cc"),
+		0x82: ("Cc", 'to'), # Like "To", there can be more than one
 		0x83: ("X-Mms-Content-Location"),
 		# http://python-mms.sourceforge.net/api/mms.wsp_pdu.Decoder-class.html#decodeContentTypeValue
 		0x84: ("Content-Type", "contentType"),
@@ -50,41 +374,11 @@ class MMSMessage:
 		0xA0: ("X-Mms-Previously-Sent-By"),
 		0xA1: ("X-Mms-Previously-Sent-Date")
 	}
-	# Values for header 0x8C
-	mms_message_type = {
-		0x80: "m-send-req",
-		0x81: "m-send-conf",
-		0x82: "m-notification-ind",
-		0x83: "m-notifyresp-ind",
-		0x84: "m-retrieve-conf",
-		0x85: "m-acknowledge-ind",
-		0x86: "m-delivery-ind",
-		0x87: "m-read-rec-ind",
-		0x88: "m-read-orig-ind",
-		0x89: "m-forward-req",
-		0x8A: "m-forward-conf"
-	}
-	# Values for header 0x8D
-	# From: https://godoc.org/github.com/ubuntu-phonedations/nuntium/mms
-	mms_version = {
-		0x90: '1.0',
-		0x91: '1.1',
-		0x92: '1.2',
-		0x93: '1.3'
-	}
-	# Values for header 0x8A
-	mms_message_class = {
-		0x80: 'Personal',
-		0x81: 'Advertisement',
-		0x82: 'Informational',
-		0x83: 'Auto'
-	}
-	# Values for header 0x8F
-	mms_message_priority = {
-		0x80: 'Low',
-		0x81: 'Normal',
-		0x82: 'High'
-	}
+	# Values for headers 0x8C, 0x8D, 0x8A and 0x8F (see the enums above)
+	mms_message_type = {code.value: str(code) for code in MessageType}
+	mms_version = {code.value: str(code) for code in MMSVersion}
+	mms_message_class = {code.value: str(code) for code in MessageClass}
+	mms_message_priority = {code.value: str(code) for code in MessagePriority}
 
 	# Needed for data decoding
 	charsets = {
@@ -176,326 +470,761 @@ class MMSMessage:
 		0xCB: 'application/vnd.oma.drm.rights+wbxml'
 	}
 
+	# `mms` can be bytes, an mmap or anything else that supports the buffer protocol
+	# Parts are sliced out of it as memoryviews, so their data is never copied
+	# The decoding itself is done by `decoder` (see MMSDecoder), this just holds onto the data
 	def __init__(self, mms):
-		self.data = mms
+		self.data = memoryview(mms).cast('B')
+
+	def decode(self, use_pil=True, lazy=False):
+		return decoder.decode(self.data, use_pil, lazy)
+
+	def decode_headers(self):
+		return decoder.decode_headers(self.data)
+
+	def read_headers(self):
+		return decoder.read_headers(self.data)
+
+	@classmethod
+	def scan_file(cls, file_name, prefix_size=4096):
+		# Decode just the headers of a file, without reading the whole thing
+		# Start with the first `prefix_size` bytes, and read more if the headers don't fit
+		with open(file_name, 'rb') as mms_file:
+			data = b''
+			size = prefix_size
+
+			while True:
+				chunk = mms_file.read(size)
+				at_end = len(chunk) < size
+				data += chunk
+
+				try:
+					mms_headers, curr_index = decoder.read_headers(data)
+					# We're done if we saw the byte after the headers (or there's nothing else to read)
+					if curr_index < len(data) or at_end:
+						return mms_headers
+				except IndexError:
+					if at_end:
+						raise
+
+				size *= 2
+
+	def find_null(self, curr_index):
+		return decoder.find_null(self.data, curr_index)
+
+	def decode_header(self, curr_index, mms_headers):
+		return decoder.decode_header(self.data, curr_index, mms_headers)
+
+	def decode_part(self, curr_index, use_pil=True):
+		return decoder.decode_part(self.data, curr_index, use_pil)
+
+	def decode_part_headers(self, data):
+		return decoder.decode_part_headers(data)
+
+class MMSDecoder:
+	"""
+	Does the actual decoding for `MMSMessage`, without keeping anything on itself.
 
-	def decode(self, use_pil=True):
+	Everything it needs is passed in (the data, the index, the headers being
+	filled in), and the lookup tables are tuples built once when the class is,
+	so one decoder (the module's `decoder`) can be used by any number of threads
+	at the same time.  Each call only touches its own buffer and the objects it returns.
+	"""
+	__slots__ = ()
+
+	# The tables from MMSMessage, as tuples indexed by the byte (None if it's not in the table)
+	# Header codes are 0x80 and up, anything under that (the part count, or the text) ends the headers
+	# Headers we don't know how to decode get a method of None, so their value is skipped over
+	header_table = tuple(None if code < 0x80
+		else MMSMessage.mms_headers[code] if isinstance(MMSMessage.mms_headers.get(code), tuple)
+		else (MMSMessage.mms_headers.get(code, '0x{0:02X}'.format(code)), None)
+		for code in range(256))
+	charset_table = tuple(MMSMessage.charsets.get(code) for code in range(256))
+	mime_table = tuple(MMSMessage.mime_types.get(code) for code in range(256))
+
+	def charset(self, code):
+		charset = self.charset_table[code]
+		if charset is None:
+			raise KeyError(code)
+		return charset
+
+	def mime_type(self, code):
+		mime_type = self.mime_table[code]
+		if mime_type is None:
+			raise KeyError(code)
+		return mime_type
+
+	def decode(self, data, use_pil=True, lazy=False):
 		# Start looping over each byte in the data.
 		# Assume the 1st byte is a header code and then start decoding.
 		# Info on byte/bytearray: https://docs.python.org/3/library/stdtypes.html
-		mms_headers = {}
+		# If `lazy` is set, the parts will only be decoded (PIL, SMIL, etc.) when their data is read
+		# `data` can be bytes, an mmap or anything else that supports the buffer protocol
+		# Parts are sliced out of it as memoryviews, so their data is never copied
+		data = memoryview(data).cast('B')
 		mms_data = []
 
-		curr_index = 0
 		# First get the headers from the data
-		while curr_index < len(self.data):
-			# Get the header...
-			curr_byte = self.data[curr_index]
-			# Once we hit a byte not in the header object, then we're done with the headers
-			# Or we've just hit a header I haven't parsed yet
-			if curr_byte not in self.mms_headers or len(self.mms_headers[curr_byte]) != 2:
-				break
-			# ...and its parsing info
-			header, method = self.mms_headers[curr_byte]
-
-			# Decode the value...
-			value = None
-			# Shift to the next byte
-			curr_index += 1
-
-			# Figure out the length of this header's value
-			# Read the next byte...
-			# 00-1E: Read that many bytes
-			# 1F: Next byte is length
-			# 20-7F: Null-terminated string
-			# 80-FF: This byte is the data
-			header_length = self.data[curr_index]
-
-			if 0 <= header_length <= 0x1E:
-				# This byte is the length of the data
-				# So read that many bytes ahead
-				# After shifting to the start of the data
-				curr_index +=1
-				byte_range = self.data[curr_index:curr_index+header_length]
-				# Shift over that many bytes
-				curr_index += header_length
-			elif header_length == 0x1F:
-				# The next byte is the length
-				curr_index += 1
-				byte_count = self.data[curr_index]
-				# Shift to the start of the data
-				curr_index += 1
-
-				# Read and shift the correct number of bytes
-				byte_range = self.data[curr_index:curr_index+byte_count]
-				curr_index += byte_count
-			elif 0x20 <= header_length <= 0x7F:
-				# Read until we hit a null byte (0x00)
-				# The `header_length` byte is part of our data
-				byte_range = bytearray()
-				while self.data[curr_index] != 0x00:
-					byte_range.append(self.data[curr_index])
-					curr_index += 1
-
-				# Shift off the null byte
-				curr_index += 1
-			elif 0x80 <= header_length <= 0xFF:
-				# This byte is actually the value
-				# So just return it and move on
-				byte_range = self.data[curr_index]
-				curr_index += 1
-
-			# Then decide what to do with those byte(s)
-			if method == 'messageType':
-				# Get the message type
-				value = self.mms_message_type[byte_range]
-			elif method == 'version':
-				# Get the mms version number
-				value = self.mms_version[byte_range]
-			elif method == 'messageClass':
-				# Get the "message class"
-				value = self.mms_message_class[byte_range]
-			elif method == 'messagePriority':
-				# Get the "message priority"
-				value = self.mms_message_priority[byte_range]
-			elif method == 'contentType':
-				# Look up the MIME type in the table
-				# This value may be a single byte
-				byte_range = bytes([byte_range]) if type(byte_range) is int else byte_range
-				if byte_range[0] in self.mime_types:
-					value = self.mms_content_type = self.mime_types[byte_range[0]]
-
-					# Read the type of the encapsulated data
-					for content_header in byte_range[1:].rstrip(b'\x00').split(b'\x00'):
-						# 0x89: Multipart Related Type
-						if content_header.startswith(b'\x89'):
-							# Save the encapsulated content-type separately
-							self.content_type = content_header.lstrip(b'\x89').decode('utf_8')
-						# 0x8A: Presentation Content ID
-						elif content_header.startswith(b'\x8A'):
-							# As well as this value, which I don't know how it's used
-							self.content_id = content_header.lstrip(b'\x8A').decode('utf_8')
-				else:
-					value = ''
-			elif method == 'from':
-				# The "from" phone number
-				# Phone numbers end in "/TYPE=PLMN", let's strip that off
-				# The 1st byte is the "Address-present-token" (0x80)
-				# The last byte is a null byte (trim that off)
-				if byte_range.startswith(b'\x80'):
-					value = byte_range.lstrip(b'\x80').rstrip(b'\x00').decode('utf_8').rstrip('/TYPE=PLMN')
-				else:
-					value = ''
-			elif method == 'to':
-				# This will be an array, just in case there are multiple values
-				value = mms_headers[header] if header in mms_headers else []
-				# Note: value is a *reference*, so we can just update and not set it
-				value.append(byte_range.decode('utf_8').rstrip('/TYPE=PLMN'))
-			elif method == 'ascii':
-				# Convert the byte_range into an ASCII string
-				value = byte_range.decode('utf_8')
-			elif method == 'timestamp':
-				# Decode the bytes into an timestamp
-				# ie: convert b'\x57\xe2\xa2\x49' to 0x57e2a249 (1474470473)
-				# With thanks to: http://codereview.stackexchange.com/a/142918/52
-				# Note: Unpack always returns a tuple (even if it only contains one value)
-				timestamp, = struct.unpack('>L', byte_range)
-				value = datetime.fromtimestamp(timestamp)
-			elif method == 'boolean':
-				# A "boolean" is a yes/no value
-				# 0x80 = yes and 0x81 = no
-				value = byte_range == b'\x80'
-
-			if header not in mms_headers:
-				# If this is an array, then all we need is a reference to it
-				# We can append to that and not need to set it back in the object
-				mms_headers[header] = value
+		with profiler.timer('decode.headers'):
+			mms_headers, curr_index = self.read_headers(data)
 
 		# We've finished the headers, let's move onto the actual data
 		# Continue reading bytes, except we now are filling in the data
 		# The data is (probably) application/vnd.wap.multipart.related
 		# It may not actually be.  In the case of an error, it's just text/plain
-		if self.mms_content_type == 'text/plain':
+		if mms_headers.content_type == 'text/plain':
 			# This is just a txt file.
-			# Just read the rest of the bytes and decode
-			the_data = content_type_length = self.data[curr_index:].decode('utf_8')
-
-			# Append the data to the array of parts
-			mms_data.append({
-				'fileName': None,
-				'contentType': self.mms_content_type,
-				'contentLength': len(the_data),
-				'data': the_data
-			})
-		elif self.mms_content_type.startswith('application/vnd.wap.multipart'):
+			# The rest of the bytes are the data, decode them when they are needed
+			mms_data.append(MMSPart(data, curr_index, len(data) - curr_index,
+				mms_headers.content_type, 'utf_8', None, use_pil))
+		elif (mms_headers.content_type or '').startswith('application/vnd.wap.multipart'):
 			# How many "parts" are in this "multipart" data?
-			parts = self.data[curr_index]
+			parts = data[curr_index]
 			curr_index += 1
 
 			# Loop over each part and get its data
-			for x in range(0, parts):
-				# The next byte tells us the length of the content type header
-				data_header_length = self.data[curr_index]
-				curr_index += 1
-				data_header_index = 0
-
-				# The next X bytes are the content length
-				# We need to read bytes and convert them into octets until
-				# the "continue bit" is 0.
-				# The format is described in WAP-230 Section 8.1.2
-				# "Variable Length Unsigned Ints"
-				# Basically, you encode each hexit as binary,
-				# break then into 7-bit chunks (the 1st bit is the "continue bit")
-				# Then you glue them back together
-				# Ex: 82 3F => 1000 0010 0011 1111
-				# 1|0000010 0|0111111 => 00 0001 0011 1111 => 0x013F => 319
-				# With help from: http://codereview.stackexchange.com/a/142939/52
-				content_length = 0
-				while True:
-					byte = self.data[curr_index]
-					curr_index += 1
-					content_length = (content_length << 7) | (byte & 127)
-					if byte >> 7 == 0:
-						break
-
-				# Get the full "data header", which contains the
-				# Content-Type and Content-ID
-				data_header = self.data[curr_index:curr_index+data_header_length]
-				curr_index += data_header_length
-
-				# Now, we get the content-type.
-				# Read the next byte...
-				# 00-1E: Read that many bytes
-				# 1F: Next byte is length
-				# 80-FF: This byte is the data
-				# This range contains the content-type and its charset
-				if 0x00 <= data_header[data_header_index] <= 0x1E:
-					content_type_length = data_header[data_header_index]
-					data_header_index += 1
-				elif data_header[data_header_index] == 0x1F:
-					content_type_length = data_header[data_header_index+1]
-					data_header_index += 2
-				elif 0x80 <= data_header[data_header_index] <= 0xFF:
-					# This byte *is* the data
-					# Don't shift data_header_index, just re-read this byte
-					content_type_length = 1
-
-				content_type_range = data_header[data_header_index:data_header_index+content_type_length]
-				data_header_index += content_type_length
-
-				# A single byte will be read as an int, convert it back to a bytes object
-				content_type_range = bytes([content_type_range]) if type(content_type_range) is int else content_type_range
-
-				# Get the content type, charset and file name
-				# This may not always be set for all parts
-				file_name = ''
-
-				# How should we intrepret the content type?
-				# Check the 1st byte:
-				# 20-7F: Null-terminated string
-				# 80-FF: This byte is the data
-				if 0x20 <= content_type_range[0] <= 0x7F:
-					# Read until we hit a null byte (0x00)
-					data_content_type_length = content_type_range.index(0x00)
-
-					# self.content_type should be application/smil
-					# The 1st part will be this, but the 2nd can be anything
-					data_content_type = content_type_range[0:data_content_type_length].decode('utf_8')
-
-					# What charset is being used?  That's the next byte
-					data_charset = self.charsets[content_type_range[data_content_type_length+1]]
+			with profiler.timer('decode.parts'):
+				for x in range(0, parts):
+					part, curr_index = self.decode_part(data, curr_index, use_pil)
+					mms_data.append(part)
+
+		# How many of each type of part (and how big) did we see?
+		if profiler.enabled:
+			profiler.count('messages')
+			profiler.count('message_bytes', len(data))
+			for part in mms_data:
+				profiler.count('parts.' + part.content_type)
+				profiler.count('part_bytes.' + part.content_type, part.content_length)
+
+		# Let each part know about the others, for the SMIL
+		for part in mms_data:
+			part.related = mms_data
 
+		# Not being lazy?  Then decode everything right now, like we always have.
+		if not lazy:
+			for part in mms_data:
+				part.data
+
+		return mms_headers, mms_data
+
+	# Only decode the headers, stop before the part count byte
+	def decode_headers(self, data):
+		mms_headers, curr_index = self.read_headers(data)
+		return mms_headers
+
+	# Returns the headers and the index of the byte after them
+	def read_headers(self, data):
+		mms_headers = MMSHeaders()
+
+		curr_index = 0
+		while curr_index < len(data):
+			next_index = self.decode_header(data, curr_index, mms_headers)
+			# Once we hit a byte that isn't a header, then we're done with the headers
+			if next_index is None:
+				break
+			curr_index = next_index
+
+			# Content-Type is always the last header, the data starts right after it
+			if mms_headers.content_type is not None:
+				break
+
+		return mms_headers, curr_index
+
+	def find_null(self, data, curr_index):
+		# Find the next null byte (0x00), scanning a block of bytes at a time
+		# memoryviews can't search, so search a (small) copy of each block
+		while curr_index < len(data):
+			block = bytes(data[curr_index:curr_index+256])
+			null_byte = block.find(0x00)
+			if null_byte > -1:
+				return curr_index + null_byte
+
+			curr_index += len(block)
+
+		raise IndexError('No null byte before the end of the data')
+
+	# Decode the header at `curr_index` and add it to `mms_headers`
+	# Returns the index of the next header, or None if this isn't a header we know
+	def decode_header(self, data, curr_index, mms_headers):
+		# Get the header...
+		curr_byte = data[curr_index]
+		# Once we hit a byte that isn't a header code, then we're done with the headers
+		header_info = self.header_table[curr_byte]
+		if header_info is None:
+			return None
+		# ...and its parsing info
+		header, method = header_info
+
+		# Decode the value...
+		value = None
+		# Shift to the next byte
+		curr_index += 1
+
+		# Figure out the length of this header's value
+		# Read the next byte...
+		# 00-1E: Read that many bytes
+		# 1F: Next byte is length
+		# 20-7F: Null-terminated string
+		# 80-FF: This byte is the data
+		header_length = data[curr_index]
+
+		if 0 <= header_length <= 0x1E:
+			# This byte is the length of the data
+			# So read that many bytes ahead
+			# After shifting to the start of the data
+			curr_index +=1
+			byte_range = bytes(data[curr_index:curr_index+header_length])
+			# Shift over that many bytes
+			curr_index += header_length
+		elif header_length == 0x1F:
+			# The next byte(s) are the length (a uintvar)
+			# And then we're at the start of the data
+			byte_count, curr_index = read_uintvar(data, curr_index + 1)
+
+			# Read and shift the correct number of bytes
+			byte_range = bytes(data[curr_index:curr_index+byte_count])
+			curr_index += byte_count
+		elif 0x20 <= header_length <= 0x7F:
+			# Read until we hit a null byte (0x00)
+			# The `header_length` byte is part of our data
+			null_byte = self.find_null(data, curr_index)
+			byte_range = bytes(data[curr_index:null_byte])
+
+			# Shift off the null byte
+			curr_index = null_byte + 1
+		elif 0x80 <= header_length <= 0xFF:
+			# This byte is actually the value
+			# So just return it and move on
+			byte_range = data[curr_index]
+			curr_index += 1
+
+		# Did the value run off the end of the data?
+		# (This happens when only the start of a file is read)
+		if curr_index > len(data):
+			raise IndexError('{0} runs past the end of the data'.format(header))
+
+		# A header I haven't parsed yet, just skip over it
+		if method is None:
+			return curr_index
+
+		# Then decide what to do with those byte(s)
+		if method == 'messageType':
+			# Get the message type
+			value = MessageType(byte_range)
+		elif method == 'version':
+			# Get the mms version number
+			value = MMSVersion(byte_range)
+		elif method == 'messageClass':
+			# Get the "message class"
+			value = MessageClass(byte_range)
+		elif method == 'messagePriority':
+			# Get the "message priority"
+			value = MessagePriority(byte_range)
+		elif method == 'contentType':
+			# Look up the MIME type in the table
+			# This value may be a single byte
+			byte_range = bytes([byte_range]) if type(byte_range) is int else byte_range
+			if self.mime_table[byte_range[0]] is not None:
+				value = self.mime_table[byte_range[0]]
+
+				# Read the type of the encapsulated data
+				for content_header in byte_range[1:].rstrip(b'\x00').split(b'\x00'):
+					# 0x89: Multipart Related Type
+					if content_header.startswith(b'\x89'):
+						# Save the encapsulated content-type separately
+						mms_headers.related_type = sys.intern(content_header.lstrip(b'\x89').decode('utf_8'))
+					# 0x8A: Presentation Content ID
+					elif content_header.startswith(b'\x8A'):
+						# As well as this value, which I don't know how it's used
+						mms_headers.start = content_header.lstrip(b'\x8A').decode('utf_8')
+			else:
+				value = ''
+		elif method == 'from':
+			# The "from" phone number
+			# Phone numbers end in "/TYPE=PLMN", let's strip that off
+			# The 1st byte is the "Address-present-token" (0x80)
+			# The last byte is a null byte (trim that off)
+			if byte_range.startswith(b'\x80'):
+				value = byte_range.lstrip(b'\x80').rstrip(b'\x00').decode('utf_8').rstrip('/TYPE=PLMN')
+			else:
+				value = ''
+		elif method == 'to':
+			# This will be an array, just in case there are multiple values
+			value = mms_headers[header] if header in mms_headers else []
+			# Note: value is a *reference*, so we can just update and not set it
+			value.append(byte_range.decode('utf_8').rstrip('/TYPE=PLMN'))
+		elif method == 'ascii':
+			# Convert the byte_range into an ASCII string
+			value = byte_range.decode('utf_8')
+		elif method == 'timestamp':
+			# Decode the bytes into an timestamp
+			# ie: convert b'\x57\xe2\xa2\x49' to 0x57e2a249 (1474470473)
+			# With thanks to: http://codereview.stackexchange.com/a/142918/52
+			# Note: Unpack always returns a tuple (even if it only contains one value)
+			timestamp, = struct.unpack('>L', byte_range)
+			value = datetime.fromtimestamp(timestamp)
+		elif method == 'boolean':
+			# A "boolean" is a yes/no value
+			# 0x80 = yes and 0x81 = no
+			value = byte_range == b'\x80'
+
+		if header not in mms_headers:
+			# If this is an array, then all we need is a reference to it
+			# We can append to that and not need to set it back in the object
+			mms_headers[header] = value
+
+		return curr_index
+
+	# Decode the (multipart) part starting at `curr_index`
+	# Returns the part and the index of the next one
+	def decode_part(self, data, curr_index, use_pil=True):
+		# The next byte tells us the length of the content type header
+		data_header_length = data[curr_index]
+		curr_index += 1
+		data_header_index = 0
+
+		# The next X bytes are the content length
+		# We need to read bytes and convert them into octets until
+		# the "continue bit" is 0.
+		# The format is described in WAP-230 Section 8.1.2
+		# "Variable Length Unsigned Ints"
+		# Basically, you encode each hexit as binary,
+		# break then into 7-bit chunks (the 1st bit is the "continue bit")
+		# Then you glue them back together
+		# Ex: 82 3F => 1000 0010 0011 1111
+		# 1|0000010 0|0111111 => 00 0001 0011 1111 => 0x013F => 319
+		# With help from: http://codereview.stackexchange.com/a/142939/52
+		content_length, curr_index = read_uintvar(data, curr_index)
+
+		# Get the full "data header", which contains the
+		# Content-Type and Content-ID
+		data_header = bytes(data[curr_index:curr_index+data_header_length])
+		curr_index += data_header_length
+
+		# Now, we get the content-type.
+		# Read the next byte...
+		# 00-1E: Read that many bytes
+		# 1F: Next byte is length
+		# 80-FF: This byte is the data
+		# This range contains the content-type and its charset
+		if 0x00 <= data_header[data_header_index] <= 0x1E:
+			content_type_length = data_header[data_header_index]
+			data_header_index += 1
+		elif data_header[data_header_index] == 0x1F:
+			content_type_length = data_header[data_header_index+1]
+			data_header_index += 2
+		elif 0x80 <= data_header[data_header_index] <= 0xFF:
+			# This byte *is* the data
+			# Don't shift data_header_index, just re-read this byte
+			content_type_length = 1
+
+		content_type_range = data_header[data_header_index:data_header_index+content_type_length]
+		data_header_index += content_type_length
+
+		# A single byte will be read as an int, convert it back to a bytes object
+		content_type_range = bytes([content_type_range]) if type(content_type_range) is int else content_type_range
+
+		# Get the content type, charset and file name
+		# This may not always be set for all parts
+		file_name = ''
+
+		# How should we intrepret the content type?
+		# Check the 1st byte:
+		# 20-7F: Null-terminated string
+		# 80-FF: This byte is the data
+		if 0x20 <= content_type_range[0] <= 0x7F:
+			# Read until we hit a null byte (0x00)
+			data_content_type_length = content_type_range.index(0x00)
+
+			# self.content_type should be application/smil
+			# The 1st part will be this, but the 2nd can be anything
+			data_content_type = sys.intern(content_type_range[0:data_content_type_length].decode('utf_8'))
+
+			# What charset is being used?  That's the next byte
+			data_charset = self.charset(content_type_range[data_content_type_length+1])
+
+			# The rest is the file name, followed by a null byte
+			file_name = content_type_range[data_content_type_length+2:].rstrip(b'\x00').decode('utf_8')
+		elif 0x80 <= content_type_range[0] <= 0xFF:
+			# Look it up in the MIME type table
+			data_content_type = self.mime_type(content_type_range[0])
+
+			# Is there any more data here?  A charset and (maybe) a file name.
+			if len(content_type_range) > 1:
+				# We may need to get more info out of this range, let's add a counter
+				data_content_type_index = 1
+
+				# What charset is being used, if any?
+				# If there's an 0x85, this may mean "start of file name", and may not be the charset
+				# There may sometimes be an 0x81 byte, which means the *next* byte is the charset
+				# This isn't always *before* the file name, sometimes it's after
+				if content_type_range[data_content_type_index] == 0x81:
+					data_charset = self.charset(content_type_range[data_content_type_index+1])
+					data_content_type_index += 2
+				else:
+					data_charset = self.charset(content_type_range[data_content_type_index])
+					data_content_type_index += 1
+
+				# Is there anything, like a file name, left?
+				if len(content_type_range) > data_content_type_index:
 					# The rest is the file name, followed by a null byte
-					file_name = content_type_range[data_content_type_length+2:].rstrip(b'\x00').decode('utf_8')
-				elif 0x80 <= content_type_range[0] <= 0xFF:
-					# Look it up in the MIME type table
-					data_content_type = self.mime_types[content_type_range[0]]
-
-					# Is there any more data here?  A charset and (maybe) a file name.
-					if len(content_type_range) > 1:
-						# We may need to get more info out of this range, let's add a counter
-						data_content_type_index = 1
-
-						# What charset is being used, if any?
-						# If there's an 0x85, this may mean "start of file name", and may not be the charset
-						# There may sometimes be an 0x81 byte, which means the *next* byte is the charset
-						# This isn't always *before* the file name, sometimes it's after
-						if content_type_range[data_content_type_index] == 0x81:
-							data_charset = self.charsets[content_type_range[data_content_type_index+1]]
-							data_content_type_index += 2
-						else:
-							data_charset = self.charsets[content_type_range[data_content_type_index]]
-							data_content_type_index += 1
-
-						# Is there anything, like a file name, left?
-						if len(content_type_range) > data_content_type_index:
-							# The rest is the file name, followed by a null byte
-							# Sometimes there's an 0x85 here.  Not sure why.
-							# Just strip it off, I guess.
-							# Don't use `.rstrip(b'\x00')`, just read to the NULL byte
-							content_type_null = content_type_range.find(b'\x00')
-							if(content_type_null > -1):
-								file_name = content_type_range[data_content_type_index:content_type_null].lstrip(b'\x85').decode('utf_8')
-								data_content_type_index += content_type_null-1
-
-						# So, sometimes the charset is *after* the file name.
-						# If after reading the file name, there are more bytes, then
-						# read them as the charset
-						if len(content_type_range) > data_content_type_index:
-							if content_type_range[data_content_type_index] == 0x81:
-								data_charset = self.charsets[content_type_range[data_content_type_index+1]]
-								data_content_type_index += 2
-							else:
-								data_charset = self.charsets[content_type_range[data_content_type_index]]
-								data_content_type_index += 1
-
-				# Followed by the "Content-ID" (this may not match the one from earlier)
-				# This is just the rest of the remaining bytes before the data
-				# I don't actually know what it is or how to decode it
-				# It seems to contain the "file name", except multiple times for some reason
-				# We've read the "content-type length" (1 byte) and the "content-type"
-				# and the "file name", this is what's left in the data header
-				data_content_id = data_header[data_header_index:]
-
-				# The content type may not actually have the file name in it.
-				# In this case, it's in the content id.
-				# Let's attempt to extract it.
-				if file_name == '' and data_content_id.startswith(b'\xAE\x0F\x81\x86'):
-					# I don't know what these bytes mean, but the file name is after:
-					# 0xAE 0x0F 0x81 0x86
-					# and just read to NULL
-					file_name = data_content_id[4:].rstrip(b'\x00').decode('utf_8')
-
-				# Ok, we're done with the content headers.
-				# We know the length of the data, let's read that many bytes!
-				the_data = self.data[curr_index:curr_index+content_length]
-				curr_index += content_length
-
-				# "Decode" the data, or wrap it in an object
-				if data_content_type.startswith('image/'):
-					# Should we process the image with PIL or not?
-					if use_pil:
-						the_data = Image.open(BytesIO(the_data))
+					# Sometimes there's an 0x85 here.  Not sure why.
+					# Just strip it off, I guess.
+					# Don't use `.rstrip(b'\x00')`, just read to the NULL byte
+					content_type_null = content_type_range.find(b'\x00')
+					if(content_type_null > -1):
+						file_name = content_type_range[data_content_type_index:content_type_null].lstrip(b'\x85').decode('utf_8')
+						data_content_type_index += content_type_null-1
+
+				# So, sometimes the charset is *after* the file name.
+				# If after reading the file name, there are more bytes, then
+				# read them as the charset
+				if len(content_type_range) > data_content_type_index:
+					if content_type_range[data_content_type_index] == 0x81:
+						data_charset = self.charset(content_type_range[data_content_type_index+1])
+						data_content_type_index += 2
 					else:
-						# 5M of RAM before using a temp file on disk
-						tmpFile = tempfile.SpooledTemporaryFile(5242880)
-						tmpFile.write(the_data)
-						tmpFile.seek(0)
-
-						# Store the "file" object in as the data
-						the_data = tmpFile
-				elif data_content_type == 'application/smil':
-					the_data = BeautifulSoup(the_data.decode(data_charset), 'xml')
+						data_charset = self.charset(content_type_range[data_content_type_index])
+						data_content_type_index += 1
+
+		# Followed by the "Content-ID" (this may not match the one from earlier)
+		# This is just the rest of the remaining bytes before the data
+		# I don't actually know what it is or how to decode it
+		# It seems to contain the "file name", except multiple times for some reason
+		# We've read the "content-type length" (1 byte) and the "content-type"
+		# and the "file name", this is what's left in the data header
+		data_content_id = data_header[data_header_index:]
+		part_headers = self.decode_part_headers(data_content_id)
+
+		# The content type may not actually have the file name in it.
+		# In this case, it's in the content id.
+		# Let's attempt to extract it.
+		if file_name == '' and data_content_id.startswith(b'\xAE\x0F\x81\x86'):
+			# I don't know what these bytes mean, but the file name is after:
+			# 0xAE 0x0F 0x81 0x86
+			# and just read to NULL
+			file_name = data_content_id[4:].rstrip(b'\x00').decode('utf_8')
+
+		# Ok, we're done with the content headers.
+		# We know where the data is and how long it is, that's all we need for now.
+		# The part will "decode" itself the first time its data is asked for.
+		part = MMSPart(data, curr_index, content_length,
+			data_content_type, data_charset if not data_content_type.startswith('image/') else '',
+			file_name, use_pil, part_headers.get('Content-ID'), part_headers.get('Content-Location'))
+		curr_index += content_length
+
+		return part, curr_index
+
+	@staticmethod
+	def decode_part_headers(header_data):
+		# The rest of a part's header_data header is a list of (well-known) headers
+		# We want the Content-ID and Content-Location, so the SMIL can find the part
+		# See WAP-230 Section 8.4.2.x
+		part_headers = {}
+		header_index = 0
+
+		while header_index < len(header_data):
+			header = header_data[header_index]
+			header_index += 1
+
+			# Headers with a text name (< 0x80), we don't know how to read
+			if header < 0x80 or header_index >= len(header_data):
+				break
+
+			# How long is the value?  (Same as the MMS headers, but 1F is followed by a uintvar)
+			value_length = header_data[header_index]
+			if value_length <= 0x1E:
+				value_end = header_index + 1 + value_length
+			elif value_length == 0x1F:
+				value_length, value_start = read_uintvar(header_data, header_index + 1)
+				value_end = value_start + value_length
+			elif value_length <= 0x7F:
+				null_byte = header_data.find(b'\x00', header_index)
+				value_end = null_byte + 1 if null_byte > -1 else len(header_data)
+			else:
+				value_end = header_index + 1
+
+			value = header_data[header_index:value_end]
+			header_index = value_end
+
+			# 0xC0: Content-ID, a quoted string, ie: "<image>
+			if header == 0xC0:
+				part_headers['Content-ID'] = value.rstrip(b'\x00').lstrip(b'"').decode('utf_8').strip('<>')
+			# 0x8E: Content-Location
+			elif header == 0x8E:
+				part_headers['Content-Location'] = value.rstrip(b'\x00').decode('utf_8')
+
+		return part_headers
+
+# The decoder has no state, so everyone can share this one
+decoder = MMSDecoder()
+
+class MMSStreamDecoder:
+	"""
+	Push-style (incremental) MMS decoder.
+
+	Feed it the PDU in chunks, as it comes in off of the socket, and it returns
+	each header and part as soon as all of its bytes have arrived.
+	So we can start working with the message before it's done downloading.
+
+	`feed()` and `close()` return a list of events, which are tuples:
+		('header', (name, value)): A single header
+		('headers', headers): All of the headers have been read
+		('part', MMSPart): A part of the message
+	"""
+	def __init__(self, use_pil=True):
+		self.use_pil = use_pil
+		self.buffer = bytearray()
+
+		# Everything we've decoded so far
+		self.headers = MMSHeaders()
+		self.parts = []
+
+		# What are we currently waiting for?
+		# headers, count, parts, text or done
+		self.state = 'headers'
+		self.parts_left = 0
+
+	def feed(self, chunk):
+		profiler.count('stream_bytes', len(chunk))
+		self.buffer += chunk
+		events = []
+
+		# Keep decoding things until we need more data
+		# text/plain messages are just the rest of the data, we'll get those on close()
+		while self.buffer and self.state not in ('text', 'done'):
+			end = self.next_end()
+			if end is None:
+				break
+
+			events.extend(self.next_events(end))
+
+		# There's nothing else to read, don't hold on to any extra bytes
+		if self.state == 'done':
+			self.buffer.clear()
+
+		return events
+
+	def close(self):
+		events = []
+
+		if self.state == 'headers' and not self.buffer:
+			# A message that's all headers
+			events.append(('headers', self.headers))
+			self.state = 'done'
+		elif self.state == 'text':
+			part = MMSPart(memoryview(bytes(self.buffer)), 0, len(self.buffer),
+				self.headers['Content-Type'], 'utf_8', None, self.use_pil)
+			self.parts.append(part)
+			events.append(('part', part))
+			self.state = 'done'
+		elif self.state != 'done':
+			raise ValueError('MMS message ended early ({0} bytes left over)'.format(len(self.buffer)))
+
+		self.buffer.clear()
+		return events
+
+	def read_from(self, stream, chunk_size=8192):
+		# Feed the decoder from a file/urllib.request object and yield the events as they come in
+		# read1() returns whatever has arrived, instead of waiting for all `chunk_size` bytes
+		read = getattr(stream, 'read1', stream.read)
+
+		while True:
+			chunk = read(chunk_size)
+			if not chunk:
+				break
+
+			yield from self.feed(chunk)
+
+		yield from self.close()
+
+	def next_end(self):
+		# How many bytes does the next header/part need?
+		# Returns None if we don't have all of them yet
+		try:
+			if self.state == 'headers':
+				end = self.header_end()
+			elif self.state == 'count':
+				end = 1
+			elif self.state == 'parts':
+				# Data header length, the content length (a uintvar), the data header and then the data
+				content_length, curr_index = read_uintvar(self.buffer, 1)
+				end = curr_index + self.buffer[0] + content_length
+		except IndexError:
+			return None
+
+		return end if end is not None and len(self.buffer) >= end else None
+
+	def header_end(self):
+		curr_byte = self.buffer[0]
+
+		# Is this the end of the headers?
+		# We don't need any more bytes to know that
+		if decoder.header_table[curr_byte] is None or self.headers.content_type is not None:
+			return 0
+
+		# Figure out the length of this header's value, the same way `decode_header` does
+		header_length = self.buffer[1]
+		if 0 <= header_length <= 0x1E:
+			return 2 + header_length
+		elif header_length == 0x1F:
+			byte_count, curr_index = read_uintvar(self.buffer, 2)
+			return curr_index + byte_count
+		elif 0x20 <= header_length <= 0x7F:
+			null_byte = self.buffer.find(0x00, 1)
+			return null_byte + 1 if null_byte > -1 else None
+		else:
+			return 2
+
+	def next_events(self, end):
+		events = []
+
+		# Cut the bytes we need off of the buffer
+		data = bytes(self.buffer[:end])
+		del self.buffer[:end]
+
+		if self.state == 'headers':
+			if end == 0:
+				# That's all the headers, what's next depends on the content type
+				events.append(('headers', self.headers))
+
+				content_type = self.headers.get('Content-Type', '')
+				if content_type == 'text/plain':
+					self.state = 'text'
+				elif content_type.startswith('application/vnd.wap.multipart'):
+					self.state = 'count'
 				else:
-					the_data = the_data.decode(data_charset)
+					self.state = 'done'
+			else:
+				# Let the decoder decode the header, so it's the same as when we have the whole message
+				data = memoryview(data)
+				decoder.decode_header(data, 0, self.headers)
+				header = decoder.header_table[data[0]][0]
 
-				# Append the data to the array of parts
-				mms_data.append({
-					'fileName': file_name,
-					'contentType': data_content_type,
-					'contentLength': content_length,
-					'charset': data_charset if not data_content_type.startswith('image/') else '',
-					'data': the_data
-				})
+				# Headers that were skipped over don't get an event
+				if header in self.headers:
+					events.append(('header', (header, self.headers[header])))
+		elif self.state == 'count':
+			self.parts_left = data[0]
+			self.state = 'parts' if self.parts_left > 0 else 'done'
+		elif self.state == 'parts':
+			part, curr_index = decoder.decode_part(memoryview(data), 0, self.use_pil)
+			self.parts.append(part)
+			events.append(('part', part))
 
-		return mms_headers, mms_data
+			# Each part shares the (growing) list of parts, for the SMIL
+			part.related = self.parts
+
+			self.parts_left -= 1
+			if self.parts_left == 0:
+				self.state = 'done'
+
+		return events
+
+class SMILPresentation:
+	"""
+	The SMIL part of a message says how to show the other parts: the layout
+	(regions) and the "slides" (<par>), each with the image/text/audio to show.
+
+	It's a tiny bit of XML, so instead of building a whole tree (bs4),
+	we just stream through it once and keep what we need.
+
+	Each slide is an object: {'duration': ms (or None), 'media': [...]}
+	And each media is an object: {'type': 'img', 'src': ..., 'region': ..., 'part': MMSPart (or None)}
+	"""
+	media_tags = ('img', 'text', 'audio', 'video', 'ref', 'textstream', 'animation')
+
+	def __init__(self):
+		self.width = None
+		self.height = None
+		self.regions = {}
+		self.slides = []
+
+	@classmethod
+	def parse(cls, smil, parts=()):
+		import xml.etree.ElementTree as ElementTree
+
+		presentation = cls()
+		parser = ElementTree.XMLPullParser(events=('start', 'end'))
+		# The <par>s we're inside of, the last one is the slide media goes on
+		open_slides = []
+
+		try:
+			parser.feed(smil)
+			parser.close()
+		except ElementTree.ParseError:
+			# Keep whatever we got before the bad XML
+			pass
+
+		for event, element in parser.read_events():
+			# Ignore the namespace, if there is one
+			tag = element.tag.rsplit('}', 1)[-1].lower()
+
+			if event == 'end':
+				# A slide is done at its </par>, anything after that isn't on it
+				if tag == 'par' and open_slides:
+					open_slides.pop()
+			elif tag == 'root-layout':
+				presentation.width = element.get('width')
+				presentation.height = element.get('height')
+			elif tag == 'region':
+				presentation.regions[element.get('id')] = {
+					'top': element.get('top'),
+					'left': element.get('left'),
+					'width': element.get('width'),
+					'height': element.get('height'),
+					'fit': element.get('fit')
+				}
+			elif tag == 'par':
+				slide = {'duration': cls.parse_duration(element.get('dur')), 'media': []}
+				presentation.slides.append(slide)
+				open_slides.append(slide)
+			elif tag in cls.media_tags:
+				media = {
+					'type': tag,
+					'src': element.get('src'),
+					'region': element.get('region'),
+					'part': cls.find_part(element.get('src'), parts)
+				}
+
+				# Media outside of a <par> is its own slide
+				if not open_slides:
+					presentation.slides.append({'duration': cls.parse_duration(element.get('dur')), 'media': [media]})
+				else:
+					open_slides[-1]['media'].append(media)
+
+		return presentation
+
+	@staticmethod
+	def parse_duration(duration):
+		# "5000ms" or "5s" (or just "5"), in ms
+		if not duration:
+			return None
+
+		try:
+			if duration.endswith('ms'):
+				return int(float(duration[:-2]))
+			return int(float(duration.rstrip('s')) * 1000)
+		except ValueError:
+			return None
+
+	@staticmethod
+	def find_part(src, parts):
+		# The src is either "cid:<Content-ID>" or the file name/Content-Location
+		if not src:
+			return None
+
+		if src.startswith('cid:'):
+			content_id = src[4:].strip('<>')
+			for part in parts:
+				if part.content_id == content_id:
+					return part
+		else:
+			for part in parts:
+				if src in (part.file_name, part.content_location, part.content_id):
+					return part
+
+		return None
+
+	def __repr__(self):
+		return '<SMILPresentation {0} region(s), {1} slide(s)>'.format(len(self.regions), len(self.slides))
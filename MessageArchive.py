@@ -0,0 +1,257 @@
+"""
+	MMS Message Archive
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+"""
+import json, os, os.path, re, sqlite3
+from datetime import datetime
+
+from PhoneBook import normalize_number
+
+class MessageArchive:
+	"""
+	An index of decoded MMS messages, stored in SQLite.
+
+	Only the headers and the part table (offsets into the original file)
+	are stored, not the parts themselves.  So we can answer questions like
+	"what did X send last March" without decoding anything again.
+
+	Each message is only stored once, by its Message-ID (or Transaction-ID if
+	it doesn't have one).  Other files with the same message in them (ie: one
+	in the cache, and one that was exported) are only remembered in `message_files`.
+
+	It lives in phonebook.db by default, so names can be looked up with a join.
+	"""
+	schema = '''
+		CREATE TABLE IF NOT EXISTS messages(
+			id integer primary key,
+			file text unique not null,
+			file_size integer not null,
+			file_mtime real not null,
+			message_id text,
+			transaction_id text,
+			message_type text,
+			from_num text,
+			date integer,
+			subject text,
+			content_type text
+		);
+		CREATE INDEX IF NOT EXISTS messages_message_id ON messages(message_id);
+		CREATE INDEX IF NOT EXISTS messages_transaction_id ON messages(transaction_id);
+		CREATE INDEX IF NOT EXISTS messages_from_num ON messages(from_num, date);
+		CREATE INDEX IF NOT EXISTS messages_date ON messages(date);
+
+		CREATE TABLE IF NOT EXISTS message_recipients(
+			message integer not null references messages(id) on delete cascade,
+			to_num text not null,
+			field text not null default 'To'
+		);
+		CREATE INDEX IF NOT EXISTS message_recipients_message ON message_recipients(message);
+		CREATE INDEX IF NOT EXISTS message_recipients_to_num ON message_recipients(to_num);
+
+		CREATE TABLE IF NOT EXISTS message_files(
+			file text primary key,
+			file_size integer not null,
+			file_mtime real not null,
+			message integer not null references messages(id) on delete cascade
+		);
+		CREATE INDEX IF NOT EXISTS message_files_message ON message_files(message);
+
+		CREATE TABLE IF NOT EXISTS message_parts(
+			message integer not null references messages(id) on delete cascade,
+			part integer not null,
+			file_name text,
+			content_type text not null,
+			charset text,
+			offset integer not null,
+			length integer not null,
+			primary key(message, part)
+		);
+	'''
+
+	def __init__(self, database='phonebook.db'):
+		self.db_conn = sqlite3.connect(database)
+		self.db_conn.create_function('normalize_number', 1, normalize_number, deterministic=True)
+		self.db_conn.execute('PRAGMA foreign_keys = ON')
+		self.db_conn.executescript(self.schema)
+
+		# Archives from before Cc was stored only have "To" recipients
+		columns = [row[1] for row in self.db_conn.execute('PRAGMA table_info(message_recipients)')]
+		if 'field' not in columns:
+			with self.db_conn:
+				self.db_conn.execute("ALTER TABLE message_recipients ADD COLUMN field text not null default 'To'")
+
+	def __del__(self):
+		self.db_conn.close()
+
+	def address(self, value):
+		# Phone numbers are normalized, so they can be searched for any way they're written
+		# Anything else (ie: an email address) is stored as it is
+		if re.fullmatch(r'\+?[\d\s().-]+', value):
+			return normalize_number(value)
+
+		return value
+
+	def is_current(self, file_name):
+		# Has this file already been added (and not changed since)?
+		try:
+			stat = os.stat(file_name)
+		except OSError:
+			# It's gone (or a broken link), let the decoder report it
+			return False
+
+		sql = self.db_conn.cursor()
+		sql.execute('''SELECT file_size, file_mtime FROM messages WHERE file=:file
+			UNION ALL SELECT file_size, file_mtime FROM message_files WHERE file=:file''', {'file': os.path.abspath(file_name)})
+		row = sql.fetchone()
+
+		return row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime
+
+	def find_message(self, mms_headers, file_name):
+		# The message that's already stored (from another file) with the same Message-ID, or Transaction-ID
+		if mms_headers.get('Message-ID'):
+			sql = self.db_conn.execute('SELECT id FROM messages WHERE message_id=? AND file!=?', (mms_headers['Message-ID'], file_name))
+		elif mms_headers.get('X-Mms-Transaction-Id'):
+			sql = self.db_conn.execute('SELECT id FROM messages WHERE message_id IS NULL AND transaction_id=? AND file!=?',
+				(mms_headers['X-Mms-Transaction-Id'], file_name))
+		else:
+			return None
+
+		row = sql.fetchone()
+		return row[0] if row is not None else None
+
+	def add(self, record):
+		# Add a record from `batch.decode_batch()` (once it's loaded from JSON) to the archive
+		if 'error' in record or not record.get('headers'):
+			return False
+
+		file_name = os.path.abspath(record['file'])
+		try:
+			stat = os.stat(file_name)
+		except OSError:
+			# It was removed after it was decoded
+			return False
+		mms_headers = record['headers']
+
+		date = mms_headers.get('Date')
+		date = int(datetime.fromisoformat(date).timestamp()) if date is not None else None
+
+		with self.db_conn:
+			# Replace what we had for this file (the parts and recipients are deleted with it)
+			self.db_conn.execute('DELETE FROM messages WHERE file=?', (file_name,))
+			self.db_conn.execute('DELETE FROM message_files WHERE file=?', (file_name,))
+
+			# Already have this message?  Then only remember that this file has it too
+			message = self.find_message(mms_headers, file_name)
+			if message is not None:
+				self.db_conn.execute('INSERT INTO message_files(file, file_size, file_mtime, message) VALUES (?,?,?,?)',
+					(file_name, stat.st_size, stat.st_mtime, message))
+				return False
+
+			sql = self.db_conn.execute('''INSERT INTO messages(file, file_size, file_mtime, message_id, transaction_id,
+				message_type, from_num, date, subject, content_type) VALUES (?,?,?,?,?,?,?,?,?,?)''', (
+				file_name, stat.st_size, stat.st_mtime,
+				mms_headers.get('Message-ID'), mms_headers.get('X-Mms-Transaction-Id'), mms_headers.get('X-Mms-Message-Type'),
+				self.address(mms_headers['From']) if mms_headers.get('From') else None,
+				date, mms_headers.get('Subject'), mms_headers.get('Content-Type')
+			))
+			message = sql.lastrowid
+
+			self.db_conn.executemany('INSERT INTO message_recipients(message, to_num, field) VALUES (?,?,?)',
+				[(message, self.address(to_num), field) for field in ('To', 'Cc') for to_num in mms_headers.get(field, [])])
+
+			self.db_conn.executemany('''INSERT INTO message_parts(message, part, file_name, content_type, charset, offset, length)
+				VALUES (?,?,?,?,?,?,?)''', [(message, x, part['fileName'], part['contentType'], part['charset'], part['offset'], part['contentLength'])
+				for x, part in enumerate(record.get('parts', []))])
+
+		return True
+
+	def ingest(self, records):
+		# Add a bunch of records (JSON strings or objects), returns how many new messages were added
+		count = 0
+		for record in records:
+			if isinstance(record, str):
+				record = json.loads(record)
+
+			if self.add(record):
+				count += 1
+
+		return count
+
+	def has_phonebook(self):
+		sql = self.db_conn.cursor()
+		sql.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='phone_numbers'")
+		return sql.fetchone() is not None
+
+	def phonebook_number(self):
+		# The phonebook's numbers, normalized.  PhoneBook keeps an indexed copy of them in normalized_num.
+		columns = [row[1] for row in self.db_conn.execute('PRAGMA table_info(phone_numbers)')]
+		return 'normalized_num' if 'normalized_num' in columns else 'normalize_number(phone_num)'
+
+	def number_filter(self, column, who):
+		# Match either a phone number (or email address), or a name from the phonebook
+		if '@' in who:
+			return '{0} = ?'.format(column), [who]
+		elif any(char.isdigit() for char in who):
+			return '{0} = ?'.format(column), [normalize_number(who)]
+		elif self.has_phonebook():
+			return ("{0} IN (SELECT {1} FROM phone_numbers WHERE first_name || ' ' || last_name LIKE ? AND {1} != '')".format(column, self.phonebook_number()),
+				['%{0}%'.format(who)])
+		else:
+			raise ValueError('Searching by name needs the phone_numbers table')
+
+	def query(self, from_num=None, to_num=None, since=None, until=None, subject=None, limit=None):
+		# Returns a list of message objects, newest first
+		where = []
+		params = []
+
+		if from_num is not None:
+			clause, values = self.number_filter('messages.from_num', from_num)
+			where.append(clause)
+			params += values
+		if to_num is not None:
+			clause, values = self.number_filter('message_recipients.to_num', to_num)
+			where.append('messages.id IN (SELECT message FROM message_recipients WHERE {0})'.format(clause))
+			params += values
+		if since is not None:
+			where.append('messages.date >= ?')
+			params.append(int(since.timestamp()))
+		if until is not None:
+			where.append('messages.date < ?')
+			params.append(int(until.timestamp()))
+		if subject is not None:
+			where.append('messages.subject LIKE ?')
+			params.append('%{0}%'.format(subject))
+
+		sql = 'SELECT id, file, message_id, from_num, date, subject, content_type FROM messages'
+		if where:
+			sql += ' WHERE ' + ' AND '.join(where)
+		sql += ' ORDER BY date DESC'
+		if limit is not None:
+			sql += ' LIMIT {0:d}'.format(limit)
+
+		messages = {}
+		for row in self.db_conn.execute(sql, params):
+			messages[row[0]] = {
+				'id': row[0],
+				'file': row[1],
+				'Message-ID': row[2],
+				'From': row[3],
+				'Date': datetime.fromtimestamp(row[4]) if row[4] is not None else None,
+				'Subject': row[5],
+				'Content-Type': row[6],
+				'To': [],
+				'Cc': [],
+				'parts': []
+			}
+
+		# Get the recipients and parts of all of the messages in two queries, not two per message
+		ids = json.dumps(list(messages))
+		for message, to_num, field in self.db_conn.execute('''SELECT message, to_num, field FROM message_recipients
+			WHERE message IN (SELECT value FROM json_each(?)) ORDER BY rowid''', (ids,)):
+			messages[message][field].append(to_num)
+		for message, file_name, content_type, offset, length in self.db_conn.execute('''SELECT message, file_name, content_type, offset, length
+			FROM message_parts WHERE message IN (SELECT value FROM json_each(?)) ORDER BY message, part''', (ids,)):
+			messages[message]['parts'].append({'fileName': file_name, 'contentType': content_type, 'offset': offset, 'contentLength': length})
+
+		return list(messages.values())
@@ -0,0 +1,245 @@
+"""
+	MMS PDU Cache
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+"""
+import contextlib, glob, hashlib, json, os, os.path, sqlite3, tempfile, threading, time
+
+class PDUCache:
+	"""
+	An on-disk cache of downloaded MMS messages, so we don't need to
+	download the same message from the carrier more than once.
+
+	The raw PDUs are stored by their SHA-256 hash (objects/ab/abcdef...),
+	so the same message is only stored once.  `index.db` (SQLite) maps each
+	(phone number, MMS ID) to its hash, along with when it was last used.
+	SQLite does the locking, so main.py, watch.py and service.py can all
+	use the same cache at once.
+
+	Once the cache is bigger than `max_size` bytes, the least recently used
+	messages are removed.  Everything is written to a temp file first and
+	then renamed, so a crash never leaves a half-written file in the cache.
+	"""
+	schema = '''
+		CREATE TABLE IF NOT EXISTS pdus(
+			key text primary key,
+			hash text not null,
+			size integer not null,
+			used real not null
+		);
+		CREATE INDEX IF NOT EXISTS pdus_hash ON pdus(hash);
+		CREATE INDEX IF NOT EXISTS pdus_used ON pdus(used);
+	'''
+
+	# Temp files older than this are from a download that never finished
+	stale_age = 60*60
+
+	def __init__(self, cache_dir='mms_cache', max_size=512*1024*1024):
+		self.cache_dir = cache_dir
+		self.max_size = max_size
+		self.lock = threading.Lock()
+
+		os.makedirs(os.path.join(self.cache_dir, 'objects'), exist_ok=True)
+
+		# Transactions are started by hand (see `transaction()`), and the connection is shared by our threads
+		self.db_conn = sqlite3.connect(os.path.join(self.cache_dir, 'index.db'), timeout=30,
+			isolation_level=None, check_same_thread=False)
+		self.db_conn.executescript(self.schema)
+
+		self.import_index()
+		self.remove_stale()
+
+	def __del__(self):
+		self.db_conn.close()
+
+	@contextlib.contextmanager
+	def transaction(self):
+		# Take SQLite's write lock for the whole thing, so other processes wait for us
+		with self.lock:
+			self.db_conn.execute('BEGIN IMMEDIATE')
+			try:
+				yield self.db_conn
+			except BaseException:
+				self.db_conn.execute('ROLLBACK')
+				raise
+			self.db_conn.execute('COMMIT')
+
+	def import_index(self):
+		# Caches from before index.db kept their index in index.json
+		index_file = os.path.join(self.cache_dir, 'index.json')
+		try:
+			with open(index_file, 'r') as index:
+				entries = json.load(index)
+		except (OSError, ValueError):
+			return
+
+		with self.transaction() as db_conn:
+			db_conn.executemany('INSERT OR IGNORE INTO pdus(key, hash, size, used) VALUES (?,?,?,?)',
+				[(key, entry['hash'], entry['size'], entry['used']) for key, entry in entries.items()])
+
+		os.unlink(index_file)
+
+	def remove_stale(self):
+		# Clean up after downloads (and index writes) that were interrupted
+		now = time.time()
+		for tmp_name in glob.glob(os.path.join(glob.escape(self.cache_dir), '**', '.tmp-*'), recursive=True):
+			try:
+				if now - os.path.getmtime(tmp_name) > self.stale_age:
+					os.unlink(tmp_name)
+			except OSError:
+				# Someone else got to it first
+				pass
+
+	def key(self, phone_num, mms_id):
+		return '{0}/{1}'.format(phone_num, mms_id)
+
+	def object_path(self, hash):
+		return os.path.join(self.cache_dir, 'objects', hash[:2], hash)
+
+	def get(self, phone_num, mms_id):
+		# Returns the path to the cached PDU, or None if it's not cached
+		key = self.key(phone_num, mms_id)
+
+		with self.transaction() as db_conn:
+			row = db_conn.execute('SELECT hash FROM pdus WHERE key=?', (key,)).fetchone()
+			if row is None:
+				return None
+
+			path = self.object_path(row[0])
+			if not os.path.isfile(path):
+				# Someone deleted it from under us
+				db_conn.execute('DELETE FROM pdus WHERE key=?', (key,))
+				return None
+
+			# Only this entry changes, not the whole index
+			db_conn.execute('UPDATE pdus SET used=? WHERE key=?', (time.time(), key))
+
+			return path
+
+	def open(self, phone_num, mms_id):
+		path = self.get(phone_num, mms_id)
+		return open(path, 'rb') if path is not None else None
+
+	def put(self, phone_num, mms_id, data):
+		writer = self.writer(phone_num, mms_id)
+		writer.write(data)
+		return writer.commit()
+
+	def writer(self, phone_num, mms_id):
+		# For saving a PDU while it's being downloaded
+		return PDUCacheWriter(self, phone_num, mms_id)
+
+	def add(self, phone_num, mms_id, tmp_name, hash, size):
+		# Move a finished temp file into the cache
+		# This is done holding the write lock, so another process can't evict it halfway through
+		with self.transaction() as db_conn:
+			path = self.object_path(hash)
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+
+			if os.path.isfile(path):
+				# We already have this exact message
+				os.unlink(tmp_name)
+			else:
+				os.replace(tmp_name, path)
+
+			db_conn.execute('INSERT OR REPLACE INTO pdus(key, hash, size, used) VALUES (?,?,?,?)',
+				(self.key(phone_num, mms_id), hash, size, time.time()))
+			self.evict(db_conn)
+
+			return path
+
+	def evict(self, db_conn):
+		# Remove the least recently used messages until we fit in `max_size`
+		# Each hash is only counted (and stored) once
+		total_size, = db_conn.execute('SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM pdus GROUP BY hash)').fetchone()
+		if total_size <= self.max_size:
+			return
+
+		for key, hash, size in db_conn.execute('SELECT key, hash, size FROM pdus ORDER BY used').fetchall():
+			if total_size <= self.max_size:
+				break
+
+			db_conn.execute('DELETE FROM pdus WHERE key=?', (key,))
+
+			# Only delete the file if nothing else is using it
+			if db_conn.execute('SELECT 1 FROM pdus WHERE hash=? LIMIT 1', (hash,)).fetchone() is None:
+				try:
+					os.unlink(self.object_path(hash))
+				except FileNotFoundError:
+					pass
+				total_size -= size
+
+class PDUCacheWriter:
+	"""
+	Writes a PDU into the cache a chunk at a time, hashing it as it goes.
+	Nothing shows up in the cache until `commit()` is called.
+	"""
+	def __init__(self, cache, phone_num, mms_id):
+		self.cache = cache
+		self.phone_num = phone_num
+		self.mms_id = mms_id
+
+		self.hash = hashlib.sha256()
+		self.size = 0
+
+		fd, self.tmp_name = tempfile.mkstemp(dir=os.path.join(cache.cache_dir, 'objects'), prefix='.tmp-')
+		self.tmp_file = os.fdopen(fd, 'wb')
+
+	def write(self, data):
+		self.hash.update(data)
+		self.size += len(data)
+		self.tmp_file.write(data)
+
+	def commit(self):
+		self.tmp_file.close()
+		return self.cache.add(self.phone_num, self.mms_id, self.tmp_name, self.hash.hexdigest(), self.size)
+
+	def abort(self):
+		self.tmp_file.close()
+		try:
+			os.unlink(self.tmp_name)
+		except FileNotFoundError:
+			pass
+
+class CachingStream:
+	"""
+	Wraps the urllib.request object, so that whatever is read from it
+	is also saved into the cache.  The message is only added to the cache
+	once it's been read all the way to the end.
+	"""
+	def __init__(self, stream, writer):
+		self.stream = stream
+		self.writer = writer
+
+	def tee(self, data, at_end):
+		if self.writer is not None:
+			if data:
+				self.writer.write(data)
+
+			# We hit the end, save it!
+			if at_end:
+				self.writer.commit()
+				self.writer = None
+
+		return data
+
+	def read(self, size=-1):
+		# Nothing left means the end, and so does reading without a size (that reads everything)
+		data = self.stream.read(size)
+		return self.tee(data, not data or size is None or size < 0)
+
+	def read1(self, size=-1):
+		# read1() only returns what's already there (even with no size), so only nothing left is the end
+		data = self.stream.read1(size)
+		return self.tee(data, not data)
+
+	def getheader(self, name, default=None):
+		return self.stream.getheader(name, default)
+
+	def close(self):
+		# Closed before we read it all?  Then don't cache it.
+		if self.writer is not None:
+			self.writer.abort()
+			self.writer = None
+
+		self.stream.close()
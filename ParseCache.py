@@ -0,0 +1,180 @@
+"""
+	MMS Parse Cache
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+"""
+import hashlib, marshal, os, os.path, sqlite3, sys, time
+from datetime import datetime
+
+from MMSMessage import MMSHeaders, MMSMessage, MMSPart, MessageClass, MessagePriority, MessageType, MMSVersion
+from Profiler import profiler
+
+class ParseCache:
+	"""
+	Remembers what `MMSMessage.decode()` found in a file: the headers and the
+	part table (where each part is, and its type, charset and file name).
+	Opening the same file again then doesn't parse anything, the parts are
+	just sliced out of the data when they are used.
+
+	Entries are keyed by the file's path, size and mtime.  With `by_content`
+	they are also keyed by a hash of the file, so copied or moved files are found too
+	(but that means reading the whole file to hash it).
+
+	Everything is stored in SQLite, packed with marshal.  Entries from a different
+	version of the decoder are ignored (and removed), see `version()`.  So are
+	entries that haven't been used in `max_age` seconds, and the oldest ones past
+	`max_entries`.
+	"""
+	schema = '''
+		CREATE TABLE IF NOT EXISTS parses(
+			key text primary key,
+			version text not null,
+			headers blob not null,
+			parts blob not null,
+			used real not null
+		);
+		CREATE INDEX IF NOT EXISTS parses_used ON parses(used);
+	'''
+
+	max_age = 30*24*60*60
+	max_entries = 100000
+
+	# How many new entries between each `prune()`
+	prune_every = 1000
+
+	# The headers that are enums, and how to turn them back into one
+	header_enums = {
+		'message_type': MessageType,
+		'version': MMSVersion,
+		'message_class': MessageClass,
+		'priority': MessagePriority
+	}
+
+	def __init__(self, database='parse_cache.db', by_content=False):
+		self.by_content = by_content
+		self.version = self.decoder_version()
+		self.added = 0
+
+		self.db_conn = sqlite3.connect(database)
+		self.db_conn.executescript(self.schema)
+
+		# The decoder changed, so these are no good anymore
+		with self.db_conn:
+			self.db_conn.execute('DELETE FROM parses WHERE version != ?', (self.version,))
+
+		self.prune()
+
+	def __del__(self):
+		self.db_conn.close()
+
+	@staticmethod
+	def decoder_version():
+		# `MMSMessage.decoder_version`, plus a hash of the decoder's source and the header slots
+		# So a change to the decoder can't be missed, even if nobody remembers to bump it
+		source = hashlib.sha256(repr(MMSHeaders.__slots__).encode('utf_8'))
+		with open(sys.modules[MMSMessage.__module__].__file__, 'rb') as source_file:
+			source.update(source_file.read())
+
+		return '{0}:{1}'.format(MMSMessage.decoder_version, source.hexdigest()[:16])
+
+	def keys(self, file_name, data):
+		stat = os.stat(file_name)
+		keys = ['stat:{0}:{1}:{2}'.format(os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)]
+
+		if self.by_content:
+			keys.append('sha256:' + hashlib.sha256(data).hexdigest())
+
+		return keys
+
+	def pack(self, mms_headers, mms_parts):
+		# Keyed by the slot's name, so it doesn't matter what order they're in
+		headers = {}
+		for slot in MMSHeaders.__slots__:
+			value = getattr(mms_headers, slot, None)
+			if value is None:
+				continue
+			if isinstance(value, datetime):
+				value = value.timestamp()
+			elif slot in self.header_enums:
+				value = int(value)
+			headers[slot] = value
+
+		parts = [(part.offset, part.content_length, part.content_type, part.charset, part.file_name,
+			part.content_id, part.content_location) for part in mms_parts]
+
+		return marshal.dumps(headers), marshal.dumps(parts)
+
+	def unpack(self, headers, parts, data, use_pil=True):
+		values = {}
+		for slot, value in marshal.loads(headers).items():
+			if slot == 'date':
+				value = datetime.fromtimestamp(value)
+			elif slot in self.header_enums:
+				value = self.header_enums[slot](value)
+			values[slot] = value
+
+		# The parts are slices of the data, just like `decode()` makes
+		source = memoryview(data).cast('B')
+		mms_parts = [MMSPart(source, offset, length, content_type, charset, file_name, use_pil, content_id, content_location)
+			for offset, length, content_type, charset, file_name, content_id, content_location in marshal.loads(parts)]
+
+		for part in mms_parts:
+			part.related = mms_parts
+
+		return MMSHeaders(**values), mms_parts
+
+	def get(self, keys, data, use_pil=True):
+		sql = self.db_conn.cursor()
+		for key in keys:
+			sql.execute('SELECT headers, parts FROM parses WHERE key=? AND version=?', (key, self.version))
+			row = sql.fetchone()
+			if row is not None:
+				with self.db_conn:
+					self.db_conn.execute('UPDATE parses SET used=? WHERE key=?', (time.time(), key))
+
+				return self.unpack(row[0], row[1], data, use_pil)
+
+		return None
+
+	def put(self, keys, mms_headers, mms_parts):
+		headers, parts = self.pack(mms_headers, mms_parts)
+
+		with self.db_conn:
+			self.db_conn.executemany('INSERT OR REPLACE INTO parses(key, version, headers, parts, used) VALUES (?,?,?,?,?)',
+				[(key, self.version, headers, parts, time.time()) for key in keys])
+
+		# Don't let it grow forever
+		self.added += 1
+		if self.added % self.prune_every == 0:
+			self.prune()
+
+	def decode(self, file_name, data, use_pil=True):
+		"""
+		Like `MMSMessage(data).decode(use_pil, lazy=True)`, but only if we haven't
+		seen `file_name` before.  `data` is its contents (bytes or an mmap).
+		"""
+		keys = self.keys(file_name, data)
+
+		with profiler.timer('parse_cache.get'):
+			cached = self.get(keys, data, use_pil)
+
+		if cached is not None:
+			profiler.count('parse_cache.hits')
+			return cached
+
+		profiler.count('parse_cache.misses')
+
+		mms_headers, mms_parts = MMSMessage(data).decode(use_pil, lazy=True)
+		self.put(keys, mms_headers, mms_parts)
+
+		return mms_headers, mms_parts
+
+	def prune(self, max_age=None, max_entries=None):
+		# Remove entries that haven't been used in a while, and the oldest ones if there are too many
+		# The key changes when a file does, so old entries pile up otherwise
+		max_age = max_age if max_age is not None else self.max_age
+		max_entries = max_entries if max_entries is not None else self.max_entries
+
+		with self.db_conn:
+			self.db_conn.execute('DELETE FROM parses WHERE used < ?', (time.time() - max_age,))
+			self.db_conn.execute('DELETE FROM parses WHERE key IN (SELECT key FROM parses ORDER BY used DESC LIMIT -1 OFFSET ?)', (max_entries,))
@@ -1,22 +1,150 @@
-import sqlite3
+import json, re, sqlite3
+from collections import OrderedDict
+
+from Profiler import profiler
+
+def normalize_number(number):
+    # Phone numbers can show up as +15551234567, 15551234567 or 5551234567
+    # Turn them all into the same 11 digit number (what's stored in phone_num)
+    digits = re.sub(r'\D', '', number or '')
+
+    if len(digits) == 10:
+        digits = '1' + digits
+
+    return digits
 
 class PhoneBook:
-    def __init__(self, database='phonebook.db'):
+    # Numbers looked up (or not found) are remembered, up to this many
+    cache_size = 1024
+
+    def __init__(self, database='phonebook.db', cache_size=None, preload=False):
         self.db_conn = sqlite3.connect(database)
+        self.db_conn.create_function('normalize_number', 1, normalize_number, deterministic=True)
+
+        self.cache = OrderedDict()
+        self.preloaded = False
+        if cache_size is not None:
+            self.cache_size = cache_size
+
+        self.normalized = self.add_normalized_column()
+
+        # Load the whole phonebook up front, for big batches
+        if preload:
+            self.preload()
 
     def __del__(self):
         self.db_conn.close()
 
+    def columns(self):
+        # The columns of phone_numbers, or an empty list if there's no such table
+        return [row[1] for row in self.db_conn.execute('PRAGMA table_info(phone_numbers)')]
+
+    def add_normalized_column(self):
+        # Keep an indexed copy of each number in its normalized form
+        # The database is only written to the first time, or when rows were added since then
+        columns = self.columns()
+        self.has_table = bool(columns)
+        if not self.has_table:
+            return False
+
+        if 'normalized_num' in columns:
+            index = self.db_conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'phone_numbers_normalized_num'").fetchone()
+            pending = self.db_conn.execute('SELECT 1 FROM phone_numbers WHERE normalized_num IS NULL LIMIT 1').fetchone()
+            if index is not None and pending is None:
+                return True
+
+        try:
+            # Lock the database first, so when a bunch of (batch worker) processes open it at once,
+            # one of them migrates it and the others wait for it and then see it's done
+            self.db_conn.execute('BEGIN IMMEDIATE')
+
+            if 'normalized_num' not in self.columns():
+                self.db_conn.execute('ALTER TABLE phone_numbers ADD COLUMN normalized_num text')
+
+            self.db_conn.execute('UPDATE phone_numbers SET normalized_num = normalize_number(phone_num) WHERE normalized_num IS NULL')
+            self.db_conn.execute('CREATE INDEX IF NOT EXISTS phone_numbers_normalized_num ON phone_numbers(normalized_num)')
+            self.db_conn.commit()
+        except sqlite3.OperationalError:
+            # Read-only (or locked) database, we'll have to normalize in the query
+            if self.db_conn.in_transaction:
+                self.db_conn.rollback()
+            return False
+
+        return True
+
+    def preload(self):
+        # No limit on the cache, since we have everything
+        self.cache_size = None
+
+        if self.has_table:
+            sql = self.db_conn.cursor()
+            for phone_num, first_name, last_name in sql.execute('SELECT phone_num, first_name, last_name FROM phone_numbers'):
+                number = normalize_number(phone_num)
+                if number:
+                    self.cache[number] = (first_name, last_name)
+
+        self.preloaded = True
+
+    def remember(self, number, name):
+        self.cache[number] = name
+        self.cache.move_to_end(number)
+
+        if self.cache_size is not None and len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def lookup(self, numbers):
+        # Look up normalized numbers, returns an object of the ones that were found
+        names = {}
+        missing = []
+
+        for number in numbers:
+            if not number:
+                # Not a phone number (ie: an email address), don't match it against anything
+                continue
+            elif number in self.cache:
+                self.cache.move_to_end(number)
+                if self.cache[number] is not None:
+                    names[number] = self.cache[number]
+            elif not self.preloaded and self.has_table:
+                missing.append(number)
+
+        profiler.count('phonebook.cache_hits', len(numbers) - len(missing))
+        profiler.count('phonebook.cache_misses', len(missing))
+
+        if missing:
+            # Look up everything we're missing in one query
+            # The numbers are passed as one JSON array, so there's no limit on how many there are
+            column = 'normalized_num' if self.normalized else 'normalize_number(phone_num)'
+
+            with profiler.timer('phonebook.query'):
+                sql = self.db_conn.cursor()
+                result = sql.execute('SELECT {0}, first_name, last_name FROM phone_numbers WHERE {0} IN (SELECT value FROM json_each(?))'.format(column), (json.dumps(missing),))
+
+                found = {row[0]: (row[1], row[2]) for row in result}
+            for number in missing:
+                self.remember(number, found.get(number))
+
+            names.update(found)
+
+        return names
+
     def get_name(self, number):
-        sql = self.db_conn.cursor()
-        sql.execute('SELECT first_name, last_name FROM phone_numbers WHERE phone_num=?', (number,))
-        return sql.fetchone()
+        return self.get_names([number]).get(number)
 
     def get_names(self, numbers):
-        sql = self.db_conn.cursor()
-        
-        values = ','.join(['?'] * len(numbers))
-        result = sql.execute('SELECT phone_num, first_name, last_name FROM phone_numbers WHERE phone_num IN ({0})'.format(values), numbers)
+        normalized = {number: normalize_number(number) for number in numbers}
+        names = self.lookup(set(normalized.values()))
+
+        # Convert this to an object of tuples, keyed by the number we were given
+        return {number: names[normal] for number, normal in normalized.items() if normal in names}
+
+    def resolve(self, messages):
+        # Look up the sender and recipients of a whole batch of messages (their headers) at once
+        numbers = set()
+        for mms_headers in messages:
+            if mms_headers.get('From'):
+                numbers.add(mms_headers['From'])
+            numbers.update(mms_headers.get('To', []))
+            numbers.update(mms_headers.get('Cc', []))
 
-        # Convert this to an object of tuples
-        return {row[0]:(row[1],row[2]) for row in result}
+        return self.get_names(numbers)
@@ -0,0 +1,102 @@
+"""
+	MMS Viewer Profiler
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+"""
+import threading, time
+
+class NullTimer:
+	# What `Profiler.timer()` returns when profiling is off, it does nothing
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		return False
+
+null_timer = NullTimer()
+
+class Timer:
+	def __init__(self, profiler, name):
+		self.profiler = profiler
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc_info):
+		self.profiler.record(self.name, time.perf_counter() - self.start)
+		return False
+
+class Profiler:
+	"""
+	Timers and counters for finding out where the time goes
+	(download, header parsing, part parsing, image decoding, SMIL, phonebook, writing files).
+
+	It's off by default.  When it's off `timer()` hands back a shared object that
+	does nothing and `count()` returns right away, so it costs (almost) nothing.
+
+	Hooks are called with (kind, name, value) for every timing/count,
+	where kind is 'timer' or 'counter'.  Use them to send the numbers somewhere else.
+	"""
+	def __init__(self):
+		self.enabled = False
+		self.lock = threading.Lock()
+		self.hooks = []
+		self.reset()
+
+	def enable(self):
+		self.enabled = True
+
+	def disable(self):
+		self.enabled = False
+
+	def reset(self):
+		with self.lock:
+			# name => [calls, total seconds, max seconds]
+			self.timers = {}
+			# name => total
+			self.counters = {}
+			self.started = time.perf_counter()
+
+	def add_hook(self, hook):
+		self.hooks.append(hook)
+
+	def remove_hook(self, hook):
+		self.hooks.remove(hook)
+
+	def timer(self, name):
+		# Use as: with profiler.timer('decode.headers'): ...
+		return Timer(self, name) if self.enabled else null_timer
+
+	def record(self, name, seconds):
+		with self.lock:
+			timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+			timer[0] += 1
+			timer[1] += seconds
+			timer[2] = max(timer[2], seconds)
+
+		for hook in self.hooks:
+			hook('timer', name, seconds)
+
+	def count(self, name, value=1):
+		if not self.enabled:
+			return
+
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + value
+
+		for hook in self.hooks:
+			hook('counter', name, value)
+
+	def report(self):
+		with self.lock:
+			return {
+				'elapsed': time.perf_counter() - self.started,
+				'timers': {name: {'calls': calls, 'total': total, 'max': longest, 'mean': total / calls}
+					for name, (calls, total, longest) in sorted(self.timers.items())},
+				'counters': dict(sorted(self.counters.items()))
+			}
+
+# Everything shares this one
+profiler = Profiler()
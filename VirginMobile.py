@@ -3,7 +3,12 @@
 	By: Eric Siegel
 	https://github.com/NTICompass/mms-viewer
 """
-import urllib.request
+import base64, http.client, itertools, os, threading, time, urllib.error, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from EndpointTable import EndpointTable
+from PDUCache import CachingStream
+from Profiler import profiler
 
 class VirginMobile:
 	"""
@@ -15,6 +20,9 @@ class VirginMobile:
 
 	This is an object of tuples.  1st is the server, 2nd is the query parameter
 	The key is the string length of the ID
+
+	These are only where we start, `EndpointTable` learns which server
+	really has which IDs, and skips the ones that aren't working
 	"""
 	mms_servers = {
 		17: ('rstnmmsc.vmobl.com', 'ammsc'),
@@ -22,6 +30,11 @@ class VirginMobile:
 	}
 	mms_port = '8088' # This is the default port for all servers
 
+	# Tried last, for IDs the others don't have (or lengths we don't know)
+	mms_fallback = [
+		('mmsc.vmobl.com', 'mms/')
+	]
+
 	"""
 	If needed, we can send our request through a proxy
 
@@ -34,34 +47,288 @@ class VirginMobile:
 	mms_proxy_auth = ('Sprint', '*')
 
 	# Create a new object with your phone number to download MMS messages
-	def __init__(self, phone_num):
+	# Pass a PDUCache to keep a copy of everything that's downloaded
+	# In offline mode, only the cache is used
+	# The servers and port can be changed, ie: to use a local MMSCServer for testing
+	# Pass an EndpointTable to share what's been learned about the servers with other objects
+	def __init__(self, phone_num, cache=None, offline=False, mms_servers=None, mms_port=None, mms_fallback=None, endpoints=None):
 		self.phone_num = phone_num
+		self.cache = cache
+		self.offline = offline
+
+		if mms_servers is not None:
+			self.mms_servers = mms_servers
+			# Don't go to the real servers when we were given other ones
+			self.mms_fallback = []
+		if mms_fallback is not None:
+			self.mms_fallback = mms_fallback
+		if mms_port is not None:
+			self.mms_port = str(mms_port)
+
+		self.endpoints = endpoints if endpoints is not None else self.endpoint_table()
+
+	def endpoint_table(self):
+		# Remember which server had which IDs next to the cache, if there is one
+		state_file = os.path.join(self.cache.cache_dir, 'endpoints.json') if self.cache is not None else None
+
+		servers = list(dict.fromkeys(list(self.mms_servers.values()) + list(self.mms_fallback)))
+		preferred = {length: server for length, (server, query) in self.mms_servers.items()}
+
+		return EndpointTable(servers, self.mms_port, preferred, state_file)
 
 	# Pass the MMS ID (I get it from Signal's logs) to download it from the server
 	def download(self, mms_id, proxy=True):
-		# Create the opener, it'll need to send the `X-MDN` header and may need to use a proxy
-		if proxy:
-			# TODO: Loop and try each proxy
-			proxy_auth = ':'.join(self.mms_proxy_auth)
-			proxy_server = ':'.join(self.mms_proxy[0])
-
-			proxy = urllib.request.ProxyHandler({'http': "http://{0}@{1}".format(proxy_auth, proxy_server)})
-			opener = urllib.request.build_opener(proxy)
-		else:
-			opener = urllib.request.build_opener()
+		# Did we already download this one?
+		if self.cache is not None:
+			cached = self.cache.open(self.phone_num, mms_id)
+			if cached is not None:
+				profiler.count('cache.hits')
+				print('MMS Loaded {0} bytes from cache'.format(os.fstat(cached.fileno()).st_size))
+				return cached
+
+			profiler.count('cache.misses')
+
+		if self.offline:
+			print('MMS Download ({0}) Failed: Not in cache (offline)'.format(mms_id))
+			return None
+
+		# Try each server that might have it, best first
+		proxies = self.mms_proxy if proxy else [None]
+		for endpoint in self.endpoints.candidates(mms_id):
+			# Skip servers that keep failing
+			if not self.endpoints.begin(endpoint):
+				continue
+
+			try:
+				server = endpoint.server
+
+				# Try each proxy in turn, until one of them works
+				for mms_proxy in proxies:
+					# Create the opener, it'll need to send the `X-MDN` header and may need to use a proxy
+					# Don't install it globally, it's only for this download
+					if mms_proxy is not None:
+						proxy_auth = ':'.join(self.mms_proxy_auth)
+						proxy_server = ':'.join(mms_proxy)
+
+						proxy_handler = urllib.request.ProxyHandler({'http': "http://{0}@{1}".format(proxy_auth, proxy_server)})
+						opener = urllib.request.build_opener(proxy_handler)
+					else:
+						opener = urllib.request.build_opener()
+
+					opener.addheaders = [('X-MDN', self.phone_num)]
+
+					start = time.perf_counter()
+					try:
+						# This is just until we get the response headers, the body is read by the caller
+						with profiler.timer('download.connect'):
+							mms_download = opener.open("http://{0}:{1}/{2}?{3}".format(server, endpoint.port, endpoint.query, mms_id),
+								timeout=self.endpoints.timeout(endpoint))
+					except urllib.error.HTTPError as error:
+						# The server answered, another proxy won't help
+						print('MMS Download ({0}) Failed: {1} {2}'.format(server, error.code, error.reason))
+
+						if error.code >= 500:
+							self.endpoints.failure(endpoint)
+							break
+
+						self.endpoints.not_found(endpoint, time.perf_counter() - start)
+
+						# Another server might have it
+						if error.code == 404:
+							break
+
+						return None
+					except (urllib.error.URLError, OSError) as error:
+						print('MMS Download ({0}) Failed: {1}'.format(server, getattr(error, 'reason', error)))
+					else:
+						self.endpoints.success(endpoint, mms_id, time.perf_counter() - start)
+						print('MMS Downloaded {0} bytes from {1}'.format(mms_download.getheader('Content-Length'), server))
+
+						# Save it into the cache as it's read
+						if self.cache is not None:
+							return CachingStream(mms_download, self.cache.writer(self.phone_num, mms_id))
+
+						return mms_download
+				else:
+					# We couldn't get to it at all
+					self.endpoints.failure(endpoint)
+			finally:
+				# However it went, the trial request (if this was one) is over
+				self.endpoints.end(endpoint)
+
+		return None
+
+	# Download a bunch of MMS IDs at once
+	# Returns an object of the MMS data (bytes), keyed by ID.  Failed downloads are None.
+	def download_many(self, mms_ids, proxy=True, workers=8, per_host=4, retries=3, backoff=0.5, timeout=10):
+		pool = ConnectionPool(per_host, timeout)
+		proxies = self.mms_proxy if proxy else [None]
+
+		# Each download starts on the "next" proxy, so they are spread out over all of them
+		proxy_start = itertools.count()
+
+		def fetch(mms_id):
+			# Did we already download this one?
+			if self.cache is not None:
+				cached = self.cache.open(self.phone_num, mms_id)
+				if cached is not None:
+					profiler.count('cache.hits')
+					with cached:
+						return cached.read()
+
+				profiler.count('cache.misses')
+
+			if self.offline:
+				print('MMS Download ({0}) Failed: Not in cache (offline)'.format(mms_id))
+				return None
 
-		opener.addheaders = [('X-MDN', self.phone_num)]
-		urllib.request.install_opener(opener)
+			start = next(proxy_start)
+			for attempt in range(retries + 1):
+				# Fail over to the next proxy on each retry
+				mms_proxy = proxies[(start + attempt) % len(proxies)]
+				retry = False
 
-		# Which server do we use?  It seems to be based off of the length of the ID
-		server, query = self.mms_servers[len(mms_id)]
+				# Try each server that might have it, best first
+				for endpoint in self.endpoints.candidates(mms_id):
+					# Skip servers that keep failing
+					if not self.endpoints.begin(endpoint):
+						continue
+
+					try:
+						server = endpoint.server
+						try:
+							with profiler.timer('download'):
+								status, reason, mms_data, latency = pool.request(server, endpoint.port, endpoint.query, mms_id, self.phone_num,
+									mms_proxy, self.mms_proxy_auth, self.endpoints.timeout(endpoint, timeout))
+							profiler.count('download_bytes', len(mms_data))
+						except (http.client.HTTPException, OSError) as error:
+							print('MMS Download ({0}) Failed: {1}'.format(server, error))
+							self.endpoints.failure(endpoint)
+							retry = True
+							continue
+
+						if status == 200:
+							self.endpoints.success(endpoint, mms_id, latency)
+
+							if self.cache is not None:
+								self.cache.put(self.phone_num, mms_id, mms_data)
+
+							return mms_data
+
+						print('MMS Download ({0}) Failed: {1} {2}'.format(server, status, reason))
+
+						if status >= 500:
+							self.endpoints.failure(endpoint)
+							retry = True
+						else:
+							self.endpoints.not_found(endpoint, latency)
+
+							# Another server might have it, but anything other than a 404 means no
+							if status != 404:
+								return None
+					finally:
+						# However it went, the trial request (if this was one) is over
+						self.endpoints.end(endpoint)
+
+				# Only server errors (and timeouts) are worth trying again
+				if not retry:
+					return None
+
+				# Wait a little longer each time
+				if attempt < retries:
+					time.sleep(backoff * (2 ** attempt))
+
+			return None
+
+		mms_ids = list(mms_ids)
 		try:
-			mms_download = urllib.request.urlopen("http://{0}:{1}/{2}?{3}".format(server, self.mms_port, query, mms_id), timeout=10)
-		except urllib.error.URLError as error:
-			print('MMS Download ({0}) Failed: {1} {2}'.format(server, error.code, error.reason))
-			mms_data_stream = None
+			with ThreadPoolExecutor(max_workers=workers) as executor:
+				return dict(zip(mms_ids, executor.map(fetch, mms_ids)))
+		finally:
+			pool.close()
+
+class ConnectionPool:
+	"""
+	Keep-alive HTTP connections for `VirginMobile.download_many()`.
+
+	Idle connections are kept per (host, port, proxy), so each download
+	doesn't need to connect again.  Each MMSC server also gets a semaphore,
+	which limits how many requests are sent to it at once.
+	"""
+	def __init__(self, per_host=4, timeout=10):
+		self.per_host = per_host
+		self.timeout = timeout
+
+		self.lock = threading.Lock()
+		self.idle = {}
+		self.limits = {}
+
+	def limit(self, server):
+		with self.lock:
+			if server not in self.limits:
+				self.limits[server] = threading.BoundedSemaphore(self.per_host)
+
+			return self.limits[server]
+
+	def get(self, key):
+		with self.lock:
+			if self.idle.get(key):
+				return self.idle[key].pop()
+
+		# No idle connections, make a new one
+		# Through a proxy, we connect to the proxy instead of the server
+		host, port, proxy = key
+		if proxy is not None:
+			host, port = proxy
+
+		return http.client.HTTPConnection(host, int(port), timeout=self.timeout)
+
+	def put(self, key, conn):
+		with self.lock:
+			self.idle.setdefault(key, []).append(conn)
+
+	def request(self, server, port, query, mms_id, phone_num, proxy=None, proxy_auth=None, timeout=None):
+		# Returns the status, reason, data and how long it took for the server to answer
+		key = (server, port, proxy)
+		headers = {'X-MDN': phone_num}
+
+		if proxy is not None:
+			# Proxies get the full URL and the login
+			url = "http://{0}:{1}/{2}?{3}".format(server, port, query, mms_id)
+			headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(':'.join(proxy_auth).encode('utf_8')).decode('ascii')
 		else:
-			print('MMS Downloaded {0} bytes from {1}'.format(mms_download.getheader('Content-Length'), server))
-			mms_data_stream = mms_download
+			url = "/{0}?{1}".format(query, mms_id)
+
+		with self.limit(server):
+			conn = self.get(key)
+
+			# Each server can have its own timeout
+			conn.timeout = timeout or self.timeout
+			if conn.sock is not None:
+				conn.sock.settimeout(conn.timeout)
+
+			start = time.perf_counter()
+			try:
+				conn.request('GET', url, headers=headers)
+				response = conn.getresponse()
+				latency = time.perf_counter() - start
+				# We need to read the whole response before the connection can be used again
+				mms_data = response.read()
+			except Exception:
+				conn.close()
+				raise
+
+			if response.will_close:
+				conn.close()
+			else:
+				self.put(key, conn)
+
+		return response.status, response.reason, mms_data, latency
+
+	def close(self):
+		with self.lock:
+			for conns in self.idle.values():
+				for conn in conns:
+					conn.close()
 
-		return mms_data_stream
+			self.idle.clear()
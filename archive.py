@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+	MMS Message Archive
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+
+	ingest: Decode MMS files and add their headers and part tables to the archive
+	query: Search the archive, without decoding anything
+"""
+import argparse, json, sys
+from datetime import datetime
+
+from MessageArchive import MessageArchive
+
+def ingest(archive, args):
+	# Only ingesting needs the decoder, querying never loads it
+	from batch import decode_batch, find_files
+
+	# Skip the files that haven't changed since they were added
+	files = [file_name for file_name in find_files(args.paths, args.pattern) if args.force or not archive.is_current(file_name)]
+
+	count = archive.ingest(report_errors(decode_batch(files, args.jobs)))
+	print("Added {0} of {1} message(s)".format(count, len(files)))
+
+def report_errors(records):
+	# Files that couldn't be read or decoded are skipped, but say which ones
+	for record in records:
+		record = json.loads(record)
+		if 'error' in record:
+			print('{0}: {1}'.format(record['file'], record['error']), file=sys.stderr)
+
+		yield record
+
+def query(archive, args):
+	messages = archive.query(from_num=args.sender, to_num=args.recipient, since=args.since, until=args.until,
+		subject=args.subject, limit=args.limit)
+
+	# Look up the names of everyone in all of the messages at once
+	names = {}
+	if archive.has_phonebook():
+		from PhoneBook import PhoneBook
+		names = PhoneBook(args.database).resolve(messages)
+
+	def who(number):
+		return '{0} ({1})'.format(' '.join(names[number]).strip(), number) if number in names else number
+
+	for message in messages:
+		date = message['Date'].strftime('%A, %B %-d, %Y, %-I:%M %p') if message['Date'] is not None else ''
+		print("{0}\n\tFrom: {1}\n\tTo: {2}".format(date, who(message['From']), ', '.join(who(to_num) for to_num in message['To'])))
+		if message['Cc']:
+			print("\tCc:", ', '.join(who(cc_num) for cc_num in message['Cc']))
+		if message['Subject']:
+			print("\tSubject:", message['Subject'])
+		print("\tFile:", message['file'])
+		print("\tMessage:", [(part['contentType'], part['contentLength']) for part in message['parts']])
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description="Index MMS messages in SQLite and search them",
+		epilog="https://github.com/NTICompass/mms-viewer"
+	)
+	parser.add_argument('--database', default='phonebook.db', help="SQLite database to use (default: phonebook.db)")
+
+	subparsers = parser.add_subparsers(dest='command', required=True)
+
+	ingest_parser = subparsers.add_parser('ingest', help="Add MMS files to the archive")
+	ingest_parser.add_argument("paths", nargs="+", help="MMS files, directories or globs")
+	ingest_parser.add_argument('--pattern', default='*.bin', help="File pattern to use in directories (default: *.bin)")
+	ingest_parser.add_argument('-j', '--jobs', type=int, help="Number of worker processes (default: number of CPUs)")
+	ingest_parser.add_argument('-f', '--force', help="Add files again, even if they haven't changed", action="store_true")
+
+	query_parser = subparsers.add_parser('query', help="Search the archive")
+	query_parser.add_argument('--from', dest='sender', help="Phone number or name (from the phonebook) that sent the message")
+	query_parser.add_argument('--to', dest='recipient', help="Phone number or name the message was sent (or Cc'd) to")
+	query_parser.add_argument('--since', type=datetime.fromisoformat, help="Messages on or after this date (YYYY-MM-DD)")
+	query_parser.add_argument('--until', type=datetime.fromisoformat, help="Messages before this date (YYYY-MM-DD)")
+	query_parser.add_argument('--subject', help="Text in the subject")
+	query_parser.add_argument('-n', '--limit', type=int, help="Maximum number of messages to show")
+
+	args = parser.parse_args()
+
+	archive = MessageArchive(args.database)
+	if args.command == 'ingest':
+		ingest(archive, args)
+	else:
+		query(archive, args)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+	MMS Batch Decoder
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+
+	Decode a whole bunch of MMS files at once, using a pool of processes,
+	and write one JSON Lines record per message.
+"""
+import argparse, glob, json, math, mmap, os, os.path, sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from MMSMessage import MMSMessage
+
+def find_files(paths, pattern='*.bin'):
+	# Each path can be a file, a directory (searched recursively) or a glob
+	for path in paths:
+		if os.path.isdir(path):
+			yield from sorted(glob.glob(os.path.join(glob.escape(path), '**', pattern), recursive=True))
+		elif glob.has_magic(path):
+			yield from sorted(glob.glob(path, recursive=True))
+		else:
+			yield path
+
+def json_value(value):
+	# The only header value JSON doesn't know about is the date
+	if isinstance(value, datetime):
+		return value.isoformat()
+
+	return str(value)
+
+# Each worker process opens the attachment store once
+stores = {}
+
+def get_store(store_dir):
+	if store_dir not in stores:
+		from AttachmentStore import AttachmentStore
+		stores[store_dir] = AttachmentStore(store_dir)
+
+	return stores[store_dir]
+
+# ...and the phonebook
+phonebooks = {}
+
+def get_phonebook(database):
+	if database not in phonebooks:
+		from PhoneBook import PhoneBook
+		phonebooks[database] = PhoneBook(database)
+
+	return phonebooks[database]
+
+def decode_record(path, headers_only=False, store_dir=None):
+	record = {'file': path}
+
+	try:
+		if headers_only:
+			# Only read the start of the file, and don't even look at the parts
+			mms_headers = MMSMessage.scan_file(path)
+			if not mms_headers:
+				raise ValueError('No MMS headers found')
+			record['headers'] = mms_headers.to_dict()
+			return record
+
+		with open(path, 'rb') as mms_file:
+			try:
+				# Only the pages with the headers will actually get read off of the disk
+				mms_data = mmap.mmap(mms_file.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError:
+				# Empty files can't be mapped
+				mms_data = mms_file.read()
+
+		# We only want the part table, so don't decode any of the parts
+		mms_headers, mms_parts = MMSMessage(mms_data).decode(use_pil=False, lazy=True)
+		if not mms_headers:
+			# Empty, or not an MMS message at all
+			raise ValueError('No MMS headers found')
+
+		record['headers'] = mms_headers.to_dict()
+		record['parts'] = [{
+			'fileName': part.file_name,
+			'contentType': part.content_type,
+			'contentLength': part.content_length,
+			'charset': part.charset,
+			'offset': part.offset
+		} for part in mms_parts]
+
+		# Save the images, each one is only written if we don't already have it
+		if store_dir is not None:
+			message = record['headers'].get('Message-ID') or os.path.abspath(path)
+			for entry in get_store(store_dir).add_message(message, mms_parts):
+				record['parts'][entry['part']]['hash'] = entry['hash']
+	except Exception as error:
+		# One bad file shouldn't stop the whole batch
+		record['error'] = '{0}: {1}'.format(type(error).__name__, error)
+
+	return record
+
+def decode_files(paths, headers_only=False, store_dir=None, phonebook=None):
+	# Each worker gets a chunk of files, so we aren't sending them back and forth one at a time
+	records = [decode_record(path, headers_only, store_dir) for path in paths]
+
+	# Look up the names of everyone in the whole chunk in one query
+	if phonebook is not None:
+		names = get_phonebook(phonebook).resolve([record['headers'] for record in records if 'headers' in record])
+		for record in records:
+			if 'headers' in record:
+				numbers = [record['headers'].get('From')] + record['headers'].get('To', []) + record['headers'].get('Cc', [])
+				record['names'] = {number: ' '.join(names[number]).strip() for number in numbers if number in names}
+
+	return [json.dumps(record, default=json_value) for record in records]
+
+def chunk_list(items, size):
+	for x in range(0, len(items), size):
+		yield items[x:x+size]
+
+def decode_batch(paths, jobs=None, chunk_size=None, ordered=False, headers_only=False, store_dir=None, phonebook=None):
+	# Yields one JSON string for each file
+	files = list(paths)
+
+	# By default, give each worker about 4 chunks, so small batches still use every CPU
+	# (and a slow chunk at the end doesn't leave the others waiting long)
+	if chunk_size is None:
+		chunk_size = min(64, max(1, math.ceil(len(files) / ((jobs or os.cpu_count() or 1) * 4))))
+
+	with ProcessPoolExecutor(max_workers=jobs) as executor:
+		futures = [executor.submit(decode_files, chunk, headers_only, store_dir, phonebook) for chunk in chunk_list(files, chunk_size)]
+
+		# Either wait for each chunk in order, or take them as soon as they are done
+		for future in (futures if ordered else as_completed(futures)):
+			yield from future.result()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description="Decode many MMS files into JSON Lines",
+		epilog="https://github.com/NTICompass/mms-viewer"
+	)
+
+	parser.add_argument("paths", nargs="+", help="MMS files, directories or globs")
+	parser.add_argument('-o', '--output', help="JSON Lines file to write (default: stdout)")
+	parser.add_argument('--pattern', default='*.bin', help="File pattern to use in directories (default: *.bin)")
+	parser.add_argument('-j', '--jobs', type=int, help="Number of worker processes (default: number of CPUs)")
+	parser.add_argument('--chunk-size', type=int, help="Files sent to a worker at a time (default: enough for 4 chunks per worker, up to 64)")
+	parser.add_argument('--ordered', help="Write the records in the same order as the files", action="store_true")
+	parser.add_argument('-H', '--headers-only', help="Only read the headers, skip the part table", action="store_true")
+	parser.add_argument('-s', '--store', metavar="DIR", help="Also save the images into this attachment store, only one copy of each")
+	parser.add_argument('-p', '--phonebook', metavar="FILE", help="Add the names of the sender and recipients from this phonebook")
+
+	args = parser.parse_args()
+
+	if args.headers_only and args.store is not None:
+		parser.error("--store needs the parts, it can't be used with -H/--headers-only")
+
+	output = open(args.output, 'w') if args.output is not None else sys.stdout
+
+	for record in decode_batch(find_files(args.paths, args.pattern), args.jobs, args.chunk_size, args.ordered, args.headers_only, args.store,
+		args.phonebook):
+		output.write(record + '\n')
+
+	if output is not sys.stdout:
+		output.close()
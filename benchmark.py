@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+	MMS Decoder Benchmarks
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+
+	Decodes synthetic messages (from MMSEncoder) over and over, and reports
+	messages/sec and MB/sec, so we can see if the decoder gets slower.
+
+	With --download, downloads messages from a local MMSCServer instead,
+	to see the download throughput and latency.
+
+	With --stress, decodes the messages from a lot of threads at once (with
+	the one shared `decoder`), and checks they all come out the same as when
+	they're decoded one at a time.
+
+	With --roundtrip, encodes messages with headers the decoder only skips over
+	(or that used to trip it up, like Cc), and checks they decode back to the
+	same headers and parts.
+"""
+import argparse, itertools, json, os, os.path, random, subprocess, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+
+from MMSEncoder import MMSEncoder
+from MMSMessage import MMSMessage, MMSStreamDecoder, decoder
+from Profiler import profiler
+
+# Each benchmark is the arguments to `MMSEncoder.generate()`
+benchmarks = {
+	'header-heavy': {'parts': 1, 'part_size': 64, 'mix': ('text',), 'recipients': 200},
+	'many-parts': {'parts': 200, 'part_size': 256, 'mix': ('text', 'jpeg', 'png'), 'recipients': 1},
+	'large-image': {'parts': 1, 'part_size': 8*1024*1024, 'mix': ('jpeg',), 'recipients': 1},
+	'typical': {'parts': 2, 'part_size': 256*1024, 'mix': ('text', 'jpeg'), 'recipients': 3}
+}
+
+def run_decode(pdu, seconds, lazy=True):
+	# Run the decoder for (at least) `seconds`, returns how many times it ran and how long it took
+	count = 0
+	start = time.perf_counter()
+	elapsed = 0
+
+	while elapsed < seconds:
+		mms_headers, mms_parts = MMSMessage(pdu).decode(use_pil=False, lazy=lazy)
+
+		# Not lazy?  Then read every byte of the images too, so MB/sec means something
+		if not lazy:
+			for part in mms_parts:
+				if part.kind() == 'image':
+					bytes(part.raw)
+
+		count += 1
+		elapsed = time.perf_counter() - start
+
+	return count, elapsed
+
+def run_benchmarks(names, seconds=1.0, lazy=True):
+	encoder = MMSEncoder()
+	results = []
+
+	for name in names:
+		pdu = encoder.generate(seed=0, **benchmarks[name])
+		count, elapsed = run_decode(pdu, seconds, lazy)
+
+		results.append({
+			'benchmark': name,
+			'bytes': len(pdu),
+			'messages': count,
+			'seconds': elapsed,
+			'messages_per_sec': count / elapsed,
+			'us_per_message': elapsed / count * 1000000,
+			# Lazy decoding never reads the parts, so it doesn't have a throughput
+			'mb_per_sec': count * len(pdu) / elapsed / (1024*1024) if not lazy else None
+		})
+
+	return results
+
+def run_startup(runs=10):
+	# How long does it take main.py to start up and print a message?
+	# Most of that is importing things, so also get `-X importtime` to see what's slow
+	main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+	fd, pdu_file = tempfile.mkstemp(suffix='.bin')
+	with os.fdopen(fd, 'wb') as mms_file:
+		mms_file.write(MMSEncoder().generate(seed=0))
+
+	results = []
+	try:
+		for name, arguments in (('headers-only', ['-H', pdu_file]), ('list', [pdu_file])):
+			times = []
+			for x in range(runs):
+				start = time.perf_counter()
+				subprocess.run([sys.executable, main_py] + arguments, stdout=subprocess.DEVNULL, check=True)
+				times.append(time.perf_counter() - start)
+
+			# Each line is: "import time: self [us] | cumulative | imported package"
+			# Only the top level imports (not indented) are interesting
+			importtime = subprocess.run([sys.executable, '-X', 'importtime', main_py] + arguments,
+				stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, text=True).stderr
+			imports = []
+			for line in importtime.splitlines():
+				if not line.startswith('import time:') or '|' not in line:
+					continue
+
+				self_time, cumulative, module = line[len('import time:'):].split('|')
+				if cumulative.strip().isdigit() and not module.startswith('  '):
+					imports.append((module.strip(), int(cumulative) / 1000))
+
+			results.append({
+				'benchmark': name,
+				'runs': runs,
+				'min_ms': min(times) * 1000,
+				'mean_ms': sum(times) / len(times) * 1000,
+				'import_ms': sum(import_ms for module, import_ms in imports),
+				'slowest_imports': sorted(imports, key=lambda item: item[1], reverse=True)[:5]
+			})
+	finally:
+		os.unlink(pdu_file)
+
+	return results
+
+def percentile(values, percent):
+	# Nearest-rank percentile of a sorted list
+	return values[min(int(len(values) * percent / 100), len(values) - 1)] if values else 0
+
+def run_download(messages=200, workers=8, per_host=4, part_size=64*1024, latency=0.05, jitter=0.05, bandwidth=None,
+	not_found=0, timeouts=0, timeout=2):
+	# Download `messages` messages from a local MMSCServer with `VirginMobile.download_many()`
+	from MMSCServer import MMSCServer
+	from VirginMobile import VirginMobile
+
+	# Every message is the same size, but has its own ID
+	pdu = MMSEncoder().generate(parts=2, part_size=part_size, mix=('text', 'jpeg'), seed=0)
+	mms_ids = ['{0:017d}'.format(x) for x in range(messages)]
+
+	server = MMSCServer(messages={mms_id: pdu for mms_id in mms_ids}, latency=latency, jitter=jitter, bandwidth=bandwidth,
+		not_found_rate=not_found, timeout_rate=timeouts, hang=timeout * 2)
+	server.start()
+
+	# Each request (including retries) is timed by the profiler, so listen in on that
+	# This includes waiting for a connection, when there are more workers than `per_host`
+	times = []
+	def hook(kind, name, value):
+		if kind == 'timer' and name == 'download':
+			times.append(value)
+
+	profiler.reset()
+	profiler.enable()
+	profiler.add_hook(hook)
+	try:
+		phone = VirginMobile('5555555555', mms_servers=server.mms_servers(), mms_port=server.port)
+
+		start = time.perf_counter()
+		results = phone.download_many(mms_ids, proxy=False, workers=workers, per_host=per_host, timeout=timeout)
+		elapsed = time.perf_counter() - start
+	finally:
+		profiler.remove_hook(hook)
+		profiler.disable()
+		server.shutdown()
+		server.server_close()
+
+	downloaded = [mms_data for mms_data in results.values() if mms_data is not None]
+	total_bytes = sum(len(mms_data) for mms_data in downloaded)
+	times.sort()
+
+	return [{
+		'benchmark': 'download',
+		'workers': workers,
+		'messages': len(downloaded),
+		'failed': messages - len(downloaded),
+		'requests': len(times),
+		'bytes': total_bytes,
+		'seconds': elapsed,
+		'messages_per_sec': len(downloaded) / elapsed,
+		'mb_per_sec': total_bytes / elapsed / (1024*1024),
+		'p50_ms': percentile(times, 50) * 1000,
+		'p95_ms': percentile(times, 95) * 1000,
+		'p99_ms': percentile(times, 99) * 1000,
+		'max_ms': (times[-1] if times else 0) * 1000
+	}]
+
+def fingerprint(pdu):
+	# Everything `decode()` found in a message, as something we can compare
+	mms_headers, mms_parts = decoder.decode(pdu, use_pil=False, lazy=True)
+
+	# Decode the text parts too, those are the ones with their own code (charsets, etc.)
+	parts = tuple((part.offset, part.content_length, part.content_type, part.charset, part.file_name,
+		part.content_id, part.content_location, bytes(part.raw), part.data if part.kind() == 'text' else None) for part in mms_parts)
+
+	return repr(mms_headers.to_dict()), parts
+
+def run_stress(names, threads=8, rounds=50, seeds=4):
+	# Decode the same messages from `threads` threads at once, and make sure
+	# every result is the same as decoding them one at a time
+	encoder = MMSEncoder()
+	pdus = [encoder.generate(seed=seed, **benchmarks[name]) for name in names for seed in range(seeds)]
+
+	start = time.perf_counter()
+	expected = [fingerprint(pdu) for pdu in pdus]
+	single = time.perf_counter() - start
+
+	# Every message, `rounds` times, in a random order, so different messages are decoded at the same time
+	jobs = list(itertools.chain.from_iterable([range(len(pdus))] * rounds))
+	random.Random(0).shuffle(jobs)
+
+	start = time.perf_counter()
+	with ThreadPoolExecutor(threads) as executor:
+		results = list(executor.map(lambda x: (x, fingerprint(pdus[x])), jobs))
+	elapsed = time.perf_counter() - start
+
+	mismatches = sum(1 for x, result in results if result != expected[x])
+
+	return [{
+		'benchmark': 'stress',
+		'threads': threads,
+		'messages': len(pdus),
+		'decodes': len(jobs),
+		'mismatches': mismatches,
+		'seconds': elapsed,
+		'decodes_per_sec': len(jobs) / elapsed,
+		'single_decodes_per_sec': len(pdus) / single,
+		'gil': sys._is_gil_enabled() if hasattr(sys, '_is_gil_enabled') else True
+	}]
+
+# Each round trip is the headers to give `MMSEncoder.retrieve_conf()`
+roundtrips = {
+	'cc': {'to_nums': ['15550000001'], 'cc_nums': ['15550000002', '15550000003']},
+	'skipped-headers': {'to_nums': ['15550000001'], 'other_headers': [
+		('X-Mms-Read-Report', b'\x81'),
+		('X-Mms-Expiry', b'\x1F' + bytes([40]) + bytes(range(40))),
+		('X-Mms-Delivery-Time', b'\x06\x81\x04\x57\xe2\xa2\x49')
+	]},
+	'cc-and-skipped': {'to_nums': ['15550000001'], 'cc_nums': ['15550000002'], 'other_headers': [
+		('X-Mms-Sender-Visibility', b'\x80'),
+		('X-Mms-Reply-Charging-ID', b'reply@mms.example\x00')
+	]}
+}
+
+# Headers the decoder has no name for (already encoded), each is also tried right after the message type
+unknown_headers = {
+	'unknown-string': b'\xB0hello\x00',
+	'unknown-short': b'\xC1\x05abcde',
+	'unknown-byte': b'\xB1\x81',
+	'unknown-long': b'\xB2\x1F\x28' + bytes(40)
+}
+
+def check_roundtrip(headers, unknown=b''):
+	# Encode a message, then decode it (all at once and a few bytes at a time)
+	# Returns its size, and what didn't come back the same as what we put in
+	parts = [('text/plain', b'Round trip', 'text0000.txt'), ('image/jpeg', b'\xFF\xD8\xFF\xE1' + bytes(60), 'IMG_0000.jpg')]
+	pdu = MMSEncoder().retrieve_conf(parts, transaction_id='T1', message_id='roundtrip@mms.example', from_num='+15550000000',
+		subject='Round trip', **headers)
+	pdu = pdu[:2] + unknown + pdu[2:]
+	errors = []
+
+	expected = {'X-Mms-Transaction-Id': 'T1', 'Message-ID': 'roundtrip@mms.example', 'From': '+15550000000',
+		'To': headers['to_nums'], 'Subject': 'Round trip', 'Content-Type': 'application/vnd.wap.multipart.related',
+		'Cc': headers.get('cc_nums') or None}
+
+	stream = MMSStreamDecoder(use_pil=False)
+	events = [event for x in range(0, len(pdu), 7) for event in stream.feed(pdu[x:x+7])] + stream.close()
+
+	for how, (mms_headers, mms_parts) in (('decode', decoder.decode(pdu, use_pil=False, lazy=True)),
+		('stream', (stream.headers, [value for kind, value in events if kind == 'part']))):
+		for header, value in expected.items():
+			if mms_headers.get(header) != value:
+				errors.append('{0}: {1} is {2!r}, not {3!r}'.format(how, header, mms_headers.get(header), value))
+
+		if [(part.content_type, bytes(part.raw)) for part in mms_parts] != [(content_type, data) for content_type, data, file_name in parts]:
+			errors.append('{0}: the parts are wrong'.format(how))
+
+	return len(pdu), errors
+
+def run_roundtrip():
+	# Check each message, on its own and with each unknown header in it
+	results = []
+
+	for name, headers in roundtrips.items():
+		for unknown_name, unknown in [(None, b'')] + list(unknown_headers.items()):
+			size, errors = check_roundtrip(headers, unknown)
+			results.append({'benchmark': 'roundtrip', 'message': name if unknown_name is None else '{0}+{1}'.format(name, unknown_name),
+				'bytes': size, 'errors': errors})
+
+	return results
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description="Benchmark the MMS decoder",
+		epilog="https://github.com/NTICompass/mms-viewer"
+	)
+
+	parser.add_argument("benchmarks", nargs="*", help="Benchmarks to run: {0} (default: all)".format(', '.join(benchmarks)))
+	parser.add_argument('-s', '--seconds', type=float, default=1.0, help="How long to run each benchmark (default: 1)")
+	parser.add_argument('--eager', help="Decode the text parts and read the images too, not just the headers and part table (needed for MB/sec)", action="store_true")
+	parser.add_argument('--json', help="Print the results as JSON", action="store_true")
+	parser.add_argument('--startup', help="Benchmark how long main.py takes to start (and import things) instead", action="store_true")
+	parser.add_argument('--runs', type=int, default=10, help="How many times to run main.py for --startup (default: 10)")
+
+	download = parser.add_argument_group('download benchmark')
+	download.add_argument('--download', help="Benchmark downloading from a local MMSC server instead", action="store_true")
+	download.add_argument('--messages', type=int, default=200, help="Messages to download (default: 200)")
+	download.add_argument('-w', '--workers', type=int, default=8, help="Downloads to run at once (default: 8)")
+	download.add_argument('--per-host', type=int, default=4, help="Connections to the server at once (default: 4)")
+	download.add_argument('--size', type=int, default=64*1024, help="Size of each image in the messages (default: 65536)")
+	download.add_argument('--latency', type=float, default=0.05, help="Server latency in seconds (default: 0.05)")
+	download.add_argument('--jitter', type=float, default=0.05, help="Up to this many more seconds of latency (default: 0.05)")
+	download.add_argument('--bandwidth', type=int, help="Bytes/sec the server sends each message at (default: unlimited)")
+	download.add_argument('--not-found', type=float, default=0, help="Fraction of IDs the server 404s (default: 0)")
+	download.add_argument('--timeouts', type=float, default=0, help="Fraction of requests the server never answers (default: 0)")
+	download.add_argument('--timeout', type=float, default=2, help="Seconds before giving up on a request (default: 2)")
+
+	stress = parser.add_argument_group('thread stress test')
+	stress.add_argument('--stress', help="Decode from a lot of threads at once, and check the results are the same", action="store_true")
+	stress.add_argument('-t', '--threads', type=int, default=8, help="Threads to decode with (default: 8)")
+	stress.add_argument('--rounds', type=int, default=50, help="How many times to decode each message (default: 50)")
+
+	roundtrip = parser.add_argument_group('round trip check')
+	roundtrip.add_argument('--roundtrip', help="Encode messages with less common headers (Cc, ones that are skipped) and check they decode the same", action="store_true")
+
+	args = parser.parse_args()
+
+	for name in args.benchmarks:
+		if name not in benchmarks:
+			parser.error("unknown benchmark: {0}".format(name))
+
+	if args.roundtrip:
+		results = run_roundtrip()
+	elif args.startup:
+		results = run_startup(args.runs)
+	elif args.stress:
+		# The large image benchmark is just slow to generate, it doesn't have any more parts to go wrong
+		results = run_stress(args.benchmarks or [name for name in benchmarks if name != 'large-image'], args.threads, args.rounds)
+	elif args.download:
+		results = run_download(args.messages, args.workers, args.per_host, args.size, args.latency, args.jitter, args.bandwidth,
+			args.not_found, args.timeouts, args.timeout)
+	else:
+		results = run_benchmarks(args.benchmarks or list(benchmarks), args.seconds, lazy=not args.eager)
+
+	if args.json:
+		print(json.dumps(results, indent=4))
+	elif args.roundtrip:
+		for result in results:
+			print('{0:<32} {1:>6} bytes  {2}'.format(result['message'], result['bytes'], 'OK' if not result['errors'] else 'FAILED'))
+			for error in result['errors']:
+				print('\t' + error)
+	elif args.startup:
+		print('{0:<14} {1:>10} {2:>10} {3:>10}  {4}'.format('Benchmark', 'Min ms', 'Mean ms', 'Import ms', 'Slowest imports'))
+		for result in results:
+			slowest = ', '.join('{0} ({1:.1f})'.format(*item) for item in result['slowest_imports'])
+			print('{benchmark:<14} {min_ms:>10.1f} {mean_ms:>10.1f} {import_ms:>10.1f}  '.format(**result) + slowest)
+	elif args.download:
+		print('{0:<10} {1:>8} {2:>8} {3:>14} {4:>10} {5:>8} {6:>8} {7:>8} {8:>8}'.format(
+			'Workers', 'Messages', 'Failed', 'Messages/sec', 'MB/sec', 'p50 ms', 'p95 ms', 'p99 ms', 'Max ms'))
+		for result in results:
+			print('{workers:<10} {messages:>8} {failed:>8} {messages_per_sec:>14,.1f} {mb_per_sec:>10,.1f} '
+				'{p50_ms:>8.1f} {p95_ms:>8.1f} {p99_ms:>8.1f} {max_ms:>8.1f}'.format(**result))
+	elif args.stress:
+		print('{0:<10} {1:>8} {2:>10} {3:>12} {4:>12} {5:>16}'.format(
+			'Threads', 'Messages', 'Decodes', 'Mismatches', 'Decodes/sec', 'Single thread/sec'))
+		for result in results:
+			print('{threads:<10} {messages:>8} {decodes:>10} {mismatches:>12} {decodes_per_sec:>12,.1f} '
+				'{single_decodes_per_sec:>16,.1f}'.format(**result))
+	else:
+		print('{0:<14} {1:>12} {2:>14} {3:>12} {4:>10}'.format('Benchmark', 'Size', 'Messages/sec', 'us/message', 'MB/sec'))
+		for result in results:
+			mb_per_sec = '{0:,.1f}'.format(result['mb_per_sec']) if result['mb_per_sec'] is not None else '-'
+			print('{benchmark:<14} {bytes:>12,} {messages_per_sec:>14,.1f} {us_per_message:>12,.1f} '.format(**result) + '{0:>10}'.format(mb_per_sec))
+
+	# A stress test that found a difference (or a round trip that didn't match) should fail
+	if args.stress and any(result['mismatches'] for result in results):
+		sys.exit(1)
+	if args.roundtrip and any(result['errors'] for result in results):
+		sys.exit(1)
@@ -1,11 +1,10 @@
 #!/usr/bin/env python3
-import argparse, shutil, os.path
-import tkinter as tk
-from PIL import Image, ImageTk
+import argparse, json, mmap, os.path, sys
 
-from VirginMobile import VirginMobile
-from MMSMessage import MMSMessage
-from PhoneBook import PhoneBook
+# Everything else (tkinter, PIL, urllib, sqlite) is imported only when it's needed,
+# so we don't pay for importing it when just printing a message
+from MMSMessage import MMSMessage, MMSStreamDecoder
+from Profiler import null_timer, profiler
 
 version = "0.5 beta"
 
@@ -19,30 +18,87 @@ parser.add_argument('-V', '--version', action='version', version=version)
 parser.add_argument("file_or_phone", help="MMS File or phone number")
 parser.add_argument("mmsid", nargs="?", help="MMS-Transaction-ID")
 parser.add_argument('-p', '--phonebook', help="Use phonebook.db", action="store_true")
+parser.add_argument('-c', '--cache', help="Cache downloaded messages (in --cache-dir)", action="store_true")
+parser.add_argument('--cache-dir', metavar="DIR", help="Directory for -c/--cache (default: mms_cache)")
+parser.add_argument('--offline', help="Only load messages from the cache", action="store_true")
+parser.add_argument('-P', '--parse-cache', help="Remember where the headers and parts are in files, so they aren't parsed again (in --parse-cache-file)", action="store_true")
+parser.add_argument('--parse-cache-file', metavar="FILE", help="Database for -P/--parse-cache (default: parse_cache.db)")
 
 parser.add_argument('--debug', help="Print debugging info", action="store_true")
+parser.add_argument('-H', '--headers-only', help="Only read and print the message headers", action="store_true")
+parser.add_argument('--profile', help="Print a JSON report of where the time went (to stderr, or --profile-file)", action="store_true")
+parser.add_argument('--profile-file', metavar="FILE", help="Write the --profile report to this file instead")
 
 group = parser.add_mutually_exclusive_group()
 group.add_argument('-d', '--display', help="Display image file(s)", action="store_true")
-group.add_argument('-x', '--extract', help="Extract image file(s)", action="store_true")
+group.add_argument('-x', '--extract', help="Extract image file(s), fixing their file extension", action="store_true")
 group.add_argument('-X', '--extract-original', help="Extract original image file(s) without using PIL", action="store_true")
+group.add_argument('-s', '--store', help="Save image file(s) into an attachment store, only one copy of each (in --store-dir)", action="store_true")
+parser.add_argument('--store-dir', metavar="DIR", help="Directory for -s/--store (default: attachments)")
+parser.add_argument('--convert', metavar='FORMAT', help="Convert extracted images to this format (ie: png, jpeg) using PIL")
 
 args = parser.parse_args()
 
+if args.convert is not None and not args.extract:
+	parser.error("--convert needs -x/--extract")
+
+# Where each of these goes is its own option, so picking one without turning it on is a mistake
+if args.cache_dir is not None and not (args.cache or args.offline):
+	parser.error("--cache-dir needs -c/--cache or --offline")
+if args.parse_cache_file is not None and not args.parse_cache:
+	parser.error("--parse-cache-file needs -P/--parse-cache")
+if args.profile_file is not None and not args.profile:
+	parser.error("--profile-file needs --profile")
+if args.store_dir is not None and not args.store:
+	parser.error("--store-dir needs -s/--store")
+
+if args.profile:
+	profiler.enable()
+
 if args.mmsid is not None:
-	phone = VirginMobile(args.file_or_phone)
+	from VirginMobile import VirginMobile
+	from PDUCache import PDUCache
+
+	# Offline mode doesn't make any sense without the cache
+	cache = PDUCache(args.cache_dir or 'mms_cache') if args.cache or args.offline else None
+
+	phone = VirginMobile(args.file_or_phone, cache=cache, offline=args.offline)
 	message = phone.download(args.mmsid, proxy=False)
 else:
 	message = open(args.file_or_phone, 'rb')
 
 # Check if the file was downloaded successfully
 if message is not None:
-	# Get the data from the resource
-	mms_data = message.read()
-
-	# Decode the message
-	decoder = MMSMessage(mms_data)
-	mms_headers, mms_data = decoder.decode(use_pil=not args.extract_original)
+	if args.mmsid is None and args.headers_only:
+		# Only read as much of the file as we need to get the headers
+		mms_headers, mms_data = MMSMessage.scan_file(args.file_or_phone), []
+	elif args.mmsid is None:
+		# Get the data from the resource
+		# Local files are memory mapped, so (large) images are never copied into memory
+		try:
+			mms_data = mmap.mmap(message.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			# Empty files can't be mapped
+			mms_data = message.read()
+
+		# Decode the message
+		# The parts are decoded lazily, images we don't display or extract are never opened
+		if args.parse_cache:
+			from ParseCache import ParseCache
+			mms_headers, mms_data = ParseCache(args.parse_cache_file or 'parse_cache.db').decode(args.file_or_phone, mms_data, use_pil=not args.extract_original)
+		else:
+			decoder = MMSMessage(mms_data)
+			mms_headers, mms_data = decoder.decode(use_pil=not args.extract_original, lazy=True)
+	else:
+		# Decode the message while it's being downloaded
+		decoder = MMSStreamDecoder(use_pil=not args.extract_original)
+		with profiler.timer('download'):
+			for event, value in decoder.read_from(message):
+				# No need to download the rest if we only want the headers
+				if args.headers_only and event == 'headers':
+					break
+
+		mms_headers, mms_data = decoder.headers, decoder.parts
 
 	# Close the file/urllib.request object
 	message.close()
@@ -51,8 +107,11 @@ if message is not None:
 		print(mms_headers)
 		print(mms_data)
 
+	if args.headers_only:
+		for header, value in mms_headers.items():
+			print("{0}:\n\t".format(header), value)
 	# Did we get a successful message or an error?
-	if mms_headers['Content-Type'] == 'text/plain':
+	elif mms_headers['Content-Type'] == 'text/plain':
 		# MMS message contains an error message
 		print('MMS Error:', mms_data[0]['data'])
 	elif mms_headers['Content-Type'].startswith('application/vnd.wap.multipart'):
@@ -60,66 +119,108 @@ if message is not None:
 
 		# Look up names in our phonebook
 		if(args.phonebook and os.path.isfile('phonebook.db')):
+			from PhoneBook import PhoneBook
+
 			phonebook = PhoneBook()
 
-			from_name = phonebook.get_name(mms_headers['From'])
+			# Everyone in the message is looked up at once
+			names = phonebook.resolve([mms_headers])
+
+			from_name = names.get(mms_headers['From'])
 			print("From:\n\t", ' '.join(from_name) if from_name is not None else mms_headers['From'])
 
-			to_names = phonebook.get_names(mms_headers['To'])
-			to_names = [' '.join(to_names[to]).rstrip(' ') if to in to_names else to for to in mms_headers['To']]
+			to_names = [' '.join(names[to]).rstrip(' ') if to in names else to for to in mms_headers['To']]
 			print("To:\n\t", to_names)
+			if 'Cc' in mms_headers:
+				print("Cc:\n\t", [' '.join(names[cc]).rstrip(' ') if cc in names else cc for cc in mms_headers['Cc']])
 		else:
 			print("From:\n\t", mms_headers['From'])
 			print("To:\n\t", mms_headers['To'])
+			if 'Cc' in mms_headers:
+				print("Cc:\n\t", mms_headers['Cc'])
 
 		print("Date:\n\t", mms_headers['Date'].strftime('%A, %B %-d, %Y, %-I:%M %p'))
 		if 'Subject' in mms_headers:
 			print("Subject:\n\t", mms_headers['Subject'])
 		print("Message:\n\t", [(file_data['contentType'], file_data['contentLength']) for file_data in mms_data])
 
+		# All of the images are shown in one window, which decodes them in the background
+		# It's only opened once there's an image to show
+		gallery = None
+
+		# The same image is only saved once, no matter how many messages it's in
+		if args.store:
+			store_dir = args.store_dir or 'attachments'
+			from AttachmentStore import AttachmentStore
+			store = AttachmentStore(store_dir)
+			message_name = mms_headers.get('Message-ID') or args.mmsid or os.path.basename(args.file_or_phone)
+
 		# Loop over the data and decide what to do with it
-		for file_data in mms_data:
+		for part_num, file_data in enumerate(mms_data):
 			# We have an image.  Should we extract it?
 			if file_data['contentType'].startswith('image/'):
-				# Display the image in a GUI window
-				# Totally not stolen from http://stackoverflow.com/a/3167114
+				# Add it to the gallery, it's shown once we've gone through the whole message
 				if args.display:
-					window = tk.Tk()
-					window.title('MMS Image')
-					window.resizable(0, 0)
-
-					# Let's not make the window *too* big, how about a max of 1.5x the screen height
-					half_height = window.winfo_screenheight() / 1.5
-					if file_data['data'].height > half_height:
-						# Scale down the image
-						file_data['data'].thumbnail((file_data['data'].width, half_height), Image.ANTIALIAS)
-						print("Displaying Image (Scaled):\n\t", file_data['fileName'])
-					else:
-						print("Displaying Image:\n\t", file_data['fileName'])
-
-					mms_image = ImageTk.PhotoImage(file_data['data'])
-					panel = tk.Label(window, image=mms_image)
-					panel.pack(side='top', fill='both', expand='yes')
-
-					window.geometry('{0}x{1}+{2}+{2}'.format(mms_image.width(), mms_image.height(), 0, 0))
-					window.mainloop()
-
-				# The file could be stored as either a PIL object or a temp file
-				if args.extract:
-					# Only JPEGs can have EXIFs (most cell phones will add this when texting an image)
-					if file_data['contentType'] == 'image/jpeg':
-						file_data['data'].save(file_data['fileName'], 'jpeg', exif=file_data['data'].info["exif"])
-					else:
-						file_data['data'].save(file_data['fileName'])
-				elif args.extract_original:
-					real_file = open(file_data['fileName'], 'wb')
-					shutil.copyfileobj(file_data['data'], real_file)
-					real_file.close()
-
-				file_data['data'].close()
-
-				if args.extract or args.extract_original:
-					print("Image Saved As:\n\t", file_data['fileName'])
+					if gallery is None:
+						from Gallery import Gallery
+						gallery = Gallery()
+					gallery.add(file_data)
+					print("Displaying Image:\n\t", file_data['fileName'])
+
+				# Time how long it takes to write (and convert) the images, if we are writing them
+				writing = args.extract or args.extract_original or args.store
+				with profiler.timer('write') if writing else null_timer:
+					# Images are saved as-is, we only need PIL if we're converting them
+					if args.extract and args.convert is not None:
+						image_format = 'JPEG' if args.convert.upper() in ('JPG', 'JPEG') else args.convert.upper()
+						save_name = os.path.splitext(file_data.real_file_name())[0] + '.' + args.convert.lower()
+						image = file_data['data']
+
+						# JPEGs can't have transparency
+						if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+							image = image.convert('RGB')
+
+						# Keep the EXIF (most cell phones will add this when texting an image), if there is one
+						exif = {'exif': file_data['data'].info['exif']} if 'exif' in file_data['data'].info else {}
+						image.save(save_name, image_format, **exif)
+					elif args.extract:
+						# Write the original bytes, under a name that matches what the image really is
+						save_name = file_data.real_file_name()
+						real_file = open(save_name, 'wb')
+						real_file.write(file_data.raw)
+						real_file.close()
+					elif args.extract_original:
+						save_name = file_data['fileName']
+
+						# Write the original bytes straight from the message data
+						real_file = open(file_data['fileName'], 'wb')
+						real_file.write(file_data.raw)
+						real_file.close()
+					elif args.store:
+						entry = store.add(message_name, part_num, file_data)
+						save_name = os.path.join(store_dir, entry.get('link') or entry['object'])
+
+						if not entry['stored']:
+							save_name += ' (already stored)'
+
+				# Only close the image if it was actually opened with PIL
+				# (and the gallery isn't still using it)
+				if file_data.decoded and not args.extract_original and not args.display:
+					file_data['data'].close()
+
+				if args.extract or args.extract_original or args.store:
+					print("Image Saved As:\n\t", save_name)
 			# This is just a text, display it
 			elif file_data['contentType'] == 'text/plain':
 				print("Text:\n\t", file_data['data'])
+
+		if gallery is not None:
+			gallery.run()
+
+if args.profile:
+	report = json.dumps(profiler.report(), indent=4)
+	if args.profile_file is None:
+		print(report, file=sys.stderr)
+	else:
+		with open(args.profile_file, 'w') as report_file:
+			report_file.write(report)
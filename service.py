@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+	MMS Decode Service
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+
+	A local HTTP (or Unix socket) JSON API for decoding MMS messages, so each
+	message doesn't pay for starting Python and importing Pillow again.
+
+	POST a PDU to /decode, or {"phone": ..., "mms_id": ...} to /download, and
+	get back the headers and part table as JSON.  GET /status shows how busy it is.
+	The decoding is done by a pool of worker processes that are started (and
+	import everything) when the service is, and stay running.
+"""
+import argparse, base64, json, multiprocessing, os, os.path, signal, socketserver, sys, threading, time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from batch import json_value
+from MMSMessage import decoder
+
+# Each worker process keeps its phonebook open between requests
+worker_phonebook = None
+# Shared by the workers, so `warm_up()` can wait for all of them
+worker_barrier = None
+
+def start_worker(phonebook=None, barrier=None):
+	global worker_phonebook, worker_barrier
+	worker_barrier = barrier
+
+	# Import (and load the plugins of) the slow stuff now, not on the first request
+	try:
+		from PIL import Image # Pillow
+		Image.init()
+	except ImportError:
+		pass
+	import xml.etree.ElementTree
+
+	if phonebook is not None and os.path.isfile(phonebook):
+		from PhoneBook import PhoneBook
+		worker_phonebook = PhoneBook(phonebook)
+
+	# Ctrl+C is for the service, it'll shut us down
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def warm_up(timeout=10):
+	# Nothing to do, this just makes sure the process has started
+	# Wait for the other workers to get here too, so each of these is run by its own worker
+	# (instead of one that's already free).  If they don't all show up, we still say who we are.
+	if worker_barrier is not None:
+		try:
+			worker_barrier.wait(timeout)
+		except threading.BrokenBarrierError:
+			pass
+
+	return os.getpid()
+
+def decode_message(mms_data, parts=False, images=False, names=False, headers_only=False):
+	# Runs in a worker, returns the JSON for one message
+	# Empty, or not an MMS message at all (like batch.py, that's an error)
+	if headers_only:
+		mms_headers = decoder.decode_headers(mms_data)
+		if not mms_headers:
+			raise ValueError('No MMS headers found')
+		return json.dumps({'headers': mms_headers.to_dict()}, default=json_value)
+
+	mms_headers, mms_parts = decoder.decode(mms_data, use_pil=images, lazy=True)
+	if not mms_headers:
+		raise ValueError('No MMS headers found')
+	record = {'headers': mms_headers.to_dict(), 'parts': []}
+
+	for part in mms_parts:
+		part_record = {
+			'fileName': part.file_name,
+			'contentType': part.content_type,
+			'contentLength': part.content_length,
+			'charset': part.charset,
+			'offset': part.offset,
+			'contentId': part.content_id,
+			'contentLocation': part.content_location
+		}
+
+		# Pillow only reads the image's header to get these
+		if images and part.kind() == 'image':
+			try:
+				image = part.data
+				part_record.update(format=image.format, width=image.width, height=image.height)
+				image.close()
+			except Exception as error:
+				part_record['imageError'] = '{0}: {1}'.format(type(error).__name__, error)
+
+		# Texts (and the SMIL) are sent as text, everything else as base64
+		# So is text that isn't really in its charset, `encoding` says which one it is
+		if parts:
+			part_record['encoding'] = 'base64'
+			if part.kind() in ('text', 'smil'):
+				try:
+					part_record['data'] = str(part.raw, part.charset or 'utf_8')
+					part_record['encoding'] = 'text'
+				except (UnicodeDecodeError, LookupError):
+					pass
+			if part_record['encoding'] == 'base64':
+				part_record['data'] = base64.b64encode(part.raw).decode('ascii')
+
+		record['parts'].append(part_record)
+
+	if names and worker_phonebook is not None:
+		record['names'] = {number: ' '.join(name).strip() for number, name in worker_phonebook.resolve([mms_headers]).items()}
+
+	return json.dumps(record, default=json_value)
+
+class DecodeRequestHandler(BaseHTTPRequestHandler):
+	# Keep-alive, so clients don't need a new connection for every message
+	protocol_version = 'HTTP/1.1'
+	server_version = 'MMSDecode/1.0'
+
+	# Query string options that are passed to `decode_message()`
+	options = ('parts', 'images', 'names', 'headers_only')
+
+	def do_GET(self):
+		if urlsplit(self.path).path.rstrip('/') == '/status':
+			return self.send_json(200, self.server.status())
+
+		self.send_json(404, {'error': 'Not found'})
+
+	def do_POST(self):
+		url = urlsplit(self.path)
+		path = url.path.rstrip('/')
+		if path not in ('/decode', '/download'):
+			return self.send_json(404, {'error': 'Not found'})
+
+		query = parse_qs(url.query)
+		options = {option: query.get(option, [''])[-1].lower() in ('1', 'true', 'yes') for option in self.options}
+
+		length = self.headers.get('Content-Length')
+		if length is None:
+			return self.send_json(411, {'error': 'Content-Length is required'})
+		try:
+			length = int(length)
+			if length < 0:
+				raise ValueError(length)
+		except ValueError:
+			# We don't know where the body ends, so the connection can't be used again
+			self.close_connection = True
+			return self.send_json(400, {'error': 'Content-Length must be a number of bytes'})
+		if length > self.server.max_size:
+			# Don't leave the body on the connection
+			self.close_connection = True
+			return self.send_json(413, {'error': 'Messages can be at most {0} bytes'.format(self.server.max_size)})
+
+		# Too many requests already waiting?  Tell the client to try again, instead of queuing forever
+		# This is checked before the body is read, so rejected requests don't cost us reading (and holding) it
+		if not self.server.admit():
+			self.close_connection = True
+			return self.send_json(503, {'error': 'Too many requests'}, {'Retry-After': '1'})
+
+		# The slot is ours until the message has been decoded
+		try:
+			body = self.rfile.read(length)
+
+			if path == '/download':
+				mms_data = self.download(body)
+			else:
+				mms_data = body
+		except Exception:
+			self.server.leave()
+			raise
+
+		if mms_data is None:
+			self.server.leave()
+			return
+
+		# This gives the slot back once the worker is done with it, even if we stop waiting first
+		status, response = self.server.decode(mms_data, options)
+		self.send_json(status, response)
+
+	def download(self, body):
+		# Downloading is waiting on the network, so it's done here instead of in a worker
+		try:
+			request = json.loads(body)
+			phone_num, mms_id = str(request['phone']), str(request['mms_id'])
+		except (ValueError, KeyError, TypeError):
+			self.send_json(400, {'error': 'Send {"phone": ..., "mms_id": ...}'})
+			return None
+
+		message = self.server.phone(phone_num).download(mms_id, proxy=False)
+		if message is None:
+			self.send_json(404, {'error': 'MMS {0} could not be downloaded'.format(mms_id)})
+			return None
+
+		try:
+			return message.read()
+		finally:
+			message.close()
+
+	def send_json(self, status, value, headers=None):
+		body = (value if isinstance(value, str) else json.dumps(value, default=json_value)).encode('utf_8')
+
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		for header, header_value in (headers or {}).items():
+			self.send_header(header, header_value)
+		self.end_headers()
+
+		self.wfile.write(body)
+
+	def address_string(self):
+		# Unix sockets don't have an address
+		return self.client_address[0] if self.client_address else 'unix'
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			super().log_message(format, *args)
+
+class DecodeService:
+	"""
+	What `DecodeServer` and `UnixDecodeServer` have in common: the pool of
+	worker processes, and how many requests are let in at once.
+
+	`workers` messages are decoded at the same time, and up to `queue_size` more
+	wait for a worker.  Past that, requests get a 503 right away.  A message
+	keeps its spot until a worker has finished with it, even if it timed out.
+
+	If a worker dies (and takes the pool with it), a new pool is started.
+	"""
+	daemon_threads = True
+
+	def start_service(self, workers=None, queue_size=16, phonebook='phonebook.db', cache=None, timeout=30,
+		max_size=64*1024*1024, verbose=False):
+		self.workers = workers or os.cpu_count() or 1
+		self.queue_size = queue_size
+		self.timeout = timeout
+		self.max_size = max_size
+		self.verbose = verbose
+
+		self.busy = 0
+		self.counters = {'decoded': 0, 'errors': 0, 'rejected': 0, 'timeouts': 0, 'crashes': 0}
+		self.counter_lock = threading.Lock()
+		self.started = time.time()
+
+		# Downloads share one cache (and what's been learned about the servers)
+		self.cache = cache
+		self.phones = {}
+		self.phone_lock = threading.Lock()
+
+		self.phonebook = phonebook
+		self.pool_lock = threading.Lock()
+		self.pool = self.start_pool()
+
+	def start_pool(self):
+		barrier = multiprocessing.Barrier(self.workers)
+		pool = ProcessPoolExecutor(self.workers, initializer=start_worker, initargs=(self.phonebook, barrier))
+
+		# Start all of the workers now, so the first requests don't have to wait for them
+		# These are the workers that said they're running, if some didn't then there are fewer of them
+		self.pids = sorted(set(future.result() for future in [pool.submit(warm_up) for x in range(self.workers)]))
+
+		return pool
+
+	def restart_pool(self, broken):
+		# A worker died, so the pool won't take any more work, start a new one
+		# Only once, even if a bunch of requests noticed at the same time
+		with self.pool_lock:
+			if self.pool is broken:
+				broken.shutdown(wait=False, cancel_futures=True)
+				self.pool = self.start_pool()
+
+			return self.pool
+
+	def submit(self, mms_data, options):
+		# Returns the pool the message was sent to, and its future
+		pool = self.pool
+		try:
+			return pool, pool.submit(decode_message, mms_data, **options)
+		except BrokenProcessPool:
+			# It broke before this message got to it, so it's fine to try it on a new one
+			pool = self.restart_pool(pool)
+			return pool, pool.submit(decode_message, mms_data, **options)
+
+	def phone(self, phone_num):
+		with self.phone_lock:
+			if phone_num not in self.phones:
+				from VirginMobile import VirginMobile
+				self.phones[phone_num] = VirginMobile(phone_num, cache=self.cache)
+
+			return self.phones[phone_num]
+
+	def admit(self):
+		# Let a request in, if there's a worker (or a spot in the queue) for it
+		with self.counter_lock:
+			if self.busy >= self.workers + self.queue_size:
+				self.counters['rejected'] += 1
+				return False
+
+			self.busy += 1
+			return True
+
+	def leave(self):
+		with self.counter_lock:
+			self.busy -= 1
+
+	def count(self, counter):
+		with self.counter_lock:
+			self.counters[counter] += 1
+
+	def decode(self, mms_data, options):
+		# Returns the HTTP status and the JSON to send back
+		# Call `admit()` first, this calls `leave()` when the worker is done
+		try:
+			pool, future = self.submit(mms_data, options)
+		except Exception as error:
+			self.leave()
+			return 500, {'error': '{0}: {1}'.format(type(error).__name__, error)}
+
+		future.add_done_callback(lambda future: self.leave())
+
+		try:
+			record = future.result(timeout=self.timeout)
+		except TimeoutError:
+			# It'll still finish (and keep its spot until then), but we're not waiting for it
+			self.count('timeouts')
+			return 504, {'error': 'Decoding took longer than {0} seconds'.format(self.timeout)}
+		except BrokenProcessPool:
+			# The worker died (maybe because of this message), the next request gets a new pool
+			self.count('crashes')
+			self.restart_pool(pool)
+			return 500, {'error': 'The worker decoding this message stopped'}
+		except Exception as error:
+			self.count('errors')
+			return 422, {'error': '{0}: {1}'.format(type(error).__name__, error)}
+
+		self.count('decoded')
+		return 200, record
+
+	def status(self):
+		with self.counter_lock:
+			return dict(self.counters,
+				busy=self.busy,
+				workers=self.workers,
+				pids=self.pids,
+				queue_size=self.queue_size,
+				uptime=time.time() - self.started
+			)
+
+	def server_close(self):
+		super().server_close()
+		self.pool.shutdown(cancel_futures=True)
+
+class DecodeServer(DecodeService, ThreadingHTTPServer):
+	def __init__(self, address=('127.0.0.1', 8089), **options):
+		ThreadingHTTPServer.__init__(self, address, DecodeRequestHandler)
+		self.start_service(**options)
+
+class UnixDecodeServer(DecodeService, socketserver.ThreadingUnixStreamServer):
+	def __init__(self, path, **options):
+		# A socket file left over from last time
+		if os.path.exists(path):
+			os.unlink(path)
+
+		socketserver.ThreadingUnixStreamServer.__init__(self, path, DecodeRequestHandler)
+		self.start_service(**options)
+
+	def server_close(self):
+		super().server_close()
+		try:
+			os.unlink(self.server_address)
+		except OSError:
+			pass
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description="Run a local JSON API for decoding MMS messages",
+		epilog="https://github.com/NTICompass/mms-viewer"
+	)
+
+	parser.add_argument('--host', default='127.0.0.1', help="Address to listen on (default: 127.0.0.1)")
+	parser.add_argument('--port', type=int, default=8089, help="Port to listen on (default: 8089)")
+	parser.add_argument('--socket', metavar="PATH", help="Listen on this Unix socket instead")
+	parser.add_argument('-j', '--workers', type=int, help="Worker processes (default: number of CPUs)")
+	parser.add_argument('-q', '--queue-size', type=int, default=16, help="Requests that can wait for a worker, the rest get a 503 (default: 16)")
+	parser.add_argument('-p', '--phonebook', nargs="?", const="phonebook.db", metavar="FILE", help="Look up names (with ?names=1) in this phonebook (default: phonebook.db)")
+	parser.add_argument('-c', '--cache', nargs="?", const="mms_cache", metavar="DIR", help="Cache downloaded messages in this directory (default: mms_cache)")
+	parser.add_argument('--timeout', type=float, default=30, help="Seconds to wait for a message to be decoded (default: 30)")
+	parser.add_argument('--max-size', type=int, default=64*1024*1024, help="Biggest message to accept, in bytes (default: 64MB)")
+	parser.add_argument('-v', '--verbose', help="Log each request", action="store_true")
+
+	args = parser.parse_args()
+
+	cache = None
+	if args.cache is not None:
+		from PDUCache import PDUCache
+		cache = PDUCache(args.cache)
+
+	options = dict(workers=args.workers, queue_size=args.queue_size, phonebook=args.phonebook, cache=cache,
+		timeout=args.timeout, max_size=args.max_size, verbose=args.verbose)
+
+	if args.socket is not None:
+		server = UnixDecodeServer(args.socket, **options)
+		print('Decoding on {0} with {1} workers'.format(args.socket, server.workers), file=sys.stderr)
+	else:
+		server = DecodeServer((args.host, args.port), **options)
+		print('Decoding on http://{0}:{1}/ with {2} workers'.format(args.host, server.server_address[1], server.workers), file=sys.stderr)
+
+	# Stop nicely on Ctrl+C or a kill
+	signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
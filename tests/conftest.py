@@ -0,0 +1,4 @@
+import os.path, sys
+
+# The modules are in the root of the repo, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,23 @@
+"""
+	Tests for the shared MMS decoder: decoding from a lot of threads at once,
+	and encoding messages then decoding them back.
+
+	These run the same checks as `benchmark.py --stress` and `--roundtrip`.
+"""
+import pytest
+
+import benchmark
+
+def test_threads_match_single():
+	# Every kind of message (except the big, slow to make, one), decoded by 8 threads at once
+	names = [name for name in benchmark.benchmarks if name != 'large-image']
+	results = benchmark.run_stress(names, threads=8, rounds=20, seeds=3)
+
+	assert results[0]['mismatches'] == 0
+
+@pytest.mark.parametrize('name', list(benchmark.roundtrips))
+@pytest.mark.parametrize('unknown', [None] + list(benchmark.unknown_headers))
+def test_roundtrip(name, unknown):
+	size, errors = benchmark.check_roundtrip(benchmark.roundtrips[name], benchmark.unknown_headers.get(unknown, b''))
+
+	assert errors == []
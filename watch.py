@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+	MMS Log Watcher
+	By: Eric Siegel
+	https://github.com/NTICompass/mms-viewer
+
+	Tails Signal's logs (a file, or a directory of them) for MMS IDs,
+	then downloads, decodes and extracts each new one.
+
+	IDs go through a bounded queue, so when a burst of them shows up we
+	just stop reading the logs until the downloads catch up.
+"""
+import argparse, asyncio, glob, os, os.path, re, signal
+from concurrent.futures import ThreadPoolExecutor
+
+from MMSMessage import MMSMessage
+from Profiler import profiler
+
+class LogTailer:
+	"""
+	Follows one or more log files, like `tail -F`.
+
+	Directories are checked for new files (matching `pattern`) on every poll.
+	If a file is replaced (log rotation) or truncated, it's read from the start again.
+
+	At most `chunk_size` bytes of each file are read at a time (in a thread, so
+	the event loop keeps going).  The next chunk is only read once the lines from
+	this one have been used, so a huge backlog never has to fit in memory.
+	"""
+	chunk_size = 1024*1024
+
+	def __init__(self, paths, pattern='*.log', interval=1.0, from_start=False):
+		self.paths = paths
+		self.pattern = pattern
+		self.interval = interval
+		self.from_start = from_start
+
+		# file name => [inode, offset, leftover (partial line)]
+		self.files = {}
+
+	def find_files(self):
+		for path in self.paths:
+			if os.path.isdir(path):
+				yield from sorted(glob.glob(os.path.join(glob.escape(path), self.pattern)))
+			elif os.path.isfile(path):
+				yield path
+
+	def read_new(self, first=False):
+		# Returns the complete lines that were added to each file since last time,
+		# and if there's more to read (when a file had more than `chunk_size` new bytes)
+		lines = []
+		more = False
+
+		for file_name in self.find_files():
+			try:
+				stat = os.stat(file_name)
+			except OSError:
+				continue
+
+			state = self.files.get(file_name)
+			if state is None:
+				# Files that are there when we start are skipped, unless we were told to read them.
+				# Files that show up later are always read from the start.
+				offset = 0 if self.from_start or not first else stat.st_size
+				state = self.files[file_name] = [stat.st_ino, offset, b'']
+			elif state[0] != stat.st_ino or stat.st_size < state[1]:
+				# Rotated or truncated
+				state[:] = [stat.st_ino, 0, b'']
+
+			if stat.st_size == state[1]:
+				continue
+
+			with open(file_name, 'rb') as log_file:
+				log_file.seek(state[1])
+				data = log_file.read(self.chunk_size)
+
+			state[1] += len(data)
+			if state[1] < stat.st_size:
+				more = True
+
+			# Hang on to the last line until it's finished
+			# A "line" longer than a chunk isn't one we're looking for, so don't keep all of it
+			data = state[2] + data
+			*complete, state[2] = data.split(b'\n')
+			state[2] = state[2][-self.chunk_size:]
+			lines.extend(line.decode('utf_8', 'replace') for line in complete)
+
+		return lines, more
+
+	async def lines(self):
+		# Yields each new line, forever
+		first = True
+		while True:
+			lines, more = await asyncio.to_thread(self.read_new, first)
+			for line in lines:
+				yield line
+
+			first = False
+
+			# Still catching up?  Then don't wait before reading the next chunk.
+			if not more:
+				await asyncio.sleep(self.interval)
+
+class MMSWatcher:
+	"""
+	Finds MMS IDs in log lines and downloads them.
+
+	The tailer puts each new ID on a queue with a maximum size, and `workers`
+	tasks take them off of it.  The downloading, decoding and writing files is
+	blocking, so that's done in a thread pool.
+
+	IDs that were already downloaded are remembered in `seen_file`, so they
+	aren't downloaded again when the watcher is restarted.
+	"""
+	# Signal logs the Content-Location of the MMS notification, the ID is the query string.
+	# Anything that looks like "transaction id: XXX" is picked up too.
+	# Use the `phone` group if the log has the phone number in it, otherwise the default number is used.
+	id_pattern = r'(?:ammsc\?|transaction[ _-]?id[=: ]+)(?P<mms_id>[A-Za-z0-9_-]+)'
+
+	def __init__(self, phone_num, output='.', cache=None, workers=4, queue_size=16, seen_file=None, id_pattern=None, proxy=False):
+		self.phone_num = phone_num
+		self.output = output
+		self.cache = cache
+		self.workers = workers
+		self.queue_size = queue_size
+		self.seen_file = seen_file
+		self.proxy = proxy
+
+		self.id_regex = re.compile(id_pattern or self.id_pattern, re.IGNORECASE)
+
+		# IDs that are done, or in the queue right now
+		self.seen = set()
+		if seen_file is not None and os.path.isfile(seen_file):
+			with open(seen_file) as seen:
+				self.seen.update(line.strip() for line in seen if line.strip())
+
+		# One VirginMobile object per phone number
+		self.phones = {}
+
+	def find_ids(self, line):
+		for match in self.id_regex.finditer(line):
+			groups = match.groupdict()
+			yield groups.get('phone') or self.phone_num, groups['mms_id']
+
+	def phone(self, phone_num):
+		if phone_num not in self.phones:
+			from VirginMobile import VirginMobile
+			self.phones[phone_num] = VirginMobile(phone_num, cache=self.cache)
+
+		return self.phones[phone_num]
+
+	def process(self, phone_num, mms_id):
+		# Download, decode and extract one message (this runs in a thread)
+		with profiler.timer('download'):
+			message = self.phone(phone_num).download(mms_id, proxy=self.proxy)
+			if message is None:
+				return None
+
+			try:
+				mms_data = message.read()
+			finally:
+				message.close()
+
+		mms_headers, mms_parts = MMSMessage(mms_data).decode(use_pil=False, lazy=True)
+
+		saved = []
+		if mms_headers.get('Content-Type') == 'text/plain':
+			print('MMS Error ({0}):'.format(mms_id), mms_parts[0]['data'])
+			return saved
+
+		with profiler.timer('write'):
+			for part in mms_parts:
+				if part.kind() in ('image', 'other'):
+					# Start with the ID, different messages can have files with the same name
+					save_name = os.path.join(self.output, '{0}_{1}'.format(mms_id, part.real_file_name()))
+				elif part.kind() == 'text':
+					save_name = os.path.join(self.output, '{0}_{1}.txt'.format(mms_id, os.path.splitext(part.file_name or 'text')[0]))
+				else:
+					continue
+
+				with open(save_name, 'wb') as part_file:
+					part_file.write(part.raw)
+				saved.append(save_name)
+
+		return saved
+
+	def remember(self, mms_id):
+		if self.seen_file is not None:
+			with open(self.seen_file, 'a') as seen:
+				seen.write(mms_id + '\n')
+
+	async def worker(self, queue, executor):
+		loop = asyncio.get_running_loop()
+
+		while True:
+			phone_num, mms_id = await queue.get()
+			try:
+				saved = await loop.run_in_executor(executor, self.process, phone_num, mms_id)
+			except Exception as error:
+				saved = None
+				print('MMS ({0}) Failed: {1}: {2}'.format(mms_id, type(error).__name__, error))
+			finally:
+				queue.task_done()
+
+			if saved is None:
+				# Let it be tried again, if it shows up in the logs again
+				self.seen.discard(mms_id)
+			else:
+				self.remember(mms_id)
+				profiler.count('watch.messages')
+				print('MMS ({0}) Saved:'.format(mms_id), ', '.join(saved) or 'nothing')
+
+	async def watch(self, tailer):
+		queue = asyncio.Queue(maxsize=self.queue_size)
+
+		with ThreadPoolExecutor(max_workers=self.workers) as executor:
+			workers = [asyncio.create_task(self.worker(queue, executor)) for x in range(self.workers)]
+			try:
+				async for line in tailer.lines():
+					for phone_num, mms_id in self.find_ids(line):
+						if mms_id in self.seen:
+							profiler.count('watch.duplicates')
+							continue
+
+						self.seen.add(mms_id)
+						profiler.count('watch.queued')
+
+						# This waits when the queue is full, so we stop reading the logs
+						await queue.put((phone_num, mms_id))
+			finally:
+				# Let the ones we have finish, then stop the workers
+				await queue.join()
+				for task in workers:
+					task.cancel()
+				await asyncio.gather(*workers, return_exceptions=True)
+
+async def main(args):
+	cache = None
+	if args.cache:
+		from PDUCache import PDUCache
+		cache = PDUCache(args.cache_dir or 'mms_cache')
+
+	os.makedirs(args.output, exist_ok=True)
+
+	watcher = MMSWatcher(args.phone, args.output, cache, args.workers, args.queue_size, args.seen, args.id_pattern, args.proxy)
+	tailer = LogTailer(args.logs, args.pattern, args.interval, args.from_start)
+
+	task = asyncio.create_task(watcher.watch(tailer))
+
+	# Stop (after finishing what's queued) on Ctrl+C or `kill`
+	loop = asyncio.get_running_loop()
+	for signum in (signal.SIGINT, signal.SIGTERM):
+		loop.add_signal_handler(signum, task.cancel)
+
+	try:
+		await task
+	except asyncio.CancelledError:
+		pass
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description="Watch Signal's logs for MMS messages, and download them",
+		epilog="https://github.com/NTICompass/mms-viewer"
+	)
+
+	parser.add_argument("phone", help="Phone number to download with (unless the log line has one)")
+	parser.add_argument("logs", nargs="+", help="Log files or directories to watch")
+	parser.add_argument('-o', '--output', default='.', help="Directory to save the images, texts and other attachments in (default: .)")
+	parser.add_argument('-c', '--cache', help="Cache downloaded messages (in --cache-dir)", action="store_true")
+	parser.add_argument('--cache-dir', metavar="DIR", help="Directory for -c/--cache (default: mms_cache)")
+	parser.add_argument('--pattern', default='*.log', help="File pattern to use in directories (default: *.log)")
+	parser.add_argument('--id-pattern', help="Regex to find MMS IDs, with a `mms_id` (and optional `phone`) group")
+	parser.add_argument('--seen', default='mms_seen.txt', help="File of IDs that were already downloaded (default: mms_seen.txt)")
+	parser.add_argument('--from-start', help="Read the logs from the start, not just new lines", action="store_true")
+	parser.add_argument('-w', '--workers', type=int, default=4, help="Downloads to run at once (default: 4)")
+	parser.add_argument('--queue-size', type=int, default=16, help="IDs to queue up before we stop reading the logs (default: 16)")
+	parser.add_argument('--interval', type=float, default=1.0, help="Seconds between checking the logs (default: 1)")
+	parser.add_argument('--proxy', help="Download through the proxies", action="store_true")
+
+	args = parser.parse_args()
+
+	if args.cache_dir is not None and not args.cache:
+		parser.error("--cache-dir needs -c/--cache")
+
+	if args.id_pattern is not None:
+		try:
+			if 'mms_id' not in re.compile(args.id_pattern).groupindex:
+				parser.error("--id-pattern needs a (?P<mms_id>...) group")
+		except re.error as error:
+			parser.error("bad --id-pattern: {0}".format(error))
+
+	asyncio.run(main(args))